@@ -11,6 +11,7 @@ from scipy.stats import mode
 from scipy import signal
 import pandas as pd
 from tkinter import *
+from pyAPisolation.database.fileIndex import fileIndex
 root = Tk()
 #root.withdraw()
 dir_path = filedialog.askdirectory(title="Choose Dir to sort")
@@ -55,25 +56,30 @@ label.pack()
 root_tk.update()
 
 
-for dir_paths in subfolders_to_use:
-    for root,dirs,files in os.walk(dir_paths): 
-        for x in files:
-            fp = os.path.join(root, x)
+#the protocols come from the file index of the dir, so only new or changed files are opened
+label.config(text=f"Indexing {dir_path}")
+root_tk.update()
+index = fileIndex(dir_path, extensions=('.abf',))
+index_df = index.query()
+index.close()
+#the index stores absolute paths, the dialog gives forward slashes on windows, so both are normalized before comparing
+def _norm_path(path):
+    return os.path.normcase(os.path.abspath(path))
 
-            if '.abf' in x:
-                print(f"opening {fp}")
-                label.config(text=f"Working on {fp}")
-                root_tk.update()
-                try:
-                    abf = pyabf.ABF(fp, loadData=False)
-                    proto = abf.protocol
-                    if '\\' in proto:
-                        proto = proto.split('\\')[-1]
-                    new_path = find_or_create_folder(out_path, proto)
-                    print(f"copying {fp}")
-                    shutil.copy2(fp, new_path)
-                except:
-                    pass
+for dir_paths in subfolders_to_use:
+    for fp, proto in zip(index_df['path'], index_df['protocol']):
+        if not _norm_path(fp).startswith(os.path.join(_norm_path(dir_paths), '')):
+            continue
+        label.config(text=f"Working on {fp}")
+        root_tk.update()
+        try:
+            if '\\' in proto:
+                proto = proto.split('\\')[-1]
+            new_path = find_or_create_folder(out_path, proto)
+            print(f"copying {fp}")
+            shutil.copy2(fp, new_path)
+        except:
+            pass
             
 #tell the user we are done
 label.config(text="Done")
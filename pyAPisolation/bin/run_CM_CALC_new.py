@@ -19,6 +19,7 @@ import pyabf
 import logging
 import scipy.ndimage as ndimage
 from pyAPisolation.patch_subthres import subthres_a
+from pyAPisolation.patch_utils import build_running_bin
 print("Load finished")
 logging.basicConfig(level=logging.DEBUG)
 root = tk.Tk()
@@ -479,30 +480,6 @@ def plotabf(abf, spiketimes, lowerlim, upperlim, sweep_plots):
    except:
         print('plot failed')
 
-def build_running_bin(array, time, start, end, bin=20, time_units='s', kind='nearest'):
-    if time_units == 's':
-        start = start * 1000
-        end = end* 1000
-
-        time = time*1000
-    time_bins = np.arange(start, end+bin, bin)
-    binned_ = np.full(time_bins.shape[0], np.nan, dtype=np.float64)
-    index_ = np.digitize(time, time_bins)
-    uni_index_ = np.unique(index_)
-    for time_ind in uni_index_:
-        data = np.asarray(array[index_==time_ind])
-        data = np.nanmean(data)
-        binned_[time_ind] = data
-    nans = np.isnan(binned_)
-    if np.any(nans):
-        if time.shape[0] > 1:
-            f = interpolate.interp1d(time, array, kind=kind, fill_value="extrapolate")
-            new_data = f(time_bins)
-            binned_[nans] = new_data[nans]
-        else:
-            binned_[nans] = np.nanmean(array)
-    return binned_, time_bins
-
 def mem_cap_alt(tau, b2, deflection):
     rm2 = np.abs((b2)/(deflection /1000000000000))#in pA -> A)
     cm = tau / rm2
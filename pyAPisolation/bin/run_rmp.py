@@ -14,7 +14,7 @@ from ipfx import feature_extractor
 from ipfx import subthresh_features as subt
 import pyabf
 
-from pyAPisolation.patch_utils import build_running_bin
+from pyAPisolation.patch_utils import build_running_bin, load_protocols
 
 print("Load finished")
 DEBUG = False
@@ -138,17 +138,7 @@ def rmp_abf(abf, time=30, crop=True, bin_time=100):
  #except:
      #return pd.DataFrame
 print('loading protocols...')
-protocol = []
-for root,dir,fileList in os.walk(files):
- for filename in fileList:
-    if filename.endswith(".abf"):
-        try:
-            file_path = os.path.join(root,filename)
-            abf = pyabf.ABF(file_path, loadData=False)
-            protocol = np.hstack((protocol, abf.protocol))
-        except:
-            print('error processing file ' + file_path)
-protocol_n = np.unique(protocol)
+protocol_n = load_protocols(files, use_index=True)
 
 
 
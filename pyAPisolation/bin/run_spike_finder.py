@@ -31,8 +31,10 @@ from matplotlib.widgets import SpanSelector
 print("Loaded external libraries")
 #import pyAPisolation
 from pyAPisolation.featureExtractor import save_data_frames, save_subthres_data, \
-process_file, analyze_subthres, preprocess_abf_subthreshold, determine_rejected_spikes
+process_file, process_files, analyze_subthres, preprocess_abf_subthreshold, batch_subthreshold_extract, determine_rejected_spikes, analyze_sweep, SIGNAL_CACHE
 from pyAPisolation.patch_subthres import exp_decay_2p
+from pyAPisolation.patch_utils import filter_bessel
+from pyAPisolation.database.fileIndex import fileIndex
 from pyAPisolation.dev.prism_writer_gui import PrismWriterGUI
 import time
 from ipfx.feature_extractor import SpikeFeatureExtractor
@@ -193,26 +195,24 @@ class analysis_gui(object):
             None
         """
         self.selected_dir = QFileDialog.getExistingDirectory()
-        self.abf_list = glob.glob(self.selected_dir + "/**/*.abf", recursive=True)
-        self.abf_list_name = [os.path.basename(x) for x in self.abf_list]
-        self.pairs = [c for c in zip(self.abf_list_name, self.abf_list)]
-        self.abf_file = self.pairs
-        self.selected_sweeps = None
         #create a popup about the scanning the files
-        self.scan_popup = QProgressDialog("Scanning files", "Cancel", 0, len(self.abf_list), parent=None)
+        self.scan_popup = QProgressDialog("Scanning files", "Cancel", 0, 0, parent=None)
         self.scan_popup.setWindowModality(QtCore.Qt.WindowModal)
         self.scan_popup.forceShow()
+        #the file index only opens the files that are new or changed since the last scan of this folder
+        def _scan_progress(done, total):
+            self.scan_popup.setMaximum(total)
+            self.scan_popup.setValue(done)
+        with fileIndex(self.selected_dir, extensions=('.abf',), progress_callback=_scan_progress) as index:
+            index_df = index.query(include_errors=True)
+        self.abf_list = index_df['path'].to_list()
+        self.abf_list_name = index_df['filename'].to_list()
+        self.pairs = [c for c in zip(self.abf_list_name, self.abf_list)]
+        self.abf_file = self.pairs
+        self.selected_sweeps = None
         #Generate the protocol list
-        self.protocol_list = []
-        self.protocol_file_pair = {}
-        for name, abf in self.abf_file:
-            try:
-                self.scan_popup.setValue(self.scan_popup.value() + 1)
-                abf_obj = pyabf.ABF(abf, loadData=False)
-                self.protocol_list.append(abf_obj.protocol)
-                self.protocol_file_pair[name] = abf_obj.protocol
-            except:
-                self.protocol_file_pair[name] = 'unknown'
+        self.protocol_list = index_df.loc[index_df['error'].isna(), 'protocol'].to_list()
+        self.protocol_file_pair = {name: (protocol if pd.isna(error) else 'unknown') for name, protocol, error in zip(index_df['filename'], index_df['protocol'], index_df['error'])}
         #we really only care about unique protocols
         #close the popup
         self.scan_popup.deleteLater()
@@ -329,11 +329,10 @@ class analysis_gui(object):
                 self.bessel.setValue(float(abf.dataRate/2)-1)
 
         #filter the abf with 5 khz lowpass
-        if self.bessel.text() == "" or float(self.bessel.text()) < 0:
+        if self.bessel.text() == "" or float(self.bessel.text()) <= 0:
             return abf
         
-        b, a = signal.bessel(4, float(self.bessel.text()), 'low', norm='phase', fs=abf.dataRate)
-        abf.data = signal.filtfilt(b, a, abf.data)
+        abf.data = filter_bessel(abf.data, abf.dataRate, float(self.bessel.text()))
         return abf
 
     def run_indiv_analysis(self):
@@ -355,21 +354,24 @@ class analysis_gui(object):
             if self.param_dict['end'] == 0.0 or self.param_dict['end'] > self.abf.sweepX[-1]:
                 self.param_dict['end'] = self.abf.sweepX[-1]
 
-            self.spike_extractor = SpikeFeatureExtractor(filter=0,  dv_cutoff=self.param_dict['dv_cutoff'],
+            spike_params = dict(filter=0,  dv_cutoff=self.param_dict['dv_cutoff'],
                 max_interval=self.param_dict['max_interval'], min_height=self.param_dict['min_height'], min_peak=self.param_dict['min_peak'],
                 start=self.param_dict['start'], end=self.param_dict['end'], thresh_frac=self.param_dict['thresh_frac'])
+            self.spike_extractor = SpikeFeatureExtractor(**spike_params)
             #extract the spikes and make a dataframe for each sweep
             self.spike_df = {}
             self.rejected_spikes = {} if show_rejected else None
-            for sweep in self.selected_sweeps:
-                self.abf.setSweep(sweep)
-                
-                self.spike_df[sweep] = self.spike_extractor.process(self.abf.sweepX,self.abf.sweepY, self.abf.sweepC)
-                if show_rejected:
-                    self.rejected_spikes[sweep] = pd.DataFrame().from_dict(determine_rejected_spikes(self.spike_extractor, self.spike_df[sweep], self.abf.sweepY, self.abf.sweepX, 
-                    self.param_dict)).T 
-                #self.rejected_spikes = None
-                self.indiv_popup.setValue(sweep)
+            #the dV/dt of each sweep is computed once, and shared by the spike detection and the rejected spike analysis
+            with SIGNAL_CACHE.scope():
+                for sweep in self.selected_sweeps:
+                    self.abf.setSweep(sweep)
+                    #analyze_sweep is memoized on the (filtered) sweep data and the params, so re-running with settings we have already seen is instant
+                    self.spike_df[sweep] = analyze_sweep(self.abf.sweepX, self.abf.sweepY, self.abf.sweepC, spike_params)[0]
+                    if show_rejected:
+                        self.rejected_spikes[sweep] = pd.DataFrame().from_dict(determine_rejected_spikes(self.spike_extractor, self.spike_df[sweep], self.abf.sweepY, self.abf.sweepX, 
+                        self.param_dict)).T 
+                    #self.rejected_spikes = None
+                    self.indiv_popup.setValue(sweep)
             #self.spike_df = pd.concat(self.spike_df)
         elif self.get_current_analysis() is 'subthres':
             self.spike_df = None
@@ -519,34 +521,17 @@ class analysis_gui(object):
         df_full = []
         df_running_avg = []
         parallel_processing = self.actionEnable_Parallel.isChecked()
-        i = 0
-
-        if parallel_processing:
-            def update_iteration(_, i):
-                popup.setValue(i)
-                popup.setLabelText("Processing file " + str(i) + " of " + str(len(filelist)))
-            pool = mp.Pool(mp.cpu_count())
 
-            results = [pool.apply_async(process_file, args=(file, copy.deepcopy(param_dict), protocol_name), callback=partial(update_iteration, i=i)) for (i, file) in enumerate(filelist)]
-            
-            ##split out the results
-            pool.close()
-            #pool.join()
-            for result in results:
-                popup.setValue(popup.value())
-                result.wait()
-                temp_res = result.get()
-                df_full.append(temp_res[1])
-                df_running_avg.append(temp_res[2])
-                spike_count.append(temp_res[0])
-            pool.join()
-        else:
-            for i, f in enumerate(filelist):
-                popup.setValue(i)
-                temp_df_spike_count, temp_full_df, temp_running_bin = process_file(f, copy.deepcopy(param_dict),protocol_name)
-                spike_count.append(temp_df_spike_count)
-                df_full.append(temp_full_df)
-                df_running_avg.append(temp_running_bin)
+        #the files (and the sweeps of long files) are scheduled over one pool, using every core if parallel processing is on
+        results = [None] * len(filelist)
+        for n_done, (i, result, _) in enumerate(process_files(filelist, param_dict, protocol_name, n_jobs=mp.cpu_count() if parallel_processing else 1)):
+            results[i] = result
+            popup.setValue(n_done + 1)
+            popup.setLabelText("Processing file " + str(n_done + 1) + " of " + str(len(filelist)))
+        for temp_df_spike_count, temp_full_df, temp_running_bin in results:
+            spike_count.append(temp_df_spike_count)
+            df_full.append(temp_full_df)
+            df_running_avg.append(temp_running_bin)
         df_spike_count = pd.concat(spike_count, sort=True)
         dfs = pd.concat(df_full, sort=True)
         df_running_avg_count = pd.concat(df_running_avg, sort=False)
@@ -562,13 +547,15 @@ class analysis_gui(object):
         popup = QProgressDialog("Operation in progress.", "Cancel", 0, len(filelist), None)
         popup.setWindowModality(QtCore.Qt.WindowModal)
         popup.forceShow()
-        dfs = []
-        for i, f in enumerate(filelist):
-            popup.setValue(i)
-            df = preprocess_abf_subthreshold(f, protocol_name, copy.deepcopy(param_dict))
-            dfs.append(df)
+        parallel_processing = self.actionEnable_Parallel.isChecked()
+        def _progress(n_done, n_files, file):
+            popup.setValue(n_done)
+            popup.setLabelText("Processing file " + str(n_done) + " of " + str(n_files))
+        #the files are spread over every core if parallel processing is on, a file that fails is left out
+        avg_df, sweepwise_df = batch_subthreshold_extract(filelist, copy.deepcopy(param_dict), protocol_name,
+                                                          n_jobs=mp.cpu_count() if parallel_processing else 1, progress=_progress)
         popup.hide()
-        return pd.concat([x[0] for x in dfs], axis=0), pd.concat([x[1] for x in dfs], axis=0)
+        return sweepwise_df, avg_df
 
 
     def _plot_matplotlib(self):
@@ -591,7 +578,7 @@ class analysis_gui(object):
             self.abf.setSweep(sweep)
             self.axe1.plot(self.abf.sweepX, self.abf.sweepY, label=str(sweep))
             #plot the dvdt
-            self.axe2.plot(self.abf.sweepX[:-1], (np.diff(self.abf.sweepY)/(np.diff(self.abf.sweepX)*1000)))
+            self.axe2.plot(self.abf.sweepX[:-1], SIGNAL_CACHE.dvdt(self.abf.sweepY, self.abf.sweepX))
         self.axe1.set_title(self.selected_abf_name)
 
         #draw the dvdt threshold
@@ -753,7 +740,7 @@ class analysis_gui(object):
             self.abf.setSweep(sweep)
             self.axe1.plot(self.abf.sweepX, self.abf.sweepY, pen=pg.mkPen(colors[i], width=3), name="Sweep_" + str(sweep))
             #plot the dvdt
-            self.axe2.plot(self.abf.sweepX[:-1], (np.diff(self.abf.sweepY)/np.diff(self.abf.sweepX))/1000,pen=pg.mkPen(colors[i]), name="Sweep_" + str(sweep))
+            self.axe2.plot(self.abf.sweepX[:-1], SIGNAL_CACHE.dvdt(self.abf.sweepY, self.abf.sweepX),pen=pg.mkPen(colors[i]), name="Sweep_" + str(sweep))
         #self.axe1.set_title(self.selected_abf_name)
 
         #draw the dvdt threshold
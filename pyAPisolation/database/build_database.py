@@ -42,6 +42,7 @@ from pyAPisolation import patch_utils
 from pyAPisolation.utils import arg_wrap
 from pyAPisolation.loadFile.loadNWB import loadNWB, GLOBAL_STIM_NAMES
 from pyAPisolation.featureExtractor import analyze_spike_times
+from pyAPisolation.scheduler import workScheduler
 try:
     from pyAPisolation.dev import stim_classifier as sc
 except:
@@ -77,10 +78,11 @@ def run_analysis(folder, backend="ipfx", outfile='out.csv', ext="nwb", parallel=
                                 data_source='filesystem',
                                 ontology=None,
                                 file_list=files)
-        if parallel == True:
-            #Run in parallel
-            parallel = joblib.cpu_count()
-        results = joblib.Parallel(n_jobs=1, backend='multiprocessing')(joblib.delayed(get_data_partial)(specimen_id) for specimen_id in file_idx)
+        #Run in parallel (all the cores if parallel is True, or that many workers), on the shared scheduler
+        n_jobs = joblib.cpu_count() if parallel is True else max(int(parallel), 1)
+        results = [None] * len(file_idx)
+        for i, result, _ in workScheduler(n_jobs=n_jobs).map(get_data_partial, file_idx):
+            results[i] = result
         
     elif backend == "custom":
         # Use custom backend to extract features, this uses the spike_finder and patch_utils method, on the very far backend it uses ipfx, so feature values will more or less be the same
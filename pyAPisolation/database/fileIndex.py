@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from ..loadFile import probeFile
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INDEX_FILENAME = '.pyAPisolation_index.sqlite'
+INDEX_EXTENSIONS = ('.abf', '.nwb')
+#the metadata columns stored per file, on top of the path, size, mtime and hash
+META_COLS = ['protocol', 'sweepCount', 'sampleRate', 'sweepPointCount', 'sweepLengthSec', 'channelCount', 'respUnits', 'stimUnits', 'datetime']
+HASH_BLOCK = 1 << 16
+
+
+class fileIndex(object):
+    """
+    A persistent index of the recordings under a data root. The index is a sqlite sidecar stored in the root folder (by default, or in
+    ~/.pyAPisolation/index if the root is not writable, e.g. a read-only share, or in memory if neither is),
+    holding the path, size, mtime, a content hash and the header metadata (protocol, sweep count, sample rate, sweep length, units and recording datetime) of every file.
+    Only the file headers are read (see loadFile.probeFile), and on refresh only the files whose size or mtime changed are re-read.
+    Paths are stored relative to the root, so the index stays valid if the root is moved or mounted elsewhere.
+    Takes:
+        root: str, the data root to index
+        index_path (optional): str, where to store the sidecar (default: root/.pyAPisolation_index.sqlite)
+        extensions (optional): tuple, the file extensions to index (default: ('.abf', '.nwb'))
+        refresh (optional): bool, rescan the root on creation (default: True)
+    returns:
+        fileIndex object
+    """
+    def __init__(self, root, index_path=None, extensions=INDEX_EXTENSIONS, refresh=True, progress_callback=None):
+        self.root = os.path.abspath(root)
+        self.extensions = tuple(extensions)
+        if index_path is not None:
+            candidates = [index_path]
+        else:
+            candidates = [os.path.join(self.root, INDEX_FILENAME), _user_index_path(self.root)]
+        #the first place the sidecar can be written to, falling back to an index that only lasts as long as this object
+        self._conn = None
+        for path in candidates + [':memory:']:
+            try:
+                self._conn = self._connect(path)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Could not open the file index at {path}: {e}")
+                continue
+            self.index_path = path
+            break
+        if refresh:
+            self.refresh(progress_callback=progress_callback)
+
+    def _connect(self, index_path):
+        if index_path != ':memory:':
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        conn = sqlite3.connect(index_path)
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                                relpath TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT,
+                                protocol TEXT, sweepCount INTEGER, sampleRate REAL, sweepPointCount INTEGER, sweepLengthSec REAL,
+                                channelCount INTEGER, respUnits TEXT, stimUnits TEXT, datetime TEXT, error TEXT)""")
+            #an existing sidecar on a read-only share opens fine, but fails on the first write
+            conn.execute("DELETE FROM files WHERE 0")
+            conn.commit()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _walk(self):
+        #yields the relative path and stat of every indexable file under the root
+        for root, dirs, fileList in os.walk(self.root):
+            for filename in fileList:
+                if filename.lower().endswith(self.extensions):
+                    file_path = os.path.join(root, filename)
+                    yield os.path.relpath(file_path, self.root), os.stat(file_path)
+
+    def refresh(self, progress_callback=None):
+        """
+        Rescans the root. New files, and files whose size or mtime changed are probed, files no longer on disk are dropped.
+        :param progress_callback: optional callable(n_done, n_total), called as the changed files are probed
+        :return: dict with the number of added, updated, removed and unchanged files
+        """
+        known = {row[0]: (row[1], row[2]) for row in self._conn.execute("SELECT relpath, size, mtime FROM files")}
+        on_disk = {}
+        stale = []
+        for relpath, stat in self._walk():
+            on_disk[relpath] = stat
+            if relpath not in known or known[relpath] != (stat.st_size, stat.st_mtime):
+                stale.append(relpath)
+
+        for i, relpath in enumerate(stale):
+            self._update_file(relpath, on_disk[relpath])
+            if progress_callback is not None:
+                progress_callback(i + 1, len(stale))
+        #the sidecar can be shared by indexes with different extensions, so only drop the files this index covers
+        removed = [x for x in known if x not in on_disk and x.lower().endswith(self.extensions)]
+        self._conn.executemany("DELETE FROM files WHERE relpath = ?", [(x,) for x in removed])
+        self._conn.commit()
+
+        counts = {'added': len([x for x in stale if x not in known]), 'updated': len([x for x in stale if x in known]),
+                  'removed': len(removed), 'unchanged': len(on_disk) - len(stale)}
+        logger.info(f"Indexed {self.root}: {counts}")
+        return counts
+
+    def _update_file(self, relpath, stat):
+        file_path = os.path.join(self.root, relpath)
+        meta = {key: None for key in META_COLS}
+        error = None
+        try:
+            meta.update({key: value for key, value in probeFile(file_path).items() if key in META_COLS})
+            file_hash = _partial_hash(file_path, stat.st_size)
+        except Exception as e:
+            logger.info(f"error processing file {file_path}: {e}")
+            file_hash = None
+            error = str(e)
+        #sqlite does not take numpy scalars
+        meta = {key: (value.item() if isinstance(value, np.generic) else value) for key, value in meta.items()}
+        self._conn.execute(f"INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, {', '.join(['?'] * len(META_COLS))}, ?)",
+                           (relpath, stat.st_size, stat.st_mtime, file_hash, *[meta[key] for key in META_COLS], error))
+
+    def lookup(self, file_path):
+        """
+        Returns the indexed metadata for a single file, as a dict with the same keys as loadFile.probeFile.
+        If the file is not indexed (or changed since it was indexed) it is probed and the index is updated.
+        :param file_path: path to the file
+        """
+        file_path = os.path.abspath(file_path)
+        relpath = os.path.relpath(file_path, self.root)
+        stat = os.stat(file_path)
+        row = self._conn.execute("SELECT size, mtime FROM files WHERE relpath = ?", (relpath,)).fetchone()
+        if row is None or tuple(row) != (stat.st_size, stat.st_mtime):
+            self._update_file(relpath, stat)
+            self._conn.commit()
+        row = self._conn.execute(f"SELECT {', '.join(META_COLS)}, error FROM files WHERE relpath = ?", (relpath,)).fetchone()
+        if row[-1] is not None:
+            raise IOError(row[-1])
+        meta = dict(zip(META_COLS, row[:-1]))
+        meta['file'] = file_path
+        meta['protocol'] = meta['protocol'] if meta['protocol'] is not None else ''
+        return meta
+
+    def query(self, protocol=None, include_errors=False):
+        """
+        Returns the index as a dataframe, one row per file, with the absolute path in the path column.
+        :param protocol: optional, only return the files whose protocol contains this string (same matching as the feature extractor)
+        :param include_errors: also return the files whose header could not be read
+        """
+        sql = "SELECT * FROM files"
+        clauses, args = [], []
+        if not include_errors:
+            clauses.append("error IS NULL")
+        if protocol is not None:
+            clauses.append("instr(protocol, ?) > 0")
+            args.append(protocol)
+        if len(clauses) > 0:
+            sql += " WHERE " + " AND ".join(clauses)
+        df = pd.read_sql_query(sql + " ORDER BY relpath", self._conn, params=args)
+        df = df.loc[[x.lower().endswith(self.extensions) for x in df['relpath']]].reset_index(drop=True)
+        df.insert(0, 'path', [os.path.join(self.root, x) for x in df['relpath']])
+        df.insert(1, 'filename', [os.path.basename(x) for x in df['relpath']])
+        df.insert(2, 'foldername', [os.path.dirname(x) for x in df['path']])
+        return df
+
+    def files(self, protocol=None):
+        """
+        Returns the list of absolute file paths, optionally filtered by protocol
+        :param protocol: optional, only return the files whose protocol contains this string
+        """
+        return self.query(protocol=protocol)['path'].to_list()
+
+    def protocols(self):
+        """
+        Returns the unique protocols in the index
+        """
+        return np.unique(self.query()['protocol'].to_numpy(dtype=str))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.query(include_errors=True))
+
+    def __repr__(self):
+        return f"fileIndex object: {self.root}, {len(self)} files"
+
+
+def _user_index_path(root):
+    #the sidecar for a root that is not writable, one per root in the user's home
+    key = hashlib.blake2b(os.path.abspath(root).encode(), digest_size=16).hexdigest()
+    return os.path.join(os.path.expanduser('~'), '.pyAPisolation', 'index', key + '.sqlite')
+
+def _partial_hash(file_path, size=None, block=HASH_BLOCK):
+    """Hashes the size plus the first and last block of the file. Cheap even for large recordings, and enough to tell files apart or spot a changed file"""
+    if size is None:
+        size = os.path.getsize(file_path)
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, 'rb') as f:
+        h.update(f.read(block))
+        if size > block:
+            f.seek(max(size - block, block))
+            h.update(f.read(block))
+    return h.hexdigest()
@@ -7,6 +7,8 @@ import anndata as ad
 import logging
 from ..patch_utils import df_select_by_col
 from ..dataset import cellData
+from ..loadFile import probeFile
+from .fileIndex import fileIndex
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -103,6 +105,8 @@ class tsDatabase:
         #we have a cellindex df representing the df for cell index
         self.cellindex = pd.DataFrame()
         self.data = {}
+        #the file index is optional, see indexFiles
+        self.index = None
         #if a dataframe is passed in here, we will use it to populate the database
         if dataframe is not None:
             self.dataframe = dataframe
@@ -207,11 +211,26 @@ class tsDatabase:
         #data.var_names = features.columns
         return data
 
-    def parseFile(file):
-        #use celldata to parse the file
-        cell = cellData(file)
+    def indexFiles(self, root=None, **kwargs):
+        """
+        Build (or refresh) the persistent file index of a data root, files are then parsed from the index rather than opened
+        :param root: Root folder of the data, defaults to the database path
+        :return: Dataframe of the indexed files
+        """
+        if self.index is not None:
+            self.index.close()
+        self.index = fileIndex(root if root is not None else self.path, **kwargs)
+        return self.index.query()
+
+    def parseFile(self, file):
+        #only the file header is read (from the file index, if there is one), no sweep data is loaded
+        if self.index is not None:
+            meta = self.index.lookup(file)
+        else:
+            meta = probeFile(file)
         #now build a dict
-        file_dict = {'filename': cell.filename, 'foldername': cell.foldername, 'protocol': cell.protocol}
+        file_dict = {'filename': os.path.basename(file), 'foldername': os.path.dirname(os.path.abspath(file)), 'protocol': meta['protocol'],
+                     'sample_rate': meta['sampleRate']}
         return file_dict
 
     def addEntry(self, name, paths=None):
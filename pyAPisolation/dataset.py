@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import logging
+import pyabf
 from ipfx.sweep import Sweep, SweepSet
 from .loadFile import loadFile
 import os
@@ -33,19 +34,32 @@ class cellData(object):
         clampMode (optional): str, the clamp mode of the data (default: None)
         stimUnits (optional): str, the units of the stimulus data (default: 'pA')
         respUnits (optional): str, the units of the response data (default: 'mV')
+        dt (optional): float, the sample interval in seconds. If given in place of dataX, the time axis is implicit (see below)
+        startTime (optional): float, the time of the first sample in seconds, used with dt (default: 0)
+        load_into_mem (optional): bool, if False nwb files are kept open and sweeps are only read from disk when accessed (default: True).
+            Call close() when done
+    The time axis is only ever stored as a single row. dataX is a read-only broadcast view of it, built on first access, and dt / sampleRate
+    are always available without touching the time array.
     returns:
         cellData object
     """
 
-    def __init__(self, file=None, dataX=None, dataY=None, dataC=None, name=None, protocolList=None, clampMode=None, stimUnits='pA', respUnits='mV'):
+    def __init__(self, file=None, dataX=None, dataY=None, dataC=None, name=None, protocolList=None, clampMode=None, stimUnits='pA', respUnits='mV',
+                 dt=None, startTime=0., load_into_mem=True):
         logger.info(f"Creating cellData object")
         # if the file is not none, then we are loading from a file
         self.protocolList = protocolList
         self.protocol = None
+        self._dataX = None
+        self._epochs = None
+        self.dt = dt
+        self.startTime = startTime
+        #true if the time axis was never given as an array, i.e. it is fully defined by startTime and dt
+        self.implicitTime = file is None and dataX is None
         if file is not None:
             logger.info(f"Loading data from file: {file}")
             #if protocol list is provided, set the protocol
-            self.dataX, self.dataY, self.dataC, self._file_obj = loadFile(file, return_obj=True)
+            self.dataX, self.dataY, self.dataC, self._file_obj = loadFile(file, return_obj=True, load_into_mem=load_into_mem)
             self.data = [self.dataX, self.dataY, self.dataC]
             self.file = file
             self.fileName = file.split('/')[-1]
@@ -53,6 +67,7 @@ class cellData(object):
             self.name = '.'.join(os.path.basename(file).split('.')[:-1])
             self._load_from_file()
             self.protocol = self._file_obj.protocol
+            self._init_time()
         else:
             logger.info(f"Loading data from arrays")
             self.data = None
@@ -66,9 +81,11 @@ class cellData(object):
                 # create a unique name by hashing the data
                 self.name = "unamed_" + str(hash(dataY[0].tostring()))
 
-            self.dataX = dataX
             self.dataY = dataY
             self.dataC = dataC
+            if dataX is not None:
+                self.dataX = dataX
+            self._init_time()
             self.data = [self.dataX, self.dataY, self.dataC]
             self.clampMode = clampMode
             self.stimUnits = stimUnits
@@ -83,6 +100,42 @@ class cellData(object):
         self.dataY = self.data[1]
         self.dataC = self.data[2]
 
+    def _init_time(self):
+        #work out dt / start time from the time array if we were given one, otherwise the time axis is implicit
+        if self.dt is None and self._dataX is not None:
+            row = np.asarray(self._dataX[0])
+            self.dt = row[1] - row[0] if len(row) > 1 else np.nan
+            self.startTime = row[0]
+        if self.dt is None:
+            raise ValueError("One of dataX or dt must be provided")
+        self.sampleRate = 1 / self.dt
+
+    @property
+    def dataX(self):
+        if self._dataX is None:
+            self._dataX = implicit_time_axis(self.dataY, self.dt, self.startTime)
+        return self._dataX
+
+    @dataX.setter
+    def dataX(self, dataX):
+        self._dataX = dataX
+
+    @property
+    def epochs(self):
+        """The stimulus epoch table of the cell (see stimEpochs), built on first access. Read from the epoch header of abf files where possible"""
+        if self._epochs is None:
+            file_obj = getattr(self, '_file_obj', None)
+            if isinstance(file_obj, pyabf.ABF):
+                self._epochs = stimEpochs.from_abf(file_obj, dataC=self.dataC)
+            else:
+                self._epochs = stimEpochs.from_command(self.dataC)
+        return self._epochs
+
+    def close(self):
+        """Closes the underlying file, if it was left open (nwb files loaded with load_into_mem=False)"""
+        if hasattr(self, '_file_obj') and hasattr(self._file_obj, 'close'):
+            self._file_obj.close()
+
     def setProtocol(self, protocol):
         """ Some files / datasets may have multiple protocols, this allows the user to set the protocol for the data.
         This is useful for when the data is loaded from a file, and the protocol is not known
@@ -93,9 +146,9 @@ class cellData(object):
     def setSweep(self, sweep):
         self.sweep = sweep
         # index into the dataX, dataY, and dataC arrays to get the sweep data
-        self.sweepX = self.dataX[sweep]
         self.sweepY = self.dataY[sweep]
         self.sweepC = self.dataC[sweep]
+        self.sweepX = self.dataX[sweep]
         
     @property
     def sweepList(self):
@@ -109,8 +162,14 @@ class cellData(object):
     def sweepNumber(self):
         return self.sweep
     
+    @property
+    def sweepPointCount(self):
+        return len(self.sweepY)
+
     @property
     def sweepLengthSec(self):
+        if self.implicitTime:
+            return self.startTime + (self.sweepPointCount - 1) * self.dt
         return self.sweepX[-1]
 
     def __str__(self):
@@ -123,3 +182,224 @@ class cellData(object):
         return self.data[key]
     
     
+
+
+def implicit_time_axis(dataY, dt, startTime=0.):
+    """Builds the time axis for dataY from the start time and sample interval. Only a single row is allocated: for a 2d array of sweeps
+    the result is a read-only broadcast view of it, for a list of uneven sweeps it is an object array of views into it.
+    Takes:
+        dataY: np.array or list, the sweeps (sweeps, samples)
+        dt: float, the sample interval in seconds
+        startTime (optional): float, the time of the first sample (default: 0)
+    returns:
+        dataX: np.array
+    """
+    if isinstance(dataY, np.ndarray) and dataY.dtype != object:
+        if dataY.ndim == 1:
+            return startTime + np.arange(dataY.shape[0]) * dt
+        return np.broadcast_to(startTime + np.arange(dataY.shape[-1]) * dt, dataY.shape)
+    lengths = [len(y) for y in dataY]
+    row = startTime + np.arange(max(lengths)) * dt
+    dataX = np.empty(len(lengths), dtype=object)
+    for i, length in enumerate(lengths):
+        dataX[i] = row[:length]
+    return dataX
+
+
+class stimEpochs(object):
+    """
+    The stimulus epoch table of a cell. The command of each sweep is split into epochs (runs of a constant command), with their start / end
+    indices, amplitude and polarity. It is built once per file and shared by the analysis stages, which query it in place of rescanning the command waveforms.
+    Build it with from_command (a single vectorized diff over all the sweeps) or from_abf (pyabf's epoch header, where the header only holds steps).
+    Takes:
+        sweep: np.array, the sweep of each epoch. The epochs are sorted by sweep, then start
+        start: np.array, the first index of each epoch
+        end: np.array, the index after the last of each epoch
+        amplitude: np.array, the command during each epoch
+        sweepCount: int, the number of sweeps
+    """
+    def __init__(self, sweep, start, end, amplitude, sweepCount):
+        self.sweep = np.asarray(sweep, dtype=np.int64)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.amplitude = np.asarray(amplitude, dtype=np.float64)
+        #a nan command has no polarity, but counts as non zero (as for np.nonzero)
+        self.polarity = np.nan_to_num(np.sign(self.amplitude)).astype(np.int64)
+        self.sweepCount = int(sweepCount)
+        #the epochs of sweep i are rows _bounds[i]:_bounds[i + 1]
+        self._bounds = np.searchsorted(self.sweep, np.arange(self.sweepCount + 1))
+
+    @classmethod
+    def from_command(cls, dataC):
+        """Builds the table from the command waveforms, (sweeps, samples) or a list of uneven sweeps. The epochs break wherever the command changes"""
+        dense = isinstance(dataC, np.ndarray) and dataC.dtype != object
+        if dense and dataC.ndim == 1:
+            dataC = dataC.reshape(1, -1)
+        if dense:
+            sweepCount, n_points = dataC.shape
+            #one pass over all the sweeps, the same change points as np.nonzero(np.diff(dataC, axis=1)) (a nan sample is a change)
+            sweep, idx = np.nonzero(dataC[:, 1:] != dataC[:, :-1])
+            n_points = np.full(sweepCount, n_points)
+        else:
+            rows = [np.asarray(row) for row in dataC]
+            sweepCount = len(rows)
+            changes = [np.flatnonzero(row[1:] != row[:-1]) for row in rows]
+            sweep = np.repeat(np.arange(sweepCount), [len(change) for change in changes]).astype(np.int64)
+            idx = np.concatenate(changes + [np.zeros(0, dtype=np.int64)])
+            n_points = np.array([len(row) for row in rows])
+        #every sweep opens with an epoch at 0, then one after each change point
+        sweep = np.concatenate((np.arange(sweepCount), sweep))
+        start = np.concatenate((np.zeros(sweepCount, dtype=np.int64), idx + 1))
+        order = np.lexsort((start, sweep))
+        sweep, start = sweep[order], start[order]
+        last = np.append(sweep[1:] != sweep[:-1], True)
+        end = np.where(last, n_points[sweep], np.append(start[1:], 0))
+        if dense:
+            amplitude = dataC[sweep, start]
+        else:
+            amplitude = np.array([rows[i][j] for i, j in zip(sweep, start)], dtype=np.float64)
+        #empty sweeps have no epochs
+        keep = start < end
+        return cls(sweep[keep], start[keep], end[keep], amplitude[keep], sweepCount)
+
+    @classmethod
+    def from_abf(cls, abf, dataC=None, channel=0):
+        """ Builds the table from the epoch header of a pyabf.ABF, if every epoch is a step. Otherwise (ramps, pulse trains, no epoch waveform,
+        or a header that does not tile the sweeps) falls back to from_command, on dataC if given, else on the command generated from the header
+        """
+        table = cls._from_abf_header(abf, channel)
+        if table is not None:
+            return table
+        if dataC is None:
+            from .loadFile.loadABF import _abf_command_waveforms, _has_fixed_length_sweeps
+            if _has_fixed_length_sweeps(abf):
+                dataC = _abf_command_waveforms(abf, channel, abf.sweepCount, abf.sweepPointCount)
+            else:
+                dataC = []
+                for sweep in abf.sweepList:
+                    abf.setSweep(sweep, channel=channel)
+                    dataC.append(abf.sweepC)
+        return cls.from_command(dataC)
+
+    @classmethod
+    def _from_abf_header(cls, abf, channel=0):
+        if abf.abfVersion["major"] == 1:
+            nWaveformEnable = abf._headerV1.nWaveformEnable[channel]
+            nWaveformSource = abf._headerV1.nWaveformSource[channel]
+        else:
+            nWaveformEnable = abf._dacSection.nWaveformEnable[channel]
+            nWaveformSource = abf._dacSection.nWaveformSource[channel]
+        if nWaveformEnable == 0 or nWaveformSource != 1:
+            return None
+        if abf.sweepCount > 1 and hasattr(abf, "_synchArraySection") and len(set(abf._synchArraySection.lLength)) != 1:
+            return None
+        try:
+            epochTable = pyabf.waveform.EpochTable(abf, channel)
+        except Exception:
+            return None
+        n_points = abf.sweepPointCount
+        sweep, start, end, amplitude = [], [], [], []
+        for i, ep in enumerate(epochTable.epochWaveformsBySweep):
+            p1s, p2s = np.asarray(ep.p1s, dtype=np.int64), np.asarray(ep.p2s, dtype=np.int64)
+            #the epochs must tile the sweep exactly, and only steps have one amplitude
+            if len(p1s) == 0 or p1s[0] != 0 or p2s[-1] != n_points or np.any(p1s[1:] != p2s[:-1]) or np.any(p2s < p1s):
+                return None
+            nonempty = p2s > p1s
+            if any(epochType != "Step" for epochType, keep in zip(ep.types, nonempty) if keep):
+                return None
+            p1s, p2s, levels = p1s[nonempty], p2s[nonempty], np.asarray(ep.levels, dtype=np.float64)[nonempty]
+            #neighbouring steps at the same level are one epoch, as from_command would find
+            new = np.append(True, levels[1:] != levels[:-1])
+            sweep.append(np.full(np.count_nonzero(new), i))
+            start.append(p1s[new])
+            end.append(np.append(p1s[new][1:], n_points))
+            amplitude.append(levels[new])
+        if len(sweep) == 0:
+            return None
+        return cls(np.concatenate(sweep), np.concatenate(start), np.concatenate(end), np.concatenate(amplitude), len(sweep))
+
+    def __len__(self):
+        return len(self.start)
+
+    def __repr__(self):
+        return f"stimEpochs: {len(self)} epochs over {self.sweepCount} sweeps"
+
+    @property
+    def table(self):
+        """The epochs as a dataframe, one row per epoch"""
+        epoch = np.arange(len(self)) - self._bounds[self.sweep]
+        return pd.DataFrame({'sweep': self.sweep, 'epoch': epoch, 'start': self.start, 'end': self.end,
+                             'amplitude': self.amplitude, 'polarity': self.polarity})
+
+    def rows(self, sweep):
+        """The (first, last + 1) rows of the epochs of a sweep"""
+        return self._bounds[sweep], self._bounds[sweep + 1]
+
+    def select(self, sweeps):
+        """The table of some of the sweeps (an int or a list of sweeps), renumbered from 0 in the given order"""
+        sweeps = np.atleast_1d(sweeps)
+        rows = [np.arange(*self.rows(i)) for i in sweeps]
+        sweep = np.repeat(np.arange(len(sweeps)), [len(row) for row in rows])
+        rows = np.concatenate(rows + [np.zeros(0, dtype=np.int64)])
+        return stimEpochs(sweep, self.start[rows], self.end[rows], self.amplitude[rows], len(sweeps))
+
+    def steps(self, sweep):
+        """The changes of the command in a sweep, as (index, delta), with index i the change between samples i and i + 1 (as np.diff)"""
+        lo, hi = self.rows(sweep)
+        return self.start[lo + 1:hi] - 1, np.diff(self.amplitude[lo:hi])
+
+    def step_counts(self):
+        """The number of changes of the command in each sweep"""
+        return np.maximum(np.diff(self._bounds) - 1, 0)
+
+    def first_step(self, sweep, polarity):
+        """The index (as np.diff) of the first downward (polarity -1) or upward (polarity 1) change of the command in a sweep, None if there is none"""
+        idx, delta = self.steps(sweep)
+        found = np.flatnonzero(np.sign(delta) == polarity)
+        return idx[found[0]] if len(found) else None
+
+    def segment(self, sweep, polarity=None):
+        """The (first, last) index of the samples of a sweep with a command of that polarity (or any non zero command), (None, None) if there are none"""
+        lo, hi = self.rows(sweep)
+        found = np.flatnonzero(self.amplitude[lo:hi] != 0 if polarity is None else self.polarity[lo:hi] == polarity)
+        if len(found) == 0:
+            return None, None
+        return self.start[lo + found[0]], self.end[lo + found[-1]] - 1
+
+    def non_zero_range(self, sweep):
+        """The (first, last) index of the non zero command in a sweep, (None, None) if there is none"""
+        return self.segment(sweep)
+
+    def points(self, sweep, polarity=None):
+        """The number of samples of a sweep with a command of that polarity (or any non zero command)"""
+        lo, hi = self.rows(sweep)
+        keep = self.amplitude[lo:hi] != 0 if polarity is None else self.polarity[lo:hi] == polarity
+        return int(np.sum((self.end[lo:hi] - self.start[lo:hi])[keep]))
+
+    def sweeps_with(self, polarity, start=0, end=None):
+        """The sweeps with a command of that polarity somewhere in [start:end], which index each sweep as a slice would (negative from its end)"""
+        #the length of the sweep of each epoch
+        length = self.end[np.maximum(self._bounds[1:] - 1, 0)][self.sweep]
+        def _index(index, default):
+            if index is None:
+                return default
+            return np.clip(np.where(index < 0, index + length, index), 0, length)
+        start, end = _index(start, 0), _index(end, length)
+        keep = (self.polarity == polarity) & (self.end > start) & (self.start < end) & (start < end)
+        return np.unique(self.sweep[keep])
+
+
+def cell_epochs(data):
+    """The stimulus epoch table of a cellData, a pyabf.ABF (read from its header where possible), any other object with pyabf style sweeps,
+    or of the command waveforms themselves"""
+    if isinstance(data, cellData):
+        return data.epochs
+    if isinstance(data, pyabf.ABF):
+        return stimEpochs.from_abf(data)
+    if hasattr(data, 'setSweep'):
+        dataC = []
+        for sweep in data.sweepList:
+            data.setSweep(sweep)
+            dataC.append(np.asarray(data.sweepC))
+        return stimEpochs.from_command(dataC)
+    return stimEpochs.from_command(data)
@@ -20,6 +20,7 @@ from sklearn.preprocessing import minmax_scale
 import pyabf
 import logging
 import scipy.ndimage as ndimage
+from pyAPisolation.patch_utils import build_running_bins
 print("Load finished")
 logging.basicConfig(level=logging.DEBUG)
 root = tk.Tk()
@@ -220,31 +221,6 @@ def exp_decay_factor(dataT,dataV,dataI, end_index=3000, abf_id='abf'):
 
 
 
-def build_running_bin(array, time, start, end, bin=20, time_units='s', kind='nearest'):
-    if time_units == 's':
-        start = start * 1000
-        end = end* 1000
-
-        time = time*1000
-    time_bins = np.arange(start, end+bin, bin)
-    binned_ = np.full(time_bins.shape[0], np.nan, dtype=np.float64)
-    index_ = np.digitize(time, time_bins)
-    uni_index_ = np.unique(index_)
-    for time_ind in uni_index_:
-        data = np.asarray(array[index_==time_ind])
-        data = np.nanmean(data)
-        binned_[time_ind] = data
-    nans = np.isnan(binned_)
-    if np.any(nans):
-        if time.shape[0] > 1:
-            f = interpolate.interp1d(time, array, kind=kind, fill_value="extrapolate")
-            new_data = f(time_bins)
-            binned_[nans] = new_data[nans]
-        else:
-            binned_[nans] = np.nanmean(array)
-    return binned_, time_bins
-
-
 def find_zero(realC):
     #expects 1d array
     zero_ind = np.where(realC == 0)[0]
@@ -412,12 +388,9 @@ for root,dir,fileList in os.walk(files):
 
                     if spike_in_sweep.empty == False:
                         temp_spike_dfs_nonzero.append(spike_in_sweep)
-                        trough_average,_  = build_running_bin(spike_in_sweep['fast_trough_v'].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)
-                        peak_average = build_running_bin(spike_in_sweep['peak_v'].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)[0]
-                        peak_max_rise = build_running_bin(spike_in_sweep['upstroke'].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)[0]
-                        peak_max_down = build_running_bin(spike_in_sweep['downstroke'].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)[0]
-                        threshold = build_running_bin(spike_in_sweep['downstroke'].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)[0]
-                        peak_width = build_running_bin(spike_in_sweep['width'].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)[0]
+                        binned, _ = build_running_bins(spike_in_sweep[['fast_trough_v', 'peak_v', 'upstroke', 'downstroke', 'width']].to_numpy(), spike_in_sweep['peak_t'].to_numpy(), start=lowerlim, end=upperlim)
+                        trough_average, peak_average, peak_max_rise, peak_max_down, peak_width = binned[0].T
+                        threshold = peak_max_down
                         ratio = np.abs(peak_max_rise / peak_max_down)
                         sweepwise_trough_averge.append(trough_average)
                         sweepwise_peak_average.append(peak_average)
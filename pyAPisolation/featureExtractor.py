@@ -1,26 +1,39 @@
 import glob
 import os
 import functools
+import itertools
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pyabf
 import copy
+import threading
+import contextlib
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import hashlib
+import json
+import joblib
 import ipfx.spike_detector
+import ipfx.time_series_utils
 from ipfx import feature_extractor
 from ipfx import subthresh_features as subt
 import scipy.signal as signal
 import logging
 
 #Local imports
-from .ipfx_df import _build_full_df, _build_sweepwise_dataframe, save_data_frames, save_subthres_data
-from .loadFile import loadFile, loadABF
-from .dataset import cellData
-from .patch_utils import plotabf, load_protocols, find_non_zero_range, filter_bessel, parse_user_input
-from .patch_subthres import exp_decay_factor, membrane_resistance, mem_cap, mem_cap_alt, \
-    rmp_mode, compute_sag, exp_decay_factor_alt, exp_growth_factor, determine_subt, df_select_by_col, subthres_a
+from .ipfx_df import _build_full_df, sweepwiseAccumulator, save_data_frames, save_subthres_data
+from .loadFile import loadFile, loadABF, probeFile, openABF
+from .dataset import cellData, stimEpochs
+from .patch_utils import plotabf, load_protocols, find_non_zero_range, filter_bessel, use_bessel, parse_user_input, signalCache
+from .patch_subthres import exp_decay_factor, exp_decay_factor_batch, exp_rm_factor, membrane_resistance, mem_cap, mem_cap_alt, mem_resist_alt, \
+    rmp_mode, compute_sag, exp_decay_factor_alt, exp_growth_factor, determine_subt, df_select_by_col, subthres_a, subthresContext, \
+    step_indices, rmp_mode_block, membrane_resistance_block, compute_sag_block
 from .QC import run_qc
+from .patch_spikes import detect_spikes, block_dvdt, has_fixed_dt, spike_times_table
+from .utils import memoCache, memoize, canonical_params, array_key, file_key, package_version
+from .database.fileIndex import fileIndex
+from .scheduler import workScheduler
 
 #set up the logger
 logger = logging.getLogger(__name__)
@@ -31,8 +44,46 @@ logger.info('Feature extractor loaded')
 IC1_SPECIFIC_FUNCTIONS = True
 DEFAULT_DICT = {'start': 0, 'end': 0, 'filter': 0, 'stim_find': True}
 
+#=== feature dependency graph ===
+#each feature stage of analyze_sweepset, and the stages it needs. Callers declare the outputs they need ('outputs' in the param_dict, a list of stages),
+#and only those stages, and the ones they depend on, are run. By default (no 'outputs') every stage is run
+FEATURE_GRAPH = {
+    'spike_times': [], #the thresholds and peaks of the spikes (the spike count, spike times and isi)
+    'spike_features': ['spike_times'], #the full ipfx spike table, troughs, upstrokes, downstrokes, widths etc.
+    'spike_train': ['spike_features'], #the ipfx spike train features, adaptation, latency, mean isi etc.
+    'sweepwise': ['spike_train'], #the sweepwise summary columns of the spike count dataframe, first spike features, isi etc.
+    'running_bins': ['sweepwise'], #the running bin averages
+    'rheobase': ['sweepwise'], #the rheobase and mean features
+    'subthreshold': [], #the sag, taum and baseline voltage of each sweep
+    'current_injection': [], #the current injection (epoch) features of the file
+    'qc': [], #the rms noise and drift QC of the file
+    'decay_fit': [], #the one and two phase membrane decay fits to the mean sweep
+}
+
+def feature_stages(outputs=None):
+    """ Resolves the outputs a caller needs into the set of stages of FEATURE_GRAPH to run.
+    takes:
+        outputs (str or list): The names of the stages whose output is needed. None (or 'all') for every stage
+    returns:
+        stages (frozenset): The stages to run, the outputs and everything they depend on
+    """
+    if outputs is None or outputs == 'all':
+        return frozenset(FEATURE_GRAPH)
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    stages = set()
+    todo = list(outputs)
+    while todo:
+        stage = todo.pop()
+        if stage not in FEATURE_GRAPH:
+            raise ValueError(f'Unknown output {stage}, expected one of {list(FEATURE_GRAPH)}')
+        if stage not in stages:
+            stages.add(stage)
+            todo.extend(FEATURE_GRAPH[stage])
+    return frozenset(stages)
+
 #=== functional interface for programmatic use ===
-def analyze(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT, return_summary_frames=False):
+def analyze(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT, return_summary_frames=False, outputs=None):
     """ Runs the ipfx feature extractor over a single sweep, set of sweeps, or file. Returns the standard ipfx dataframe, and summary dataframes (if requested).
     Args:
         x (np.array, optional): The time array of the sweep. Defaults to None.
@@ -41,19 +92,48 @@ def analyze(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT, return_s
         file (str, optional): The file path of the sweep. Defaults to None.
         param_dict (dict, optional): The dictionary of parameters that will be passed to the feature extractor. Defaults to None.
         return_summary_frames (bool, optional): If True, will return the summary dataframes. Defaults to False.
+        outputs (list, optional): The stages of FEATURE_GRAPH that are needed, only these (and what they depend on) are computed. Defaults to None, every stage.
     Returns:
         df_raw_out: A dataframe of the full data as returned by the ipfx feature extractor. Consists of all the sweeps in the files stacked on top of each other.
         (optional) df_spike_count (pd.DataFrame): The dataframe that contains the standard ipfx features for the sweep, oriented sweepwise
         (optional) df_running_avg_count (pd.DataFrame): The dataframe that contains the standard ipfx features for the consecutive spikes in the sweep
     """
     data = parse_user_input(x, y, c, file)
+    if outputs is not None:
+        param_dict = dict(param_dict, outputs=sorted(feature_stages(outputs)))
     #determine what we should return
     temp_spike_df, df, temp_running_bin = analyze_sweepset(data, sweeplist=None, param_dict=param_dict)
     if return_summary_frames:
         return temp_spike_df, df, temp_running_bin
     return temp_spike_df
 
-#cache the function
+#=== memoization ===
+#results of analyze_sweep / analyze_sweepset are cached on the data (file path, size and mtime for a path, or a hash of the arrays) and the canonicalized param_dict,
+#so re-running with the same settings (e.g. toggling settings back and forth in the GUI) is instant.
+#set SWEEPSET_MEMO.disk_dir to also keep the results on disk between sessions, or .enabled = False to turn it off
+SWEEP_MEMO = memoCache(maxsize=512)
+SWEEPSET_MEMO = memoCache(maxsize=32)
+#the filtered voltage and dV/dt of each sweep, shared by the prescreen, ipfx (see calculate_dvdt below), determine_rejected_spikes and the GUI plots.
+#Only filled inside a SIGNAL_CACHE.scope() block, e.g. while analyze_sweep / analyze_sweepset run
+SIGNAL_CACHE = signalCache()
+
+def _analyze_sweep_key(x=None, y=None, c=None, param_dict=DEFAULT_DICT, bessel_filter=None):
+    return '|'.join(['analyze_sweep', package_version(), array_key(x, y, c), canonical_params(param_dict), str(bessel_filter)])
+
+def _analyze_sweepset_key(x=None, y=None, c=None, file=None, sweeplist=None, param_dict=DEFAULT_DICT):
+    if isinstance(file, str):
+        data_key = file_key(file)
+    elif isinstance(file, cellData):
+        #a loaded cellData may have been filtered or edited since, so it is keyed on its arrays (and the name and folder written into the frames), not its file
+        data_key = '|'.join([array_key(file.dataX, file.dataY, file.dataC), str(file.name), file.filePath])
+    elif file is None and y is not None:
+        data_key = array_key(*[np.asarray(v) if isinstance(v, list) else v for v in (x, y, c)])
+    else:
+        return None
+    return '|'.join(['analyze_sweepset', package_version(), data_key, str(sweeplist), canonical_params(param_dict)])
+
+
+@memoize(SWEEP_MEMO, _analyze_sweep_key)
 def analyze_sweep(x=None, y=None, c=None, param_dict=DEFAULT_DICT, bessel_filter=None):
     """ This function will run the ipfx feature extractor on a single sweep. It will return the spike_in_sweep and spike_train dataframes as returned by the ipfx feature extractor.
     takes:
@@ -61,23 +141,191 @@ def analyze_sweep(x=None, y=None, c=None, param_dict=DEFAULT_DICT, bessel_filter
         y (np.array): The voltage array of the sweep (1d array)
         c (np.array): The current array of the sweep (1d array)
         param_dict (dict): The dictionary of parameters that will be passed to the feature extractor. defaults to the default_dict
-        bessel_filter (int): The cutoff frequency of the bessel filter. If -1, no filter will be applied. Defaults to None.
+        bessel_filter (int): The cutoff frequency of the bessel filter, in Hz. If -1, no filter will be applied. Defaults to None.
     returns:
         spike_in_sweep (pd.DataFrame): The dataframe that contains the standard ipfx features for the sweep
         spike_train (pd.DataFrame): The dataframe that contains the standard ipfx features for the consecutive spikes in the sweep
     """ 
-    spikext = feature_extractor.SpikeFeatureExtractor(**param_dict)
+    param_dict = dict(param_dict)
+    backend = param_dict.pop('backend', 'ipfx')
     spiketxt = feature_extractor.SpikeTrainFeatureExtractor(start=param_dict['start'], end=param_dict['end'])  
     #if the user asks for a filter, apply it
-    if bessel_filter is not None:
-        if bessel_filter != -1:
-            y = filter_bessel(y, 1/10000, bessel_filter)
+    y = bessel_prefilter(x, y, bessel_filter)
     if c.shape[0] < y.shape[0]:
                 c = np.hstack((c, np.full(y.shape[0] - c.shape[0], 0)))
-    spike_in_sweep = spikext.process(x, y, c) #returns the default Dataframe Returned by ipfx
-    spike_train = spiketxt.process(x, y, c, spike_in_sweep) #additional dataframe returned by ipfx, contains the features related to consecutive spikes
+    with SIGNAL_CACHE.scope():
+        if backend == 'numpy' and has_fixed_dt(x[None, :]):
+            spike_in_sweep = detect_spikes(x[None, :], y[None, :], c[None, :], **param_dict)[0] #same dataframe as ipfx, see patch_spikes
+        else:
+            spikext = feature_extractor.SpikeFeatureExtractor(**param_dict)
+            spike_in_sweep = spikext.process(x, y, c) #returns the default Dataframe Returned by ipfx
+        spike_train = spiketxt.process(x, y, c, spike_in_sweep) #additional dataframe returned by ipfx, contains the features related to consecutive spikes
     return spike_in_sweep, spike_train
 
+def detect_spike_times(x=None, y=None, c=None, param_dict=DEFAULT_DICT, bessel_filter=None):
+    """ The 'spike_times' stage of analyze_sweep. Runs only the spike detection steps of the ipfx feature extractor (up to check_thresholds_and_peaks),
+    and returns the threshold and peak columns of the spike table, with the same values as analyze_sweep. The troughs, widths and spike train are not computed.
+    takes:
+        x (np.array): The time array of the sweep (1d array)
+        y (np.array): The voltage array of the sweep (1d array)
+        c (np.array): The current array of the sweep (1d array)
+        param_dict (dict): The dictionary of parameters that will be passed to the feature extractor. defaults to the default_dict
+        bessel_filter (int): The cutoff frequency of the bessel filter, in Hz. If -1, no filter will be applied. Defaults to None.
+    returns:
+        spike_in_sweep (pd.DataFrame): threshold_index, threshold_t, threshold_v, threshold_i, peak_index, peak_t, peak_v, peak_i of each spike
+    """
+    param_dict = dict(param_dict)
+    backend = param_dict.pop('backend', 'ipfx')
+    y = bessel_prefilter(x, y, bessel_filter)
+    if c.shape[0] < y.shape[0]:
+        c = np.hstack((c, np.full(y.shape[0] - c.shape[0], 0)))
+    if backend == 'numpy' and has_fixed_dt(x[None, :]):
+        return detect_spikes(x[None, :], y[None, :], c[None, :], times_only=True, **param_dict)[0]
+    #the same steps as SpikeFeatureExtractor.process, with its defaults
+    spikext = feature_extractor.SpikeFeatureExtractor(**param_dict)
+    spkd = ipfx.spike_detector
+    with SIGNAL_CACHE.scope():
+        dvdt = calculate_dvdt(y, x, spikext.filter)
+        putative_spikes = spkd.detect_putative_spikes(y, x, spikext.start, spikext.end, dv_cutoff=spikext.dv_cutoff, dvdt=dvdt)
+        peaks = spkd.find_peak_indexes(y, x, putative_spikes, spikext.end)
+        putative_spikes, peaks = spkd.filter_putative_spikes(y, x, putative_spikes, peaks, spikext.min_height, spikext.min_peak, dvdt=dvdt)
+        if not putative_spikes.size:
+            return pd.DataFrame()
+        upstrokes = spkd.find_upstroke_indexes(y, x, putative_spikes, peaks, dvdt=dvdt)
+        thresholds = spkd.refine_threshold_indexes(y, x, upstrokes, spikext.thresh_frac, dvdt=dvdt)
+        thresholds, peaks, upstrokes, clipped = spkd.check_thresholds_and_peaks(y, x, thresholds, peaks, upstrokes, spikext.start, spikext.end,
+                                                                                spikext.max_interval, dvdt=dvdt,
+                                                                                reject_at_stim_start_interval=spikext.reject_at_stim_start_interval)
+    if not thresholds.size:
+        return pd.DataFrame()
+    return spike_times_table(x, y, c, thresholds, peaks)
+
+def bessel_prefilter(x, y, bessel_filter=None):
+    """ Applies the bessel pre-filter to one sweep (1d) or all the sweeps of a file (2d array, filtered at once), at the sample rate of the data.
+    takes:
+        x (np.array): The time array of the sweep(s)
+        y (np.array): The voltage array of the sweep(s)
+        bessel_filter (float): The cutoff frequency in Hz. If None or -1, no filter will be applied. Raises a ValueError if it is above the nyquist frequency
+    returns:
+        y (np.array): the filtered voltage
+    """
+    if not use_bessel(bessel_filter):
+        return y
+    t = np.asarray(x[0] if np.ndim(y) == 2 else x, dtype=np.float64)
+    #inside a SIGNAL_CACHE scope, the same sweeps are only filtered once per cutoff (e.g. across the param sets of param_grid_extract)
+    return SIGNAL_CACHE.cached('bessel', (x, y), float(bessel_filter), lambda: filter_bessel(y, 1 / (t[1] - t[0]), bessel_filter))
+
+def _analyze_block(x, y, c, sweeps, windows, param_dict, bessel_filter=None, times_only=False):
+    """ Runs the numpy spike detector (patch_spikes.detect_spikes) on all the sweeps at once. Returns the spike dataframe of each sweep in sweeps,
+    or None if the sweeps can not be run as a block (uneven or lazy sweeps, uneven sampling), in which case they should go through analyze_sweep.
+    If times_only, only the threshold and peak columns are computed (as in detect_spike_times)
+    """
+    if not isinstance(x, np.ndarray) or not isinstance(y, np.ndarray) or not isinstance(c, np.ndarray) or y.ndim != 2 or y.dtype == object \
+            or x.shape != y.shape or c.shape != y.shape or not has_fixed_dt(x):
+        logger.debug('Sweeps can not be run as a block, falling back to one sweep at a time')
+        return None
+    y = bessel_prefilter(x, y, bessel_filter)
+    param_dict = {key: value for key, value in param_dict.items() if key not in ('start', 'end', 'backend')}
+    filter = param_dict.pop('filter', 10.)
+    dvdt = _block_dvdt(x, y, filter)
+    if list(sweeps) != list(range(y.shape[0])):
+        x, y, c, dvdt = x[sweeps], y[sweeps], c[sweeps], dvdt[sweeps]
+    return detect_spikes(x, y, c, start=[w[0] for w in windows], end=[w[1] for w in windows], filter=filter, dvdt=dvdt, times_only=times_only, **param_dict)
+
+def _block_dvdt(x, y, filter):
+    #patch_spikes.block_dvdt, computed once per filter setting inside a SIGNAL_CACHE scope
+    return SIGNAL_CACHE.cached('block_dvdt', (x, y), float(filter or 0), lambda: block_dvdt(x, y, filter))
+
+#=== spike pre-screen ===
+#sweeps whose dV/dt never crosses dv_cutoff inside [start, end] cannot have a putative spike, so ipfx would return an empty dataframe.
+#analyze_sweepset checks every sweep of the file at once and skips ipfx for these. Set 'prescreen': False in the param_dict to turn it off
+class prescreenCounts(object):
+    """
+    The number of sweeps analyzed, and skipped by the prescreen, e.g. PRESCREEN_COUNTS['skipped']. Safe to add to from several threads.
+    Inside a collect() block the counts of the thread go to the block instead, so a scheduler task (which may run in another process)
+    hands them back with its result, and the parent adds them up.
+    """
+    def __init__(self):
+        self._counts = {'sweeps': 0, 'skipped': 0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getitem__(self, key):
+        return self._counts[key]
+
+    def __repr__(self):
+        return f"prescreenCounts: {self._counts}"
+
+    def add(self, sweeps=0, skipped=0):
+        collected = getattr(self._local, 'collected', None)
+        if collected is not None:
+            collected['sweeps'] += sweeps
+            collected['skipped'] += skipped
+            return
+        with self._lock:
+            self._counts['sweeps'] += sweeps
+            self._counts['skipped'] += skipped
+
+    def reset(self):
+        with self._lock:
+            self._counts = {'sweeps': 0, 'skipped': 0}
+
+    @contextlib.contextmanager
+    def collect(self):
+        outer = getattr(self._local, 'collected', None)
+        self._local.collected = {'sweeps': 0, 'skipped': 0}
+        try:
+            yield self._local.collected
+        finally:
+            self._local.collected = outer
+
+PRESCREEN_COUNTS = prescreenCounts()
+
+def prescreen_sweeps(x, y, param_dict=DEFAULT_DICT, bessel_filter=None):
+    """ Finds the positive going dV/dt crossings of dv_cutoff for all the sweeps at once, computing dV/dt the same way ipfx does (same bessel filter, same derivative).
+    Pass a row of the output to sweep_may_spike to check a sweep.
+    takes:
+        x (np.array): The time array of the sweeps (2d array)
+        y (np.array): The voltage array of the sweeps (2d array)
+        param_dict (dict): The feature extractor params, filter and dv_cutoff are used
+        bessel_filter (int): The cutoff frequency of the pre-filter applied in analyze_sweep, in Hz. If -1, no filter will be applied. Defaults to None.
+    returns:
+        crossings (np.array): bool array (sweeps, points - 2), True where dV/dt crosses dv_cutoff between points i+1 and i+2. None if the sweeps can not be screened
+            (uneven or lazy sweeps, uneven sampling), in which case every sweep should go through ipfx
+    """
+    if not isinstance(x, np.ndarray) or not isinstance(y, np.ndarray) or y.ndim != 2 or y.dtype == object or x.shape != y.shape or y.shape[1] < 3:
+        return None
+    if not has_fixed_dt(x):
+        return None
+    y = bessel_prefilter(x, y, bessel_filter)
+    try:
+        dvdt = _block_dvdt(x, y, param_dict.get('filter', 10.))
+    except ValueError:
+        return None #ipfx will raise
+    #the rows are exactly what ipfx computes for each sweep, so keep them for the sweeps that go on to ipfx
+    for i in range(y.shape[0]):
+        SIGNAL_CACHE.seed(y[i], x[i], param_dict.get('filter', 10.), dvdt[i])
+    dv_cutoff = param_dict.get('dv_cutoff', 20.)
+    #ipfx looks for a sample >= dv_cutoff following one that is not. Leave a hair of tolerance so rounding differences never skip a real crossing
+    tol = 1e-9 * max(1., abs(dv_cutoff))
+    return ~(dvdt[:, :-1] >= dv_cutoff + tol) & (dvdt[:, 1:] >= dv_cutoff - tol)
+
+def sweep_may_spike(crossings, t, start, end):
+    """ Checks one row of prescreen_sweeps for a crossing in [start, end], using the same window as ipfx.spike_detector.detect_putative_spikes.
+    Returns True if the sweep may have a spike (or can not be screened), False if ipfx would find no spikes
+    """
+    if crossings is None or not (t[0] <= start <= t[-1]) or not (t[0] <= end <= t[-1]):
+        return True
+    start_index = np.argmin(np.abs(t - start))
+    end_index = np.argmin(np.abs(t - end))
+    return bool(np.any(crossings[start_index:end_index - 1]))
+
+def _spike_train(x, y, c, spike_in_sweep, param_dict):
+    #the spike train features of an already detected sweep
+    spiketxt = feature_extractor.SpikeTrainFeatureExtractor(start=param_dict['start'], end=param_dict['end'])
+    return spike_in_sweep, spiketxt.process(x, y, c, spike_in_sweep)
+
+@memoize(SWEEPSET_MEMO, _analyze_sweepset_key)
 def analyze_sweepset(x=None, y=None, c=None, file=None, sweeplist=None, param_dict=DEFAULT_DICT):
     """ Runs the ifpx feature extractor over a set of sweeps. Returns the standard ipfx dataframe, and summary dataframes.
     Args:
@@ -90,7 +338,16 @@ def analyze_sweepset(x=None, y=None, c=None, file=None, sweeplist=None, param_di
         _type_: _description_
     """    
     data = parse_user_input(x, y, c, file)
-
+    #the sweeps are planned, analyzed, then the per file dataframes are built. The scheduler runs the same three steps, with the sweeps split over its workers
+    with SIGNAL_CACHE.scope():
+        plan, y_filt = _plan_sweepset(data, sweeplist, param_dict)
+        results = list(_run_sweeps(_sweep_tasks(data, plan, y_filt), n_jobs=plan['sweep_n_jobs'], pool=plan['sweep_pool']))
+    return _finish_sweepset(data, plan, results)
+
+def _plan_sweepset(data, sweeplist=None, param_dict=DEFAULT_DICT):
+    """ The first step of analyze_sweepset: works out the sweeps, analysis windows and settings, pre-filters the sweeps and picks how each sweep is analyzed
+    (the numpy block detector, skipped by the prescreen, or ipfx). Returns the plan (a dict, small enough to send to a worker) and the pre-filtered voltage
+    """
     #load the data 
     x, y ,c = data.dataX, data.dataY, data.dataC
 
@@ -100,14 +357,8 @@ def analyze_sweepset(x=None, y=None, c=None, file=None, sweeplist=None, param_di
             sweepcount = data.sweepList
         else:
             sweepcount = [0]
-    
-    #Now we walk through the sweeps looking for action potentials
-    df = pd.DataFrame()
-    temp_spike_df = pd.DataFrame()
-    temp_spike_df['filename'] = [data.name]
-    temp_spike_df['foldername'] = [os.path.dirname(data.filePath)]
-    temp_running_bin = pd.DataFrame()
-    
+    else:
+        sweepcount = list(sweeplist)
     
     #memory copy the param_dict, as we will be popping values out of it
     param_dict = copy.deepcopy(param_dict)
@@ -118,48 +369,103 @@ def analyze_sweepset(x=None, y=None, c=None, file=None, sweeplist=None, param_di
         bessel_filter = param_dict.pop('bessel_filter')
     else:
         bessel_filter = None
+    prescreen = param_dict.pop('prescreen', True)
+    backend = param_dict.pop('backend', 'ipfx')
+    #the sweeps can be analyzed in parallel, in a pool of sweep_n_jobs processes ('sweep_pool': 'process') or threads ('thread'), for files with many sweeps
+    sweep_n_jobs = param_dict.pop('sweep_n_jobs', 1)
+    sweep_pool = param_dict.pop('sweep_pool', 'process')
+    #the feature stages to run, see FEATURE_GRAPH
+    stages = feature_stages(param_dict.pop('outputs', None))
 
 
     if stim_find:
         data.setSweep(data.sweepList[-1])
-        start, end = find_non_zero_range(data.sweepX, data.sweepC)
+        start, end = find_non_zero_range(data.sweepX, data.sweepC, epochs=data.epochs, sweep=data.sweepList[-1])
         param_dict['end'] = end
         param_dict['start'] = start
         print('Stimulation time found: ' + str(start) + ' to ' + str(end))
 
 
 
-    #iterate through the sweeps
+    #the analysis window of each sweep, clipped to the sweep length
+    windows = []
     for sweepNumber in sweepcount: 
         real_sweep_length = data.sweepLengthSec - 0.0001
         data.setSweep(sweepNumber)
-        #here we just make sure the sweep number is in the correct format for the dataframe
-        real_sweep_number = sweepNumber_to_real_sweep_number(sweepNumber)
         if param_dict['start'] == 0 and param_dict['end'] == 0: 
             param_dict['end']= real_sweep_length
         elif param_dict['end'] > real_sweep_length:
             param_dict['end'] = real_sweep_length
-        
-        spike_in_sweep, spike_train = analyze_sweep(x[sweepNumber], y[sweepNumber] ,c[sweepNumber], param_dict, bessel_filter=bessel_filter) ### Returns the default Dataframe Returned by ipfx
-        
+        windows.append((param_dict['start'], param_dict['end']))
+
+    #the bessel pre-filter is applied to all the sweeps at once here, uneven or lazy sweeps are filtered one at a time in analyze_sweep
+    y_filt, prefilter = y, None
+    if use_bessel(bessel_filter) and isinstance(y, np.ndarray) and y.dtype != object:
+        y_filt, prefilter, bessel_filter = bessel_prefilter(x, y, bessel_filter), bessel_filter, None
+
+    #with the numpy backend, detect the spikes of all the sweeps at once
+    block = _analyze_block(x, y_filt, c, sweepcount, windows, param_dict, bessel_filter=bessel_filter,
+                           times_only='spike_features' not in stages) if backend == 'numpy' else None
+    #otherwise screen all the sweeps for dV/dt crossings at once, the sweeps without any skip ipfx
+    crossings = prescreen_sweeps(x, y_filt, param_dict, bessel_filter=bessel_filter) if prescreen and block is None else None
+
+    #how each sweep is analyzed, (index, sweep number, window, path, spikes found by the block detector)
+    sweeps = []
+    for i, sweepNumber in enumerate(sweepcount):
+        if block is not None:
+            sweeps.append((i, sweepNumber, windows[i], 'block', block[i]))
+        elif crossings is not None and not sweep_may_spike(crossings[sweepNumber], x[sweepNumber], windows[i][0], windows[i][1]):
+            sweeps.append((i, sweepNumber, windows[i], 'skip', None))
+        else:
+            sweeps.append((i, sweepNumber, windows[i], 'ipfx', None))
+    plan = {'sweepcount': sweepcount, 'param_dict': param_dict, 'bessel_filter': bessel_filter, 'prefilter': prefilter, 'sweeps': sweeps,
+            'prescreened': crossings is not None, 'sweep_n_jobs': sweep_n_jobs, 'sweep_pool': sweep_pool, 'stages': stages}
+    return plan, y_filt
+
+def _sweep_tasks(data, plan, y_filt, sweeps=None):
+    #the _sweep_task of each sweep in the plan (or of the given plan['sweeps'] entries)
+    x, y, c = data.dataX, data.dataY, data.dataC
+    #each sweep gets its own rows of the stimulus epoch table, for the subthreshold features
+    epochs = data.epochs if 'subthreshold' in plan['stages'] else None
+    for i, sweepNumber, (start, end), path, spikes in (plan['sweeps'] if sweeps is None else sweeps):
+        #here we just make sure the sweep number is in the correct format for the dataframe
+        real_sweep_number = sweepNumber_to_real_sweep_number(sweepNumber)
+        yield (i, real_sweep_number, x[sweepNumber], y_filt[sweepNumber], y[sweepNumber], c[sweepNumber], dict(plan['param_dict'], start=start, end=end),
+               plan['bessel_filter'], path, spikes, plan['stages'], epochs.select(sweepNumber) if epochs is not None else None)
+
+def _finish_sweepset(data, plan, results):
+    """ The last step of analyze_sweepset: collects the per sweep results (in sweep order) and builds the per file dataframes """
+    x, y ,c = data.dataX, data.dataY, data.dataC
+    sweepcount, param_dict, stages = plan['sweepcount'], plan['param_dict'], plan['stages']
+    #Now we walk through the sweeps looking for action potentials
+    #the sweepwise features are collected per sweep, and the dataframes built once all the sweeps are done
+    sweepwise = sweepwiseAccumulator(data.name, os.path.dirname(data.filePath), summary='sweepwise' in stages, running_bins='running_bins' in stages)
+    for i, spike_in_sweep, spike_train, custom_features in sorted(results, key=lambda result: result[0]):
+        data.setSweep(sweepcount[i])
+        param_dict['start'], param_dict['end'] = plan['sweeps'][i][2]
         #build the dataframe, this will be the dataframe that is used for the full data, essentially the sweepwise dataframe, each file will have a dataframe like this
-        temp_spike_df, df, temp_running_bin = _build_sweepwise_dataframe(real_sweep_number, spike_in_sweep, spike_train, temp_spike_df, df, temp_running_bin, param_dict) 
-        
+        sweepwise.add_sweep(sweepNumber_to_real_sweep_number(sweepcount[i]), spike_in_sweep, spike_train, param_dict)
         #attach the custom features
-        custom_features = _custom_sweepwise_features(x[sweepNumber], y[sweepNumber] ,c[sweepNumber] , real_sweep_number, param_dict, temp_spike_df, spike_in_sweep)
-        temp_spike_df = temp_spike_df.assign(**custom_features)
+        sweepwise.update(custom_features)
+
+    n_skipped = sum([sweep[3] == 'skip' for sweep in plan['sweeps']])
+    PRESCREEN_COUNTS.add(sweeps=len(sweepcount), skipped=n_skipped)
+    if plan['prescreened']:
+        logger.debug(f'Prescreen skipped ipfx on {n_skipped} of {len(sweepcount)} sweeps')
 
+    temp_spike_df, df, temp_running_bin = sweepwise.frames()
     #add the filename and foldername to the temp_running_bin
     temp_running_bin['filename'] = data.name
     temp_running_bin['foldername'] = os.path.dirname(data.filePath)
     #compute some final features, here we need all the sweeps etc, so these are computed after the sweepwise features
-    temp_spike_df = _custom_full_features(x, y, c, param_dict, temp_spike_df)
-    temp_spike_df, df, temp_running_bin = _build_full_df(data, temp_spike_df, df, temp_running_bin, sweepcount)
+    temp_spike_df = _custom_full_features(x, y, c, param_dict, temp_spike_df, stages, epochs=data.epochs if 'current_injection' in stages else None)
+    temp_spike_df, df, temp_running_bin = _build_full_df(data, temp_spike_df, df, temp_running_bin, sweepcount, rheobase='rheobase' in stages)
     
     return temp_spike_df, df, temp_running_bin
 
 
-def batch_feature_extract(files, param_dict=None, protocol_name='IC1', n_jobs=1):
+def batch_feature_extract(files, param_dict=None, protocol_name='IC1', n_jobs=1, chunksize=8, max_in_flight=None, return_skipped=False, use_index=False,
+                          checkpoint_dir=None):
     """
     Runs the full ipfx feature extraction pipeline over a folder of files, list of files, or a list of cellData objects.
     Returns a dataframe of the full data as returned by the ipfx feature extractor. Consists of all the sweeps in the files stacked on top of each other.
@@ -168,13 +474,30 @@ def batch_feature_extract(files, param_dict=None, protocol_name='IC1', n_jobs=1)
         param_dict (dict): _description_
         plot_sweeps (int, bool, optional): _description_. Defaults to -1.
         protocol_name (str, optional): _description_. Defaults to 'IC1'.
+        n_jobs (int, optional): The number of worker processes to use. Defaults to 1 (no multiprocessing). The files are scheduled at the sweep level,
+            so long files are spread over the workers too (see process_files).
+        chunksize (int, optional): The number of sweeps handed to a worker at once when n_jobs > 1. Files with no more sweeps than this are one task. Defaults to 8.
+        max_in_flight (int, optional): The maximum number of tasks submitted to the pool but not yet collected. Keeps the parent from
+            queueing the whole folder at once. Defaults to 2 * n_jobs.
+        return_skipped (bool, optional): If True, also returns a dataframe of the files skipped by the protocol prefilter, with the reason. Defaults to False.
+        use_index (bool, optional): If True and files is a folder, the file list and protocols are read from the persistent file index of the folder
+            (see database.fileIndex) instead of globbing and opening every header. Defaults to False.
+        checkpoint_dir (str, optional): If given, each file's result frames are saved here as soon as the file finishes, along with a manifest
+            (file list, param_dict hash, version). Re-running with the same files and params resumes, only processing the missing or failed files,
+            then merges everything. Failed files are logged and skipped instead of stopping the batch. Defaults to None (no checkpoint).
     Returns:
         df_raw_out: A dataframe of the full data as returned by the ipfx feature extractor. Consists of all the sweeps in the files stacked on top of each other.
         df_spike_count: The standard dataframe of the spike count data. As designed at the inoue lab. Each cell will have a row in this dataframe. returns not only
             the spike count, but also subthreshold features and suprathreshold features.
         df_running_avg_count: The running average of the spike count data. This is a sweepwise dataframe, where each row is the running average of several features.
+        df_skipped (optional): The files skipped before loading, returned if return_skipped is True.
     """
-    if isinstance(files, str) or not isinstance(files, list):
+    index = None
+    if (isinstance(files, str) or not isinstance(files, list)) and use_index:
+        index = fileIndex(files, extensions=('.abf',))
+        #the files whose header could not be read are kept, so the prefilter reports them as skipped (as for a globbed folder)
+        filelist = index.query(include_errors=True)['path'].to_list()
+    elif isinstance(files, str) or not isinstance(files, list):
         filelist = glob.glob(files + "/**/*.abf", recursive=True)
     elif isinstance(files, list):
         #check if the files are strings or cellData objects
@@ -190,41 +513,308 @@ def batch_feature_extract(files, param_dict=None, protocol_name='IC1', n_jobs=1)
         logger.error('Files must be a list of strings, a string, or a list of cellData objects')
         return None, None, None
     
+    #drop the files with the wrong protocol using the headers only, before any sweep data is loaded
+    filelist, df_skipped = prefilter_files(filelist, protocol_name, index=index)
+    if index is not None:
+        index.close()
+
     #create our output dataframes
     spike_count = []
     df_full = []
     df_running_avg = []
-    #run the feature extractor
-    if n_jobs > 1: #if we are using multiprocessing
-        pool = mp.Pool(processes=n_jobs)
-        results = [pool.apply(process_file, args=(file, param_dict, protocol_name)) for file in filelist]
-        pool.close()
-        ##split out the results
-        for result in results:
-            temp_res = result
-            df_full.append(temp_res[1])
-            df_running_avg.append(temp_res[2])
-            spike_count.append(temp_res[0])
-        pool.join()
-    #if we are not using multiprocessing
+    if checkpoint_dir is not None:
+        #each file's frames are written to the checkpoint as soon as it finishes, a re-run only processes the missing / failed files
+        _open_checkpoint(checkpoint_dir, filelist, param_dict, protocol_name)
+        todo = [i for i in range(len(filelist)) if not os.path.exists(_shard_path(checkpoint_dir, filelist[i]))]
+        logger.info(f'Checkpoint {checkpoint_dir}: {len(filelist) - len(todo)} of {len(filelist)} files already done')
     else:
-        for f in filelist:
-            temp_df_spike_count, temp_full_df, temp_running_bin = process_file(f, copy.deepcopy(param_dict), protocol_name)
-            spike_count.append(temp_df_spike_count)
-            df_full.append(temp_full_df)
-            df_running_avg.append(temp_running_bin)
+        todo = range(len(filelist))
+    #run the feature extractor
+    results = [None] * len(filelist)
+    for k, result, error in process_files([filelist[i] for i in todo], param_dict, protocol_name, n_jobs=n_jobs, chunksize=chunksize,
+                                          max_in_flight=max_in_flight, catch_errors=checkpoint_dir is not None):
+        i = todo[k]
+        if checkpoint_dir is None:
+            results[i] = result
+        elif error is not None:
+            logger.error(f'Error processing {filelist[i]}, it will be retried on the next run: {error}')
+            _write_shard(checkpoint_dir, filelist[i], error=error)
+        else:
+            _write_shard(checkpoint_dir, filelist[i], result=result)
+    if checkpoint_dir is not None:
+        #merge the per file shards, including those from previous runs
+        results, failed = _read_shards(checkpoint_dir, filelist)
+        if len(failed) > 0:
+            logger.warning(f'{len(failed)} files failed and are left out of the output: {failed}')
+    ##split out the results
+    for result in results:
+        if result is None:
+            continue
+        spike_count.append(result[0])
+        df_full.append(result[1])
+        df_running_avg.append(result[2])
 
     #concatenate the dataframes
+    if len(spike_count) == 0 and (len(df_skipped) > 0 or checkpoint_dir is not None):
+        logger.warning('No files left to concatenate')
+        spike_count, df_full, df_running_avg = [pd.DataFrame()], [pd.DataFrame()], [pd.DataFrame()]
     df_spike_count = pd.concat(spike_count, sort=True)
     df_raw_out = pd.concat(df_full, sort=True)
     df_running_avg_count = pd.concat(df_running_avg, sort=False)
+    if return_skipped:
+        return df_raw_out, df_spike_count, df_running_avg_count, df_skipped
     return df_raw_out, df_spike_count, df_running_avg_count
 
 
+def process_files(filelist, param_dict, protocol_name, n_jobs=1, chunksize=8, max_in_flight=None, catch_errors=False, pool='process'):
+    """ Runs process_file over the files, with all the work scheduled on one pool of n_jobs workers (see scheduler.workScheduler).
+    Files with more than chunksize sweeps are split up: the file is planned, its sweeps are analyzed chunksize at a time, wherever a worker is free,
+    then its dataframes are built. So a long file is spread over all the workers instead of holding up the end of the batch.
+    The results match running process_file on each file.
+    Args:
+        filelist (list): the files to analyze
+        param_dict (dict): the feature extractor params
+        protocol_name (str): the protocol to analyze, other files give empty dataframes
+        n_jobs (int, optional): the core budget, the number of worker processes. Defaults to 1 (everything in this process, file by file).
+        chunksize (int, optional): the number of sweeps handed to a worker at once. Defaults to 8.
+        max_in_flight (int, optional): the maximum number of tasks submitted to the pool but not yet collected. Defaults to 2 * n_jobs.
+        catch_errors (bool, optional): if True, a file that raises is yielded with the traceback as the error, instead of stopping the run. Defaults to False.
+        pool (str, optional): 'process' or 'thread' workers. Defaults to 'process'.
+    Yields:
+        (index, result, error): the index of the file in filelist, the process_file result, and the error (None unless catch_errors), in completion order
+    """
+    #without a pool there is nothing to spread the sweeps over, so each file is one task
+    sweep_chunksize = max(int(chunksize), 1) if n_jobs > 1 else None
+    if sweep_chunksize is not None and param_dict is not None:
+        #the scheduler splits the sweeps over its own workers, a sweep pool inside each worker would go past the core budget
+        param_dict = {key: value for key, value in param_dict.items() if key not in ('sweep_n_jobs', 'sweep_pool')}
+    scheduler = workScheduler(n_jobs=n_jobs, pool=pool, max_in_flight=max_in_flight)
+    try:
+        for out in scheduler.run((_file_job(file_path, param_dict, protocol_name, sweep_chunksize) for file_path in filelist), catch_errors=catch_errors):
+            yield out
+    finally:
+        #the loaded files are only shared by the tasks of this run, do not keep them (and their arrays / file handles) alive after it
+        _WORKER_DATA.clear()
+
+def param_grid_extract(files, param_grid, param_dict=None, protocol_name='IC1', outputs=['spike_train'], n_jobs=1, max_in_flight=None):
+    """
+    Runs the feature extractor over a list (or folder) of files once per param set, e.g. for parameter tuning or sensitivity analysis.
+    Each file is loaded once, and all the param sets are run on it in one SIGNAL_CACHE scope. So the bessel filtered sweeps, dV/dt and putative spikes
+    are computed once and shared by the param sets that agree on them. Param sets that only change min_peak, min_height, thresh_frac or max_interval
+    share the putative spikes and their peaks, and only redo the acceptance and the spike features.
+    Args:
+        files (list, str): The list of files, or the folder of files, to be analyzed.
+        param_grid (dict, list): A dict of param: list of values, every combination of which is run. Or a list of dicts, one per param set.
+            Each param set is applied on top of param_dict.
+        param_dict (dict, optional): The params shared by all the param sets. Defaults to DEFAULT_DICT.
+        protocol_name (str, optional): Only the files of this protocol are analyzed. Defaults to 'IC1'.
+        outputs (list, optional): The stages of FEATURE_GRAPH to compute for each param set. Defaults to ['spike_train'], the spike and spike train features,
+            leaving out the subthreshold, QC and summary features, which do not depend on the spike detection params.
+        n_jobs (int, optional): The number of worker processes, the files are spread over them. Defaults to 1 (no multiprocessing).
+        max_in_flight (int, optional): The maximum number of files submitted to the pool but not yet collected. Defaults to 2 * n_jobs.
+    Returns:
+        df_grid (pd.DataFrame): A tidy dataframe with one row per param set, file and sweep, indexed by ('param set', 'filename', 'sweep Number').
+            The columns are the values of the params in param_grid, the foldername, the spike count, and the mean of each spike feature
+            over the spikes of the sweep (NaN for sweeps without spikes). Files that fail are logged and left out.
+    """
+    if isinstance(files, str):
+        files = glob.glob(files + "/**/*.abf", recursive=True)
+    if isinstance(param_grid, dict):
+        grid_keys = list(param_grid.keys())
+        param_sets = [dict(zip(grid_keys, values)) for values in itertools.product(*[param_grid[key] for key in grid_keys])]
+    else:
+        param_sets = [dict(params) for params in param_grid]
+        grid_keys = list(dict.fromkeys([key for params in param_sets for key in params]))
+    base = dict(DEFAULT_DICT if param_dict is None else param_dict)
+    if outputs is not None:
+        base['outputs'] = sorted(feature_stages(outputs))
+    param_sets = [(grid_keys, dict(base, **params)) for params in param_sets]
+
+    frames = []
+    scheduler = workScheduler(n_jobs=n_jobs, max_in_flight=max_in_flight)
+    for i, result, error in scheduler.map(functools.partial(_grid_file_task, param_sets=param_sets, protocol_name=protocol_name), files, catch_errors=True):
+        if error is not None:
+            logger.error(f'Error processing {files[i]}, it is left out of the grid: {error}')
+        elif result is not None:
+            frames.append((i, result))
+    if len(frames) == 0:
+        logger.warning('No files left to concatenate')
+        return pd.DataFrame()
+    #keep the files in the input order
+    return pd.concat([frame for _, frame in sorted(frames, key=lambda x: x[0])], sort=False)
+
+def _grid_file_task(file_path, param_sets, protocol_name):
+    """Scheduler task for param_grid_extract, runs every param set over one file. Returns None for files of another protocol"""
+    if isinstance(file_path, str):
+        protocol = probeFile(file_path)['protocol']
+        if protocol_name not in protocol:
+            print('Not correct protocol: ' + protocol)
+            return None
+    data = cellData(file=file_path)
+    if protocol_name not in (data.protocol or ''):
+        print('Not correct protocol: ' + str(data.protocol))
+        return None
+    print(str(file_path) + ' import')
+    frames = []
+    #room for the signals of every sweep, so the later param sets still find the ones of the first sweeps
+    with SIGNAL_CACHE.scope(maxsize=8 * data.sweepCount + 16):
+        for k, (grid_keys, params) in enumerate(param_sets):
+            spike_count_df, df, _ = analyze_sweepset(file=data, sweeplist=None, param_dict=params)
+            frames.append(_grid_frame(k, spike_count_df, df, {key: params.get(key) for key in grid_keys}))
+    return pd.concat(frames, sort=False)
+
+def _grid_frame(param_set, spike_count_df, df, grid_params):
+    #the per sweep rows of one param set over one file, the spike count and mean spike features of each sweep
+    count_cols = [col for col in spike_count_df.columns if col.startswith('Sweep ') and col.endswith(' spike count')]
+    sweeps = [int(col.split(' ')[1]) for col in count_cols]
+    if 'sweep Number' in df.columns:
+        per_sweep = df.drop(columns=['spike count']).groupby('sweep Number').mean(numeric_only=True)
+    else:
+        per_sweep = pd.DataFrame()
+    per_sweep = per_sweep.reindex(pd.Index(sweeps, name='sweep Number'))
+    per_sweep.insert(0, 'spike count', spike_count_df[count_cols].to_numpy()[0].astype(np.int64))
+    for k, (key, value) in enumerate(grid_params.items()):
+        per_sweep.insert(k, key, [value] * len(sweeps))
+    per_sweep.insert(len(grid_params), 'foldername', spike_count_df['foldername'].to_numpy()[0])
+    per_sweep['param set'] = param_set
+    per_sweep['filename'] = spike_count_df['filename'].to_numpy()[0]
+    return per_sweep.reset_index().set_index(['param set', 'filename', 'sweep Number'])
+
+#=== scheduled file jobs ===
+#a file is run as up to three steps of scheduler tasks: plan (which also runs small files whole), the sweeps in chunks, and the dataframes.
+#The data of the last few files is kept in each worker, so the tasks of a file only load it once per worker. It is cleared once process_files is done
+_WORKER_DATA = memoCache(maxsize=4)
+EMPTY_RESULT = (pd.DataFrame(), pd.DataFrame(), pd.DataFrame())
+
+def _file_job(file_path, param_dict, protocol_name, sweep_chunksize=None):
+    ((status, value), counts), = yield [(_plan_file_task, (file_path, param_dict, protocol_name, sweep_chunksize))]
+    PRESCREEN_COUNTS.add(**counts)
+    if status == 'done':
+        return value
+    plan = value
+    #the sweep tasks only need the settings and their own sweeps
+    header = {key: value for key, value in plan.items() if key != 'sweeps'}
+    chunks = [plan['sweeps'][k:k + sweep_chunksize] for k in range(0, len(plan['sweeps']), sweep_chunksize)]
+    results = yield [(_sweeps_file_task, (file_path, header, chunk)) for chunk in chunks]
+    (result, counts), = yield [(_finish_file_task, (file_path, param_dict, plan, [x for chunk in results for x in chunk]))]
+    PRESCREEN_COUNTS.add(**counts)
+    return result
+
+def _returns_prescreen_counts(func):
+    #the task returns (result, prescreen counts of the sweeps it analyzed), as the counts made in a worker process never reach the parent
+    @functools.wraps(func)
+    def wrapper(*args):
+        with PRESCREEN_COUNTS.collect() as counts:
+            result = func(*args)
+        return result, counts
+    return wrapper
+
+def _load_data(file_path):
+    if not isinstance(file_path, str):
+        return cellData(file=file_path)
+    key = file_key(file_path)
+    hit, data = _WORKER_DATA.get(key)
+    if not hit:
+        data = cellData(file=file_path)
+        _WORKER_DATA.put(key, data)
+    return data
+
+@_returns_prescreen_counts
+def _plan_file_task(file_path, param_dict, protocol_name, sweep_chunksize=None):
+    """Scheduler task, the first step of a file. Returns ('done', result) if the file needs no more tasks (wrong protocol, memoized, or no more than
+    sweep_chunksize sweeps, which are just run here), otherwise ('plan', plan)"""
+    param_dict = copy.deepcopy(param_dict)
+    if isinstance(file_path, str):
+        protocol = probeFile(file_path)['protocol']
+        if protocol_name not in protocol:
+            print('Not correct protocol: ' + protocol)
+            return 'done', EMPTY_RESULT
+    data = _load_data(file_path)
+    if protocol_name not in (data.protocol or ''):
+        print('Not correct protocol: ' + str(data.protocol))
+        return 'done', EMPTY_RESULT
+    print(str(file_path) + ' import')
+    if sweep_chunksize is None or data.sweepCount <= sweep_chunksize:
+        return 'done', analyze_sweepset(file=data, sweeplist=None, param_dict=param_dict)
+    key = _analyze_sweepset_key(file=data, sweeplist=None, param_dict=param_dict)
+    if SWEEPSET_MEMO.enabled and key is not None:
+        hit, value = SWEEPSET_MEMO.get(key)
+        if hit:
+            return 'done', copy.deepcopy(value)
+    plan, _ = _plan_sweepset(data, None, param_dict)
+    return 'plan', plan
+
+def _sweeps_file_task(file_path, plan, sweeps):
+    """Scheduler task, runs _sweep_task over some of the sweeps of a file"""
+    data = _load_data(file_path)
+    y_filt = data.dataY
+    if plan['prefilter'] is not None:
+        #the same as the rows of the block filtered in _plan_sweepset
+        y_filt = {sweepNumber: bessel_prefilter(data.dataX[sweepNumber], data.dataY[sweepNumber], plan['prefilter']) for _, sweepNumber, _, _, _ in sweeps}
+    with SIGNAL_CACHE.scope():
+        return [_sweep_task(task) for task in _sweep_tasks(data, plan, y_filt, sweeps)]
+
+@_returns_prescreen_counts
+def _finish_file_task(file_path, param_dict, plan, results):
+    """Scheduler task, the last step of a file. Builds the dataframes from the sweep results"""
+    data = _load_data(file_path)
+    result = _finish_sweepset(data, plan, results)
+    key = _analyze_sweepset_key(file=data, sweeplist=None, param_dict=param_dict)
+    if SWEEPSET_MEMO.enabled and key is not None:
+        SWEEPSET_MEMO.put(key, copy.deepcopy(result))
+    return result
+
+def _open_checkpoint(checkpoint_dir, filelist, param_dict, protocol_name):
+    """Creates the checkpoint dir and manifest, or checks an existing manifest matches this run"""
+    manifest = {'files': [os.path.abspath(x) if isinstance(x, str) else str(x) for x in filelist], 'protocol_name': protocol_name,
+                'param_hash': hashlib.blake2b(canonical_params(param_dict).encode(), digest_size=16).hexdigest(),
+                'version': package_version()}
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            old_manifest = json.load(f)
+        if old_manifest != manifest:
+            changed = [key for key in manifest if old_manifest.get(key) != manifest[key]]
+            raise ValueError(f'Checkpoint {checkpoint_dir} was made by a different run (changed: {changed}). Use a new checkpoint_dir, or delete it to start over')
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    return manifest
+
+def _shard_path(checkpoint_dir, file, failed=False):
+    #keyed on the path, size and mtime of the file, so a file edited between runs is processed again rather than served its old shard
+    key = hashlib.blake2b((file_key(file) if isinstance(file, str) else str(file)).encode(), digest_size=16).hexdigest()
+    return os.path.join(checkpoint_dir, key + ('.failed' if failed else '.joblib'))
+
+def _write_shard(checkpoint_dir, file, result=None, error=None):
+    if error is not None:
+        with open(_shard_path(checkpoint_dir, file, failed=True), 'w') as f:
+            f.write(error)
+        return
+    #write then rename, so an interrupted write never looks like a finished file
+    path = _shard_path(checkpoint_dir, file)
+    joblib.dump(result, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    if os.path.exists(_shard_path(checkpoint_dir, file, failed=True)):
+        os.remove(_shard_path(checkpoint_dir, file, failed=True))
+
+def _read_shards(checkpoint_dir, filelist):
+    results = []
+    failed = []
+    for file in filelist:
+        path = _shard_path(checkpoint_dir, file)
+        if os.path.exists(path):
+            results.append(joblib.load(path))
+        else:
+            results.append(None)
+            failed.append(file)
+    return results, failed
+
 
 #programmatic functions to retrieve certain dataframes
 #e.g. if we only need the spike_times dataframe
-subset_frames = {'spike_times': ['peak_t'], 'spike_times_isi': ['peak_t', 'isi'], 'spike_times_isi_sweepwise': ['peak_t', 'threshold_t', 'isi']}
+subset_frames = {'spike_times': ['peak_t'], 'spike_times_isi': ['peak_t', 'isi_'], 'spike_times_isi_sweepwise': ['peak_t', 'threshold_t', 'isi_']}
 
 analysis_temp_doc_string = """ This function will run the ipfx feature extractor on a single sweep or set of sweeps. And return /%s/ information.
                             takes:
@@ -235,12 +825,13 @@ analysis_temp_doc_string = """ This function will run the ipfx feature extractor
                                 param_dict (dict): The dictionary of parameters that will be passed to the feature extractor. defaults to the default_dict
                                 feature_keys (list): The list of features that we want to extract. Defaults to ['']
                                 return_array (bool): If True, will return the dataframe as a numpy array. Defaults to True.
+                                outputs (list): The stages of FEATURE_GRAPH to compute. Defaults to ['spike_times'], only the spike detection is run
                             returns:
                                 df_raw (pd.DataFrame): The dataframe that contains the standard ipfx features for the sweep
                             """
 
 
-def analyze_template(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT, feature_keys=[''], return_array=True):
+def analyze_template(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT, feature_keys=[''], return_array=True, outputs=None):
     """ This function will run the ipfx feature extractor on a single sweep or set of sweeps. And return specific dataframes based on the feature_keys.
     useful for when we only need a subset of the features, eg. spike_times, spike_times_isi, spike_times_isi_sweepwise
     takes:
@@ -251,11 +842,12 @@ def analyze_template(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT,
         param_dict (dict): The dictionary of parameters that will be passed to the feature extractor. defaults to the default_dict
         feature_keys (list): The list of features that we want to extract. Defaults to ['']
         return_array (bool): If True, will return the dataframe as a numpy array. Defaults to True.
+        outputs (list): The stages of FEATURE_GRAPH needed for the feature_keys, only these are computed. Defaults to None, every stage
     returns:
         df_raw (pd.DataFrame): The dataframe that contains the standard ipfx features for the sweep
     """
 
-    spike_count_df, df_raw, running_bin = analyze(x, y, c, file=file, param_dict=param_dict, return_summary_frames=True)
+    spike_count_df, df_raw, running_bin = analyze(x, y, c, file=file, param_dict=param_dict, return_summary_frames=True, outputs=outputs)
 
     #index the dataframe by the filename, sweep
     #sometimes there are no spikes, so we need to check if the dataframe has sweep Number
@@ -274,13 +866,13 @@ def analyze_template(x=None, y=None, c=None, file=None, param_dict=DEFAULT_DICT,
     return df_raw
 
 
-analyze_spike_times = functools.partial(analyze_template, feature_keys=subset_frames['spike_times'])
+analyze_spike_times = functools.partial(analyze_template, feature_keys=subset_frames['spike_times'], outputs=['spike_times'])
 analyze_spike_times.__doc__ = analysis_temp_doc_string % 'The spike times'
 analyze_spike_times.__name__ = 'analyze_spike_times'
-analyze_spike_times_isi = functools.partial(analyze_template, feature_keys=subset_frames['spike_times_isi'])
+analyze_spike_times_isi = functools.partial(analyze_template, feature_keys=subset_frames['spike_times_isi'], outputs=['spike_times'])
 analyze_spike_times_isi.__doc__ = analysis_temp_doc_string % 'The spike times and the interspike intervals'
 analyze_spike_times_isi.__name__ = 'analyze_spike_times_isi'
-analyze_spike_times_isi_sweepwise = functools.partial(analyze_template, feature_keys=subset_frames['spike_times_isi_sweepwise'])
+analyze_spike_times_isi_sweepwise = functools.partial(analyze_template, feature_keys=subset_frames['spike_times_isi_sweepwise'], outputs=['spike_times'])
 analyze_spike_times_isi_sweepwise.__doc__ = analysis_temp_doc_string % 'The spike times, interspike intervals, and the sweepwise spike times'
 analyze_spike_times_isi_sweepwise.__name__ = 'analyze_spike_times_isi_sweepwise'
 
@@ -291,6 +883,7 @@ analyze_spike_times_isi_sweepwise.__name__ = 'analyze_spike_times_isi_sweepwise'
 def process_file(file_path, param_dict, protocol_name):
     """Takes an file and runs the feature extractor on it. Filters the protocol etc.
     Essentially a wrapper for the feature extractor. As when there is an error we dont want to stop the whole program, we just want to skip the file.
+    The protocol is checked against the file header before any sweep data is loaded.
     Args:
         file_path (str, os.path): _description_
         param_dict (dict): _description_
@@ -301,17 +894,89 @@ def process_file(file_path, param_dict, protocol_name):
         spike_dataframe, spikewise_dataframe, running_bin_data_frame : _description_
     """
     #try:
+    if isinstance(file_path, str):
+        protocol = probeFile(file_path)['protocol']
+        if protocol_name not in protocol:
+            print('Not correct protocol: ' + protocol)
+            return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
     file = cellData(file=file_path)   
-    if protocol_name in file.protocol: 
+    if protocol_name in (file.protocol or ''): 
         print(file_path + ' import')
         temp_spike_df, df, temp_running_bin = analyze_sweepset(file=file, sweeplist=None, param_dict=param_dict)
         return temp_spike_df, df, temp_running_bin
     else:
-        print('Not correct protocol: ' + file.protocol)
+        print('Not correct protocol: ' + str(file.protocol))
         return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
     #except:
     return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
+def prefilter_files(filelist, protocol_name, index=None):
+    """Reads only the headers of the files and drops those that do not match the protocol, or whose header cannot be read.
+    No sweep data is loaded.
+    Args:
+        filelist (list): The list of file paths.
+        protocol_name (str): The protocol name to match (substring match, same as process_file).
+        index (fileIndex, optional): A file index to read the headers from, instead of opening each file. Defaults to None.
+    Returns:
+        keep (list): The files matching the protocol, in the input order.
+        skipped (pd.DataFrame): One row per skipped file, with the filename, foldername, protocol and reason it was skipped.
+    """
+    keep = []
+    skipped = []
+    for file_path in filelist:
+        if not isinstance(file_path, str):
+            #arrays etc. have no header to check
+            keep.append(file_path)
+            continue
+        try:
+            protocol = probeFile(file_path)['protocol'] if index is None else index.lookup(file_path)['protocol']
+        except Exception as e:
+            skipped.append({'filename': os.path.basename(file_path), 'foldername': os.path.dirname(file_path), 'protocol': '',
+                            'reason': f'could not read header: {e}'})
+            continue
+        if protocol_name in protocol:
+            keep.append(file_path)
+        else:
+            skipped.append({'filename': os.path.basename(file_path), 'foldername': os.path.dirname(file_path), 'protocol': protocol,
+                            'reason': f'protocol does not match {protocol_name}'})
+    logger.info(f'Protocol prefilter kept {len(keep)} of {len(filelist)} files')
+    return keep, pd.DataFrame(skipped, columns=['filename', 'foldername', 'protocol', 'reason'])
+
+def _sweep_task(task):
+    """Analyzes one sweep for analyze_sweepset: the spike features (from the path picked for the sweep) and the custom sweepwise features,
+    for the feature stages in the plan. Module level, so it can run in a process pool"""
+    i, real_sweep_number, sweepX, sweepY, sweepY_raw, sweepC, param_dict, bessel_filter, path, spikes, stages, epochs = task
+    if path == 'ipfx' and 'spike_features' in stages:
+        spike_in_sweep, spike_train = analyze_sweep(sweepX, sweepY, sweepC, param_dict, bessel_filter=bessel_filter) ### Returns the default Dataframe Returned by ipfx
+    else:
+        if path == 'block':
+            spike_in_sweep = spikes
+        elif path == 'skip':
+            spike_in_sweep = pd.DataFrame() #the result ipfx gives for a sweep without spikes
+        else:
+            spike_in_sweep = detect_spike_times(sweepX, sweepY, sweepC, param_dict, bessel_filter=bessel_filter)
+        spike_train = _spike_train(sweepX, sweepY, sweepC, spike_in_sweep, param_dict)[1] if 'spike_train' in stages else {}
+    if 'subthreshold' in stages:
+        custom_features = _custom_sweepwise_features(sweepX, sweepY_raw, sweepC, real_sweep_number, param_dict, None, spike_in_sweep, epochs=epochs)
+    else:
+        custom_features = {}
+    return i, spike_in_sweep, spike_train, custom_features
+
+def _run_sweeps(tasks, n_jobs=1, pool='process'):
+    """Runs _sweep_task over the tasks, in a pool of processes or threads if n_jobs > 1. Yields the results in task order"""
+    if n_jobs > 1:
+        if pool == 'process' and mp.current_process().daemon:
+            #already in a worker of the batch_feature_extract pool, which can not start processes of its own
+            logger.debug('Running the sweeps in threads, as this process is a pool worker')
+            pool = 'thread'
+        pool_class = ThreadPool if pool == 'thread' else mp.Pool
+        with pool_class(processes=n_jobs) as workers:
+            for out in workers.imap(_sweep_task, tasks):
+                yield out
+    else:
+        for task in tasks:
+            yield _sweep_task(task)
+
 def sweepNumber_to_real_sweep_number(sweepNumber):
     if sweepNumber < 9:
             real_sweep_number = '00' + str(sweepNumber + 1)
@@ -320,9 +985,9 @@ def sweepNumber_to_real_sweep_number(sweepNumber):
     return real_sweep_number
 
 #CUSTOM FEATURES
-def _custom_sweepwise_features(sweepX, sweepY, sweepC, real_sweep_number, param_dict, spike_df, rawspike_df):
+def _custom_sweepwise_features(sweepX, sweepY, sweepC, real_sweep_number, param_dict, spike_df, rawspike_df, epochs=None):
     custom_features = {}
-    sag, taum, voltage = subthres_a(sweepX, sweepY, sweepC, param_dict['start'], param_dict['end'])
+    sag, taum, voltage = subthres_a(sweepX, sweepY, sweepC, param_dict['start'], param_dict['end'], epochs=epochs)
     custom_features["Sag Ratio " + real_sweep_number + ""] = sag
     custom_features["Taum " + real_sweep_number + ""] = taum
 
@@ -344,19 +1009,25 @@ def _custom_sweepwise_features(sweepX, sweepY, sweepC, real_sweep_number, param_
     return custom_features
 
 
-def _custom_full_features(x,y,c, param_dict, spike_df):
+def _custom_full_features(x,y,c, param_dict, spike_df, stages=None, epochs=None):
+    #only the current_injection, qc and decay_fit stages asked for are computed (all of them by default)
+    stages = feature_stages() if stages is None else stages
     #gather some protocol information that is requested by patchers
     #some more advanced current injection features
-    spike_df = merge_current_injection_features(x, y, c, spike_df)
+    if 'current_injection' in stages:
+        spike_df = merge_current_injection_features(x, y, c, spike_df, epochs=epochs)
     #try qc or just return the dataframe
-    try:
-        _qc_data = run_qc(y, c)
-        spike_df['QC Mean RMS'] = _qc_data[0]
-        spike_df['QC Mean Sweep Drift'] = _qc_data[2]
-    except:
-        spike_df['QC Mean RMS'] = np.nan
-        spike_df['QC Mean Sweep Drift'] = np.nan
-
+    if 'qc' in stages:
+        try:
+            _qc_data = run_qc(y, c)
+            spike_df['QC Mean RMS'] = _qc_data[0]
+            spike_df['QC Mean Sweep Drift'] = _qc_data[2]
+        except:
+            spike_df['QC Mean RMS'] = np.nan
+            spike_df['QC Mean Sweep Drift'] = np.nan
+
+    if 'decay_fit' not in stages:
+        return spike_df
     #compute (or try to) some subthreshold features
     #calculate the sag
     decay_fast, decay_slow, curve, r_squared_2p, r_squared_1p, _ = exp_decay_factor(x[0], np.nanmean(y, axis=0), np.nanmean(c, axis=0), 3000)
@@ -374,7 +1045,21 @@ def _custom_full_features(x,y,c, param_dict, spike_df):
     return spike_df
 
 
-def _merge_current_injection_features(sweepX, sweepY, sweepC, spike_df):
+def _epoch_step_indices(epochs, sweep):
+    #the index after the first change of each size in the command of the sweep (including a change of 0), read from the epoch table.
+    #The same as np.sort(np.unique(np.diff(sweepC[sweep]), return_index=True)[1]) + 1
+    lo, hi = epochs.rows(sweep)
+    n_diff = epochs.end[hi - 1] - 1 if hi > lo else 0
+    idx, delta = epochs.steps(sweep)
+    #the first sample with no change after it, if any
+    no_change = np.flatnonzero(idx != np.arange(len(idx)))
+    first_flat = no_change[0] if len(no_change) else len(idx)
+    if first_flat < n_diff:
+        idx, delta = np.insert(idx, first_flat, first_flat), np.insert(delta.astype(np.float64), first_flat, 0.)
+    first = np.unique(delta, return_index=True)[1]
+    return np.sort(idx[first]) + 1
+
+def _merge_current_injection_features(sweepX, sweepY, sweepC, spike_df, epochs=None):
     """
     This function will compute the current injection features for a given sweep. It will return a dictionary of the features, which will be appended to the dataframe.
     Tries to capture the current injection features of the sweep, such as the current at each epoch, the delta between epochs, the stimuli length, and the sample rates.
@@ -383,15 +1068,17 @@ def _merge_current_injection_features(sweepX, sweepY, sweepC, spike_df):
         sweepY (np.array): The voltage array of the sweep
         sweepC (np.array): The current array of the sweep
         spike_df (pd.DataFrame): The dataframe that will be appended with the new features
+        epochs (stimEpochs, optional): The stimulus epoch table of the sweeps. Defaults to None, building it from sweepC
     returns:
         spike_df (pd.DataFrame): The dataframe that has been appended with the new features
     """
     new_current_injection_features = {}
-    #first we want to compute the number of epochs, take the diff along the columns and count the number of nonzero rows
-    diffC = np.diff(sweepC, axis=1)
-    #find the row with the most nonzero entries
-    most_nonzero = np.argmax(np.count_nonzero(diffC, axis=1))
-    idx_epochs = np.sort(np.unique(diffC[most_nonzero], return_index=True)[1]) +1
+    if epochs is None:
+        epochs = stimEpochs.from_command(sweepC)
+    #first we want to compute the number of epochs, count the changes of the command in each sweep
+    #find the row with the most changes
+    most_nonzero = np.argmax(epochs.step_counts())
+    idx_epochs = _epoch_step_indices(epochs, most_nonzero)
     #now iter the sweeps and find the current at each epoch
     for j, idx in enumerate(idx_epochs):
         currents = sweepC[:, idx]
@@ -407,7 +1094,7 @@ def _merge_current_injection_features(sweepX, sweepY, sweepC, spike_df):
     dt = np.diff(sweepX[0])[0]
     #first compute the sweepwise variation by taking the diff along the columns
     #compute the length of the nonzero current injections:
-    stimuli_length = [len(np.flatnonzero(row))*dt for row in sweepC if np.any(row)]
+    stimuli_length = [epochs.points(i)*dt for i in range(epochs.sweepCount) if epochs.points(i) > 0]
     #pack it into the dict, if there is only one stimuli length, we will just take that
     if len(np.unique(stimuli_length)) == 1:
         new_current_injection_features['stimuli_length'] = stimuli_length[0]
@@ -425,7 +1112,7 @@ def _merge_current_injection_features(sweepX, sweepY, sweepC, spike_df):
     return spike_df
 
 
-def _merge_current_injection_features_IC1(sweepX, sweepY, sweepC, spike_df):
+def _merge_current_injection_features_IC1(sweepX, sweepY, sweepC, spike_df, epochs=None):
     """
     This function will compute the current injection features for a given sweep. It will return a dictionary of the features, which will be appended to the dataframe.
     THIS FUNCTION IS SPECIFIC TO THE INOUE LAB IC1 PROTOCOL. Which consists of a hyperpolarizing current injection followed by a depolarizing current injection.
@@ -435,16 +1122,18 @@ def _merge_current_injection_features_IC1(sweepX, sweepY, sweepC, spike_df):
         sweepY (np.array): The voltage array of the sweep
         sweepC (np.array): The current array of the sweep
         spike_df (pd.DataFrame): The dataframe that will be appended with the new features
+        epochs (stimEpochs, optional): The stimulus epoch table of the sweeps. Defaults to None, building it from sweepC
     returns:
         spike_df (pd.DataFrame): The dataframe that has been appended with the new features
     """
 
     new_current_injection_features = {}
-    #first we want to compute the number of epochs, take the diff along the columns and count the number of nonzero rows
-    diffC = np.diff(sweepC, axis=1)
-    #find the row with the most nonzero entries
-    most_nonzero = np.argmax(np.count_nonzero(diffC, axis=1))
-    idx_epochs = np.sort(np.unique(diffC[most_nonzero], return_index=True)[1]) +1
+    if epochs is None:
+        epochs = stimEpochs.from_command(sweepC)
+    #first we want to compute the number of epochs, count the changes of the command in each sweep
+    #find the row with the most changes
+    most_nonzero = np.argmax(epochs.step_counts())
+    idx_epochs = _epoch_step_indices(epochs, most_nonzero)
     #now iter the sweeps and find the current at each epoch
     non_zero_epochs = idx_epochs[np.any(sweepC[:,idx_epochs ], axis=0)]
     #should be 2 epochs for IC1
@@ -489,8 +1178,8 @@ def _merge_current_injection_features_IC1(sweepX, sweepY, sweepC, spike_df):
     #compute the dt
     dt = np.diff(sweepX[0])[0]
     #use the last sweep to compute the stimuli length
-    hyperpolarizing_stimuli_length = np.round(len(sweepC[-1, (sweepC[-1]<0.0)])*dt, 4)
-    depolarizing_stimuli_length = np.round(len(sweepC[-1, (sweepC[-1]>0.0)])*dt, 4)
+    hyperpolarizing_stimuli_length = np.round(epochs.points(epochs.sweepCount - 1, -1)*dt, 4)
+    depolarizing_stimuli_length = np.round(epochs.points(epochs.sweepCount - 1, 1)*dt, 4)
 
     new_current_injection_features['hyperpolarizing_stimuli_length'] = hyperpolarizing_stimuli_length
     new_current_injection_features['depolarizing_stimuli_length'] = depolarizing_stimuli_length
@@ -518,18 +1207,81 @@ else:
 #SUBTHRESHOLD FEATURES
 def preprocess_abf_subthreshold(file_path, protocol_name='', param_dict={}):
     #try:
-    abf = pyabf.ABF(file_path, loadData=False)           
-    if protocol_name in abf.protocol:
+    #the header is read once, the sweep data is only loaded for files of the protocol
+    abf = openABF(file_path, protocol_name)
+    if protocol_name in (abf.protocol or ''):
         print(file_path + ' import')
-        abf = pyabf.ABF(file_path)      
         df, avg = analyze_subthres(abf, **param_dict)
         return df, avg
     else:
-        print('Not correct protocol: ' + abf.protocol)
+        print('Not correct protocol: ' + str(abf.protocol))
         return pd.DataFrame(), pd.DataFrame()
     #except:
        #return pd.DataFrame(), pd.DataFrame()
 
+def batch_subthreshold_extract(files, param_dict=None, protocol_name='', n_jobs=1, max_in_flight=None, progress=None, return_errors=False):
+    """
+    Runs the subthreshold analysis (analyze_subthres) over a folder of files or a list of files, one file per task, spread over a pool of n_jobs worker processes.
+    Each file is opened once: the header is read, and the sweep data is only loaded if the protocol matches. A file that fails is logged and left out,
+    the rest of the batch carries on.
+    Args:
+        files (list, str): The list of files, or the folder of files, to be analyzed. A list may also hold already loaded pyabf.ABF like objects.
+        param_dict (dict, optional): The keyword arguments of analyze_subthres (savfilter, start_sear, end_sear, subt_sweeps, time_after, bplot). Defaults to None (the defaults).
+        protocol_name (str, optional): Only the files whose protocol contains this are analyzed. Defaults to '' (all of them).
+        n_jobs (int, optional): The number of worker processes, the files are spread over them. Defaults to 1 (no multiprocessing).
+        max_in_flight (int, optional): The maximum number of files submitted to the pool but not yet collected. Defaults to 2 * n_jobs.
+        progress (callable, optional): Called in this process as each file finishes, as progress(n_done, n_files, file). Defaults to None.
+        return_errors (bool, optional): If True, also returns a dataframe of the files that failed, with the traceback. Defaults to False.
+    Returns:
+        avg_df: The cell averaged subthreshold features, one row per cell, in the order of the files.
+        sweepwise_df: The sweepwise subthreshold features, one row per cell, in the order of the files.
+        df_errors (optional): The files that failed, returned if return_errors is True.
+        The frames are in the order save_subthres_data takes them, e.g. save_subthres_data(*batch_subthreshold_extract(folder), root_fold=folder)
+    """
+    if isinstance(files, str):
+        files = glob.glob(files + "/**/*.abf", recursive=True)
+    param_dict = {} if param_dict is None else copy.deepcopy(param_dict)
+
+    results = [None] * len(files)
+    errors = []
+    scheduler = workScheduler(n_jobs=n_jobs, max_in_flight=max_in_flight)
+    task = functools.partial(_subthres_file_task, param_dict=param_dict, protocol_name=protocol_name)
+    for n_done, (i, result, error) in enumerate(scheduler.map(task, files, catch_errors=True)):
+        if error is not None:
+            logger.error(f'Error processing {_file_name(files[i])}, it is left out: {error}')
+            errors.append({'filename': os.path.basename(_file_name(files[i])), 'foldername': os.path.dirname(_file_name(files[i])), 'error': error})
+        else:
+            results[i] = result
+        if progress is not None:
+            progress(n_done + 1, len(files), files[i])
+
+    sweepwise, averages = [], []
+    for result in results:
+        if result is None:
+            continue
+        sweepwise.append(result[0])
+        averages.append(result[1])
+    if len(averages) == 0:
+        logger.warning('No files left to concatenate')
+        avg_df, sweepwise_df = pd.DataFrame(), pd.DataFrame()
+    else:
+        avg_df, sweepwise_df = pd.concat(averages, axis=0), pd.concat(sweepwise, axis=0)
+    if return_errors:
+        return avg_df, sweepwise_df, pd.DataFrame(errors, columns=['filename', 'foldername', 'error'])
+    return avg_df, sweepwise_df
+
+def _file_name(file):
+    #the path of a file, or the name of a loaded file object
+    return file if isinstance(file, str) else str(getattr(file, 'abfFilePath', getattr(file, 'name', file)))
+
+def _subthres_file_task(file, param_dict, protocol_name):
+    """Scheduler task for batch_subthreshold_extract, runs analyze_subthres over one file. Returns None for files of another protocol"""
+    abf = openABF(file, protocol_name) if isinstance(file, str) else file
+    if protocol_name not in (abf.protocol or ''):
+        print('Not correct protocol: ' + str(abf.protocol))
+        return None
+    return analyze_subthres(abf, **copy.deepcopy(param_dict))
+
 def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_sear=None, subt_sweeps=None, time_after=50, bplot=False):
     filename = abf.name
     
@@ -579,6 +1331,7 @@ def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_se
     
     full_dataI = []
     full_dataV = []
+    sweeps = []
     for sweepNumber in sweepList: 
         real_sweep_length = abf.sweepLengthSec - 0.0001
         if sweepNumber < 9:
@@ -593,11 +1346,22 @@ def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_se
         dataT, dataV, dataI = abf.sweepX, abf.sweepY, abf.sweepC
         dataT, dataV, dataI = dataT[idx_start:idx_end], dataV[idx_start:idx_end], dataI[idx_start:idx_end]
         dataT = dataT - dataT[0]
+        sweeps.append((real_sweep_number, dataT, dataV, dataI))
+
+    #fit the decays of all the sweeps together, each starting from the fit of the one before (see exp_decay_factor_batch),
+    #and measure the per sweep metrics over the whole sweep block at once
+    decay_fits = []
+    if len(sweeps) > 0:
+        block_T, block_V, block_I = sweeps[0][1], np.vstack([sweep[2] for sweep in sweeps]), np.vstack([sweep[3] for sweep in sweeps])
+        downward, upward, rise = step_indices(block_I)
+        decay_fits = exp_decay_factor_batch(block_T, block_V, block_I, time_after)
+        resists = membrane_resistance_block(block_T, block_V, block_I, downward=downward, rise=rise)
+        rmps = rmp_mode_block(block_V, block_I, downward=downward)
+        sags, sag_mins = compute_sag_block(block_T, block_V, block_I, time_after, downward=downward, upward=upward)
+    for k, ((real_sweep_number, dataT, dataV, dataI), decay_fit) in enumerate(zip(sweeps, decay_fits)):
+        decay_fast, decay_slow, curve, r_squared_2p, r_squared_1p, p_decay = decay_fit
         
-
-        decay_fast, decay_slow, curve, r_squared_2p, r_squared_1p, p_decay = exp_decay_factor(dataT, dataV, dataI, time_after, abf_id=abf.name)
-        
-        resist = membrane_resistance(dataT, dataV, dataI)
+        resist = resists[k]
         Cm2, Cm1 = mem_cap(resist, decay_slow)
         Cm3 = mem_cap_alt(resist, decay_slow, curve[3], np.amin(dataI))
         temp_df[f"_1 phase decay {real_sweep_number}"] = [p_decay]           
@@ -608,12 +1372,14 @@ def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_se
         temp_df[f"Curve fit b2 {real_sweep_number}"] = [curve[3]]
         temp_df[f"R squared 2 phase {real_sweep_number}"] = [r_squared_2p]
         temp_df[f"R squared 1 phase {real_sweep_number}"] = [r_squared_1p]
-        temp_df[f"RMP {real_sweep_number}"] = [rmp_mode(dataV, dataI)]
+        temp_df[f"RMP {real_sweep_number}"] = [rmps[k]]
         temp_df[f"Membrane Resist {real_sweep_number}"] =  resist / 1000000000 #to gigaohms
         temp_df[f"_2 phase Cm {real_sweep_number}"] =  Cm2 * 1000000000000#to pf farad
         temp_df[f"_ALT_2 phase Cm {real_sweep_number}"] =  Cm3 * 1000000000000
         temp_df[f"_1 phase Cm {real_sweep_number}"] =  Cm1 * 1000000000000
-        temp_df[f"Voltage sag {real_sweep_number}"],temp_df[f"Voltage min {real_sweep_number}"] = compute_sag(dataT,dataV,dataI, time_after, plot=bplot, clear=False)
+        temp_df[f"Voltage sag {real_sweep_number}"],temp_df[f"Voltage min {real_sweep_number}"] = sags[k], sag_mins[k]
+        if bplot == True:
+            compute_sag(dataT,dataV,dataI, time_after, plot=bplot, clear=False)
          
         #temp_spike_df['baseline voltage' + real_sweep_number] = subt.baseline_voltage(dataT, dataV, start=b_lowerlim)
         #
@@ -637,14 +1403,16 @@ def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_se
     full_dataI = np.vstack(full_dataI) 
     indices_of_same = np.arange(full_dataI.shape[0])
     full_dataV = np.vstack(full_dataV)
+    #the cell average traces (and their stimulus epochs) are computed once and shared by the fits below
+    cell_avg = subthresContext(dataT, full_dataV, full_dataI, indices=indices_of_same)
     if bplot == True:
         if not os.path.exists(root_fold+'//cm_plots//'):
                 os.mkdir(root_fold+'//cm_plots//')   
     print("Fitting Decay")
-    decay_fast, decay_slow, curve, r_squared_2p, r_squared_1p, p_decay = exp_decay_factor_alt(dataT, np.nanmean(full_dataV[indices_of_same,:],axis=0), np.nanmean(full_dataI[indices_of_same,:],axis=0), time_after, abf_id=abf.name, plot=bplot, root_fold=root_fold)
+    decay_fast, decay_slow, curve, r_squared_2p, r_squared_1p, p_decay = exp_decay_factor_alt(cell_avg, time_after, abf_id=abf.name, plot=bplot, root_fold=root_fold)
     print("Computing Sag")
-    grow = exp_growth_factor(dataT, np.nanmean(full_dataV[indices_of_same,:],axis=0), np.nanmean(full_dataI[indices_of_same,:],axis=0), 1/decay_slow)
-    temp_avg[f"Voltage sag mean"], temp_avg["Voltage Min point"] = compute_sag(dataT, np.nanmean(full_dataV[indices_of_same,:],axis=0), np.nanmean(full_dataI[indices_of_same,:],axis=0), time_after, plot=bplot)
+    grow = exp_growth_factor(cell_avg, 1/decay_slow)
+    temp_avg[f"Voltage sag mean"], temp_avg["Voltage Min point"] = compute_sag(cell_avg, time_after, plot=bplot)
     temp_avg[f"Sweepwise Voltage sag mean"], temp_avg["Sweepwise Voltage Min point"] = np.nanmean(df_select_by_col(temp_df, ['Voltage sag'])), np.nanmean(df_select_by_col(temp_df, ['Voltage min']))
     
     temp_avg["Averaged 1 phase decay "] = [p_decay]           
@@ -655,7 +1423,7 @@ def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_se
     temp_avg["Averaged Curve fit b2"] = [curve[3]]
     temp_avg["Averaged R squared 2 phase"] = [r_squared_2p]
     temp_avg["Averaged R squared 1 phase"] = [r_squared_1p]
-    temp_avg[f"Averaged RMP"] = [rmp_mode(np.nanmean(full_dataV[indices_of_same,:],axis=0), np.nanmean(full_dataI[indices_of_same,:],axis=0))]
+    temp_avg[f"Averaged RMP"] = [rmp_mode(cell_avg)]
     temp_avg["SweepCount Measured"] = [sweepcount]
     temp_avg["Averaged alpha tau"] = [grow[1]]
     temp_avg["Averaged b tau"] = [grow[3]]
@@ -664,10 +1432,10 @@ def analyze_subthres(abf, protocol_name='', savfilter=0, start_sear=None, end_se
     else:
         temp_avg["AverageD Best Fit"] = [1]
     print(f"fitting Membrane resist")
-    resist = membrane_resistance(dataT, np.nanmean(full_dataV[indices_of_same,:],axis=0), np.nanmean(full_dataI[indices_of_same,:],axis=0))
-    resist_alt = exp_rm_factor(dataT, np.nanmean(full_dataV[indices_of_same,:],axis=0), np.nanmean(full_dataI[indices_of_same,:],axis=0), time_after, decay_slow, abf_id=abf.name,  root_fold=root_fold)
+    resist = membrane_resistance(cell_avg)
+    resist_alt = exp_rm_factor(cell_avg, time_after, decay_slow, abf_id=abf.name,  root_fold=root_fold)
     Cm2, Cm1 = mem_cap(resist, decay_slow, p_decay)
-    Cm3 = mem_cap_alt(resist, decay_slow, curve[3], np.amin(np.nanmean(full_dataI[indices_of_same,:],axis=0)))
+    Cm3 = mem_cap_alt(resist, decay_slow, curve[3], np.amin(cell_avg.meanI))
     rm_alt = mem_resist_alt(Cm3, decay_slow)
     temp_avg["Averaged Membrane Resist"] =  resist  / 1000000000 #to gigaohms
     temp_avg["Averaged Membrane Resist _ ALT"] =  resist_alt[0]  / 1000000000
@@ -707,7 +1475,7 @@ def find_downstroke_indexes(v, t, peak_indexes, trough_indexes, clipped=None, fi
         return np.array([])
 
     if dvdt is None:
-        dvdt = tsu.calculate_dvdt(v, t, filter)
+        dvdt = SIGNAL_CACHE.dvdt(v, t, filter)
 
     if clipped is None:
         clipped = np.zeros_like(peak_indexes, dtype=bool)
@@ -739,6 +1507,32 @@ def find_downstroke_indexes(v, t, peak_indexes, trough_indexes, clipped=None, fi
 #override
 ipfx.spike_detector.find_downstroke_indexes = find_downstroke_indexes
 
+def calculate_dvdt(v, t, filter=None):
+    """ipfx.time_series_utils.calculate_dvdt, served from SIGNAL_CACHE so each sweep is only filtered and differentiated once per filter setting"""
+    return SIGNAL_CACHE.dvdt(v, t, filter)
+
+#override, the ipfx modules all call it through the time_series_utils module
+ipfx.time_series_utils.calculate_dvdt = calculate_dvdt
+
+_ipfx_detect_putative_spikes = ipfx.spike_detector.detect_putative_spikes
+_ipfx_find_peak_indexes = ipfx.spike_detector.find_peak_indexes
+
+def detect_putative_spikes(v, t, start=None, end=None, filter=10., dv_cutoff=20., dvdt=None):
+    """ipfx.spike_detector.detect_putative_spikes, served from SIGNAL_CACHE. The putative spikes only depend on dV/dt, the window and dv_cutoff,
+    so runs that only change how they are accepted (min_peak, min_height, thresh_frac, max_interval) share them"""
+    if dvdt is None:
+        return _ipfx_detect_putative_spikes(v, t, start, end, filter=filter, dv_cutoff=dv_cutoff)
+    return SIGNAL_CACHE.cached('putative_spikes', (v, t, dvdt), (start, end, float(dv_cutoff)),
+                               lambda: _ipfx_detect_putative_spikes(v, t, start, end, filter=filter, dv_cutoff=dv_cutoff, dvdt=dvdt))
+
+def find_peak_indexes(v, t, spike_indexes, end=None):
+    """ipfx.spike_detector.find_peak_indexes, served from SIGNAL_CACHE (for the putative spikes cached above)"""
+    return SIGNAL_CACHE.cached('peak_indexes', (v, t, spike_indexes), end, lambda: _ipfx_find_peak_indexes(v, t, spike_indexes, end))
+
+#override
+ipfx.spike_detector.detect_putative_spikes = detect_putative_spikes
+ipfx.spike_detector.find_peak_indexes = find_peak_indexes
+
 
 from ipfx import spike_detector,time_series_utils
 def determine_rejected_spikes(spfx, spike_df, v, t, param_dict):
@@ -753,7 +1547,7 @@ def determine_rejected_spikes(spfx, spike_df, v, t, param_dict):
     rejected_spikes : list of bool
         True if spike was rejected, False if spike was accepted
     """
-    dvdt = time_series_utils.calculate_dvdt(v, t, 0)
+    dvdt = SIGNAL_CACHE.dvdt(v, t, 0)
 
     rejected_spikes = {}
     intial_spikes = spike_detector.detect_putative_spikes(v, t, param_dict['start'], param_dict['end'],
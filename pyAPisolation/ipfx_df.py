@@ -8,13 +8,15 @@ import numpy as np
 import os
 import pandas as pd
 
-from .patch_utils import df_select_by_col, build_running_bin
+from .patch_utils import df_select_by_col, build_running_bins
 from .patch_subthres import exp_decay_factor
 
 ipfx_train_feature_labels =['adapt',  'isi_cv', 'mean_isi', 'median_isi', 
        'avg_rate']
 #'first_isi', 'latency',
 running_lab = ['Trough', 'Peak', 'Max Rise (upstroke)', 'Max decline (downstroke)', 'Width', 'isi']
+#the spike columns binned for each running_lab (bar isi, which is binned from the peak times)
+running_cols = ['fast_trough_v', 'peak_v', 'upstroke', 'downstroke', 'width']
 
 subsheets_spike = {'full sheet': ['']}
 #old subsheets 'spike count':['spike count'], 'rheobase features':['rheobase'], 
@@ -48,7 +50,10 @@ def save_data_frames(dfs, df_spike_count, df_running_avg_count, root_fold='', ta
     print("data frames saved to excel")
 
 def save_subthres_data(avg_df, sweepwise_df, root_fold='', tag='', saveRaw=False):
-    
+    #takes the frames of analyze_subthres, or of batch_subthreshold_extract (which returns them in this order)
+    if avg_df.empty:
+        print("no subthreshold data to save")
+        return
     #create a dict df
     subsheets_subthres = {'averages': avg_df, 'sweepwise': sweepwise_df}
     with pd.ExcelWriter(root_fold + '/subthres_' + tag + '.xlsx') as runf:
@@ -103,135 +108,198 @@ def organize_data_frames(dfs, df_spike_count, df_running_avg_count):
 # Ensure functions do no require the abf object
 # functions should not depend on further analysis, only concat of dataframes
 # functions should not depend on the order of the sweeps
-def _build_sweepwise_dataframe(real_sweep_number, spike_in_sweep, spike_train, temp_spike_df, df, temp_running_bin, param_dict):
-    """Build a "sweepwise" dataframe for a single sweep. Essentialy compacts the features of a single sweep into several singluar columns
-    Args:
-        abf (_type_): _description_
-        real_sweep_number (_type_): _description_
-        spike_in_sweep (_type_): ipfx output spike dataframe for a single sweep
-        spike_train (_type_): ipfx output spike train dataframe for a single sweep
-        temp_spike_df (_type_): 
-        df (_type_): _description_
-        temp_running_bin (_type_): _description_
-        param_dict (_type_): _description_
-
-    Returns:
-        _type_: _description_
+class sweepwiseAccumulator(object):
+    """Collects the sweepwise features of a single file. Each sweep's features are kept in plain dicts / lists,
+    and the output dataframes are built once, in frames(), rather than concatenated (and copied) once per sweep.
+    The columns and values are the same as building the dataframes sweep by sweep.
+    Takes:
+        filename: str, the name of the file, the first column of the spike count dataframe
+        foldername: str, the folder of the file
+        summary: bool, if False only the spike count of each sweep is added to the spike count dataframe, and the spike dataframes get just the
+            sweep number, spike count and isi columns (and the spike train features, if given). Defaults to True
+        running_bins: bool, if False the running bin averages are not computed, and frames() returns an empty dataframe for them. Defaults to True
     """
-    #first declare some dicts to hold the data, they will be converted to dataframes later
-    dict_spike_df = {}
+    def __init__(self, filename, foldername, summary=True, running_bins=True):
+        #the columns of the (single row) spike count dataframe, in insertion order. Re-adding a key replaces the value in place, same as df.assign
+        self.columns = {'filename': filename, 'foldername': foldername}
+        self.summary = summary
+        self.running_bins = running_bins and summary
+        self._spike_dfs = []
+        self._running_bins = []
+        self._binned_spikes = {}
 
+    def update(self, features):
+        """Adds a dict of features as columns of the spike count dataframe"""
+        self.columns.update(features)
 
-    spike_count = spike_in_sweep.shape[0]
-    dict_spike_df["Sweep " + real_sweep_number + " spike count"] = [spike_count]
-    
-    #pregenerate the running bin labels
-    time_bins = np.arange(param_dict['start']*1000, param_dict['end']*1000+20, 20)
-    _run_labels = []
-    for p in running_lab:
-            temp_lab = []
-            for x in time_bins :
-                temp_lab = np.hstack((temp_lab, f'{p} {x} bin AVG'))
-            _run_labels.append(temp_lab)
-    _run_labels = np.hstack(_run_labels).tolist()
-    nan_row_run = np.ravel(np.full((len(running_lab), time_bins.shape[0]), np.nan)).reshape(1,-1)
+    def add_sweep(self, real_sweep_number, spike_in_sweep, spike_train, param_dict):
+        """Adds the features of a single sweep. Essentialy compacts the features of a single sweep into several singluar columns
+        Args:
+            real_sweep_number (str): the sweep number as it appears in the column names
+            spike_in_sweep (pd.DataFrame): ipfx output spike dataframe for a single sweep
+            spike_train (dict): ipfx output spike train features for a single sweep
+            param_dict (dict): the feature extractor params, start and end are used for the running bins
+        """
+        if not self.summary:
+            self._add_spikes(real_sweep_number, spike_in_sweep, spike_train)
+            return
+        #first declare some dicts to hold the data, they will be converted to dataframes later
+        dict_spike_df = {}
 
 
-    if spike_count > 0:
-        # Calculate running averages
-        trough_average = build_running_bin(spike_in_sweep['fast_trough_v'], spike_in_sweep['peak_t'], start=param_dict['start'], end=param_dict['end'])[0]
-        peak_average = build_running_bin(spike_in_sweep['peak_v'], spike_in_sweep['peak_t'], start=param_dict['start'], end=param_dict['end'])[0]
-        peak_max_rise = build_running_bin(spike_in_sweep['upstroke'], spike_in_sweep['peak_t'], start=param_dict['start'], end=param_dict['end'])[0]
-        peak_max_down = build_running_bin(spike_in_sweep['downstroke'], spike_in_sweep['peak_t'], start=param_dict['start'], end=param_dict['end'])[0]
-        peak_width = build_running_bin(spike_in_sweep['width'], spike_in_sweep['peak_t'], start=param_dict['start'], end=param_dict['end'])[0]
-        isi_bin = build_running_bin(np.diff(spike_in_sweep['peak_t']), spike_in_sweep['peak_t'][:-1], start=param_dict['start'], end=param_dict['end'])[0]
+        spike_count = spike_in_sweep.shape[0]
+        dict_spike_df["Sweep " + real_sweep_number + " spike count"] = [spike_count]
+    
+        #pregenerate the running bin labels
+        time_bins = np.arange(param_dict['start']*1000, param_dict['end']*1000+20, 20)
+        _run_labels = [f'{p} {x} bin AVG' for p in running_lab for x in time_bins]
+        nan_row_run = np.ravel(np.full((len(running_lab), time_bins.shape[0]), np.nan)).reshape(1,-1)
 
-        # Create dataframes of the running averages
-        sweep_running_bin = pd.DataFrame(data=np.hstack((trough_average, peak_average, peak_max_rise, peak_max_down, peak_width, isi_bin)).reshape(1,-1), columns=_run_labels, index=[real_sweep_number])
-        spike_train_df = pd.DataFrame(spike_train, index=[0])
+
+        if spike_count > 0:
+            # The running averages are binned for all the sweeps at once, in frames()
+            running_row = None
+            if self.running_bins:
+                self._binned_spikes[len(self._running_bins)] = (spike_in_sweep['peak_t'].to_numpy(dtype=np.float64), spike_in_sweep[running_cols].to_numpy(dtype=np.float64))
+            spike_train_df = pd.DataFrame(spike_train, index=[0])
         
-        spike_in_sweep['spike count'] = np.hstack((spike_count, np.full(abs(spike_count-1), np.nan)))
-        spike_in_sweep['sweep Number'] = np.full(abs(spike_count), int(real_sweep_number))
-        #pack in the spike features
-        dict_spike_df["first_isi_all_spikes" + real_sweep_number + " isi"] = [spike_train['first_isi']]
-        dict_spike_df["spike_amp" + real_sweep_number + " 1"] = np.abs(spike_in_sweep['peak_v'].to_numpy()[0] - spike_in_sweep['threshold_v'].to_numpy()[0])
-        dict_spike_df["spike_thres" + real_sweep_number + " 1"] = spike_in_sweep['threshold_v'].to_numpy()[0]
-        dict_spike_df["spike_peak" + real_sweep_number + " 1"] = spike_in_sweep['peak_v'].to_numpy()[0]
-        dict_spike_df["spike_rise" + real_sweep_number + " 1"] = spike_in_sweep['upstroke'].to_numpy()[0]
-        dict_spike_df["spike_decay" + real_sweep_number + " 1"] = spike_in_sweep['downstroke'].to_numpy()[0]
-        dict_spike_df["spike_AHP 1" + real_sweep_number + " "] = spike_in_sweep['fast_trough_v'].to_numpy()[0]
-        dict_spike_df["spike_AHP slow 1" + real_sweep_number + " "] = spike_in_sweep['slow_trough_v'].to_numpy()[0] if 'slow_trough_v' in spike_in_sweep.columns else np.nan
-        dict_spike_df["spike_AHP height 1" + real_sweep_number + " "] = abs(spike_in_sweep['peak_v'].to_numpy()[0] - spike_in_sweep['fast_trough_v'].to_numpy()[0])
-        dict_spike_df["latency_all_spikes" + real_sweep_number + ""] = spike_train['latency']
-        dict_spike_df["spike_width" + real_sweep_number + "1"] = spike_in_sweep['width'].to_numpy()[0]
+            spike_in_sweep['spike count'] = np.hstack((spike_count, np.full(abs(spike_count-1), np.nan)))
+            spike_in_sweep['sweep Number'] = np.full(abs(spike_count), int(real_sweep_number))
+            #pack in the spike features
+            dict_spike_df["first_isi_all_spikes" + real_sweep_number + " isi"] = [spike_train['first_isi']]
+            dict_spike_df["spike_amp" + real_sweep_number + " 1"] = np.abs(spike_in_sweep['peak_v'].to_numpy()[0] - spike_in_sweep['threshold_v'].to_numpy()[0])
+            dict_spike_df["spike_thres" + real_sweep_number + " 1"] = spike_in_sweep['threshold_v'].to_numpy()[0]
+            dict_spike_df["spike_peak" + real_sweep_number + " 1"] = spike_in_sweep['peak_v'].to_numpy()[0]
+            dict_spike_df["spike_rise" + real_sweep_number + " 1"] = spike_in_sweep['upstroke'].to_numpy()[0]
+            dict_spike_df["spike_decay" + real_sweep_number + " 1"] = spike_in_sweep['downstroke'].to_numpy()[0]
+            dict_spike_df["spike_AHP 1" + real_sweep_number + " "] = spike_in_sweep['fast_trough_v'].to_numpy()[0]
+            dict_spike_df["spike_AHP slow 1" + real_sweep_number + " "] = spike_in_sweep['slow_trough_v'].to_numpy()[0] if 'slow_trough_v' in spike_in_sweep.columns else np.nan
+            dict_spike_df["spike_AHP height 1" + real_sweep_number + " "] = abs(spike_in_sweep['peak_v'].to_numpy()[0] - spike_in_sweep['fast_trough_v'].to_numpy()[0])
+            dict_spike_df["latency_all_spikes" + real_sweep_number + ""] = spike_train['latency']
+            dict_spike_df["spike_width" + real_sweep_number + "1"] = spike_in_sweep['width'].to_numpy()[0]
         
-        #add        
-        if spike_count >= 2: #if there are more than 2 spikes in the sweep
-            f_isi = spike_in_sweep['peak_t'].to_numpy()[-1] #first spike time
-            l_isi = spike_in_sweep['peak_t'].to_numpy()[-2] #second spike time
-            dict_spike_df["last_isi" + real_sweep_number + " isi"] = [abs( f_isi- l_isi )]
-            dict_spike_df["min_isi" + real_sweep_number + " isi"] = np.nanmin(np.hstack((np.diff(spike_in_sweep['peak_t'].to_numpy()), np.nan)))
-            #add the isi stuff to the spike_in_sweep dataframe
-            spike_in_sweep['isi_'] = np.hstack((np.diff(spike_in_sweep['peak_t'].to_numpy()), np.nan))
-            for label in ipfx_train_feature_labels: #for the ipfx features
-                try:
-                    dict_spike_df[label + real_sweep_number] = spike_train[label]
-                except:
-                    dict_spike_df[label + real_sweep_number] = np.nan
-            
-            if spike_count >= 3: #if there are more than 3 spikes in the sweep
-                for label in ['first_isi', 'latency']: #add the ipfx train features but for the 3 spikes.
+            #add        
+            if spike_count >= 2: #if there are more than 2 spikes in the sweep
+                f_isi = spike_in_sweep['peak_t'].to_numpy()[-1] #first spike time
+                l_isi = spike_in_sweep['peak_t'].to_numpy()[-2] #second spike time
+                dict_spike_df["last_isi" + real_sweep_number + " isi"] = [abs( f_isi- l_isi )]
+                dict_spike_df["min_isi" + real_sweep_number + " isi"] = np.nanmin(np.hstack((np.diff(spike_in_sweep['peak_t'].to_numpy()), np.nan)))
+                #add the isi stuff to the spike_in_sweep dataframe
+                spike_in_sweep['isi_'] = np.hstack((np.diff(spike_in_sweep['peak_t'].to_numpy()), np.nan))
+                for label in ipfx_train_feature_labels: #for the ipfx features
                     try:
-                        dict_spike_df[label + "_3_spikes" + real_sweep_number] = spike_train[label]
+                        dict_spike_df[label + real_sweep_number] = spike_train[label]
                     except:
+                        dict_spike_df[label + real_sweep_number] = np.nan
+            
+                if spike_count >= 3: #if there are more than 3 spikes in the sweep
+                    for label in ['first_isi', 'latency']: #add the ipfx train features but for the 3 spikes.
+                        try:
+                            dict_spike_df[label + "_3_spikes" + real_sweep_number] = spike_train[label]
+                        except:
+                            dict_spike_df[label + "_3_spikes" + real_sweep_number] = np.nan
+                else: #if there are less than 3 spikes in the sweep
+                    for label in ['first_isi', 'latency']: #add blanks
                         dict_spike_df[label + "_3_spikes" + real_sweep_number] = np.nan
-            else: #if there are less than 3 spikes in the sweep
-                for label in ['first_isi', 'latency']: #add blanks
-                    dict_spike_df[label + "_3_spikes" + real_sweep_number] = np.nan
 
-        else: #else add blanks to the dataframe
+            else: #else add blanks to the dataframe
+                dict_spike_df["last_isi" + real_sweep_number + " isi"] = [np.nan]
+                dict_spike_df["min_isi" + real_sweep_number + " isi"] = [spike_train['first_isi']]
+                spike_in_sweep['isi_'] = np.hstack((np.full(abs(spike_count), np.nan)))
+                for label in ipfx_train_feature_labels:
+                    dict_spike_df[label + real_sweep_number] = [np.nan]
+
+            spike_in_sweep = spike_in_sweep.join(spike_train_df)
+            print("Processed Sweep " + str(real_sweep_number) + " with " + str(spike_count) + " aps")
+            self._spike_dfs.append(spike_in_sweep)
+        else:
+            running_row = nan_row_run.ravel()
+            print("Processed Sweep " + str(real_sweep_number) + " with " + str(spike_count) + " aps")
+            #fill in np nans for the features that cant be calculated when there are no spikes
+            #first the spike train generated features
+            for label in ['first_isi', 'latency']: #add blanks
+                        dict_spike_df[label + "_3_spikes" + real_sweep_number] = np.nan
+            #2 spike features
             dict_spike_df["last_isi" + real_sweep_number + " isi"] = [np.nan]
-            dict_spike_df["min_isi" + real_sweep_number + " isi"] = [spike_train['first_isi']]
-            spike_in_sweep['isi_'] = np.hstack((np.full(abs(spike_count), np.nan)))
+            dict_spike_df["min_isi" + real_sweep_number + " isi"] = np.nan
+            spike_in_sweep['isi_'] = np.nan
             for label in ipfx_train_feature_labels:
                 dict_spike_df[label + real_sweep_number] = [np.nan]
+            #1 spike features
+            dict_spike_df["first_isi_all_spikes" + real_sweep_number + " isi"] = np.nan
+            dict_spike_df["spike_amp" + real_sweep_number + " 1"] = np.nan
+            dict_spike_df["spike_thres" + real_sweep_number + " 1"] = np.nan
+            dict_spike_df["spike_peak" + real_sweep_number + " 1"] = np.nan
+            dict_spike_df["spike_rise" + real_sweep_number + " 1"] = np.nan
+            dict_spike_df["spike_decay" + real_sweep_number + " 1"] = np.nan
+            dict_spike_df["spike_AHP 1" + real_sweep_number + " "] = np.nan
+            dict_spike_df["spike_AHP slow 1" + real_sweep_number + " "] = np.nan
+            dict_spike_df["spike_AHP height 1" + real_sweep_number + " "] = np.nan
+            dict_spike_df["latency_all_spikes" + real_sweep_number + ""] = np.nan
+            dict_spike_df["spike_width" + real_sweep_number + "1"] = np.nan
+        if self.running_bins:
+            self._running_bins.append((_run_labels, running_row, real_sweep_number, param_dict['start'], param_dict['end']))
+        #append the dict as new columns
+        self.update(dict_spike_df)
 
-        spike_in_sweep = spike_in_sweep.join(spike_train_df)
-        print("Processed Sweep " + str(real_sweep_number) + " with " + str(spike_count) + " aps")
-        df = pd.concat([df, spike_in_sweep], ignore_index=True, sort=True)
-    else:
-        sweep_running_bin = pd.DataFrame(data=nan_row_run, columns=_run_labels, index=[real_sweep_number])
+    def _add_spikes(self, real_sweep_number, spike_in_sweep, spike_train):
+        #the spike count and spike dataframe of a sweep, with the same values add_sweep gives them, but none of the summary features
+        spike_count = spike_in_sweep.shape[0]
+        self.columns["Sweep " + real_sweep_number + " spike count"] = [spike_count]
+        if spike_count > 0:
+            spike_in_sweep['spike count'] = np.hstack((spike_count, np.full(abs(spike_count-1), np.nan)))
+            spike_in_sweep['sweep Number'] = np.full(abs(spike_count), int(real_sweep_number))
+            spike_in_sweep['isi_'] = np.hstack((np.diff(spike_in_sweep['peak_t'].to_numpy()), np.nan))
+            if len(spike_train) > 0:
+                spike_in_sweep = spike_in_sweep.join(pd.DataFrame(spike_train, index=[0]))
+            self._spike_dfs.append(spike_in_sweep)
         print("Processed Sweep " + str(real_sweep_number) + " with " + str(spike_count) + " aps")
-        #fill in np nans for the features that cant be calculated when there are no spikes
-        #first the spike train generated features
-        for label in ['first_isi', 'latency']: #add blanks
-                    dict_spike_df[label + "_3_spikes" + real_sweep_number] = np.nan
-        #2 spike features
-        dict_spike_df["last_isi" + real_sweep_number + " isi"] = [np.nan]
-        dict_spike_df["min_isi" + real_sweep_number + " isi"] = np.nan
-        spike_in_sweep['isi_'] = np.nan
-        for label in ipfx_train_feature_labels:
-            dict_spike_df[label + real_sweep_number] = [np.nan]
-        #1 spike features
-        dict_spike_df["first_isi_all_spikes" + real_sweep_number + " isi"] = np.nan
-        dict_spike_df["spike_amp" + real_sweep_number + " 1"] = np.nan
-        dict_spike_df["spike_thres" + real_sweep_number + " 1"] = np.nan
-        dict_spike_df["spike_peak" + real_sweep_number + " 1"] = np.nan
-        dict_spike_df["spike_rise" + real_sweep_number + " 1"] = np.nan
-        dict_spike_df["spike_decay" + real_sweep_number + " 1"] = np.nan
-        dict_spike_df["spike_AHP 1" + real_sweep_number + " "] = np.nan
-        dict_spike_df["spike_AHP slow 1" + real_sweep_number + " "] = np.nan
-        dict_spike_df["spike_AHP height 1" + real_sweep_number + " "] = np.nan
-        dict_spike_df["latency_all_spikes" + real_sweep_number + ""] = np.nan
-        dict_spike_df["spike_width" + real_sweep_number + "1"] = np.nan
-    sweep_running_bin['Sweep Number'] = [real_sweep_number]
-    temp_running_bin = pd.concat([temp_running_bin, sweep_running_bin], ignore_index=True)
-    #append the dict as new columns to the temp_spike_df
-    temp_spike_df = temp_spike_df.assign(**dict_spike_df)
-    return temp_spike_df, df, temp_running_bin
+
+    def frames(self):
+        """Builds the output dataframes
+        Returns:
+            temp_spike_df (pd.DataFrame): single row dataframe of the sweepwise features
+            df (pd.DataFrame): the ipfx spike dataframes of the sweeps stacked on top of each other
+            temp_running_bin (pd.DataFrame): the running bin averages, one row per sweep
+        """
+        temp_spike_df = pd.DataFrame({key: (value if isinstance(value, (list, np.ndarray)) else [value]) for key, value in self.columns.items()})
+        if len(self._spike_dfs) > 0:
+            df = pd.concat(self._spike_dfs, ignore_index=True, sort=True)
+        else:
+            df = pd.DataFrame()
+        rows = self._running_rows()
+        if len(self._running_bins) == 0:
+            temp_running_bin = pd.DataFrame()
+        elif all([x[0] == self._running_bins[0][0] for x in self._running_bins]):
+            temp_running_bin = pd.DataFrame(data=np.vstack(rows), columns=self._running_bins[0][0])
+            temp_running_bin['Sweep Number'] = [x[2] for x in self._running_bins]
+        else:
+            #the bins changed between sweeps (the end time was clipped to a shorter sweep), let pandas align the columns
+            temp_running_bin = pd.concat([pd.DataFrame(data=row.reshape(1, -1), columns=x[0]).assign(**{'Sweep Number': [x[2]]})
+                                          for x, row in zip(self._running_bins, rows)], ignore_index=True)
+        return temp_spike_df, df, temp_running_bin
+
+    def _running_rows(self):
+        #bins the spiking sweeps, one build_running_bins call per distinct start / end (usually just one for the file)
+        rows = [row for _, row, _, _, _ in self._running_bins]
+        windows = {}
+        for i in self._binned_spikes:
+            windows.setdefault(self._running_bins[i][3:], []).append(i)
+        for (start, end), sweeps in windows.items():
+            peak_t = [self._binned_spikes[i][0] for i in sweeps]
+            spike_groups = np.concatenate([np.full(x.shape[0], j) for j, x in enumerate(peak_t)])
+            binned, _ = build_running_bins(np.vstack([self._binned_spikes[i][1] for i in sweeps]), np.concatenate(peak_t), start, end,
+                                           groups=spike_groups, n_groups=len(sweeps))
+            isi_groups = np.concatenate([np.full(x.shape[0] - 1, j) for j, x in enumerate(peak_t)])
+            isi_bin, _ = build_running_bins(np.concatenate([np.diff(x) for x in peak_t]), np.concatenate([x[:-1] for x in peak_t]), start, end,
+                                            groups=isi_groups, n_groups=len(sweeps))
+            for j, i in enumerate(sweeps):
+                #feature major, the bins of each running_lab one after the other
+                rows[i] = np.hstack((binned[j].T.ravel(), isi_bin[j, :, 0]))
+        return rows
 
 
-def _build_full_df(abf, temp_spike_df, df, temp_running_bin, sweepList):
+def _build_full_df(abf, temp_spike_df, df, temp_running_bin, sweepList, rheobase=True):
     """
     takes a dataframe of spikes and builds a full dataframe with all the features, including means and rheobase features
     takes:
@@ -240,18 +308,21 @@ def _build_full_df(abf, temp_spike_df, df, temp_running_bin, sweepList):
         df (_type_): _description_
         temp_running_bin (_type_): _description_
         sweepList (_type_): _description_
+        rheobase (bool): if False, the rheobase and mean features are not computed, only the file and folder names are added. Defaults to True
     returns:
         _type_: _description_
     
     """
     temp_spike_df['protocol'] = [abf.protocol]
-    if df.empty:
+    spikes_found = not df.empty
+    if not spikes_found:
         df = df.assign(file_name=np.full(1,abf.name))
         df = df.assign(__fold_name=np.full(1,os.path.dirname(abf.filePath)))
         print('no spikes found')
     else:
         df = df.assign(file_name=np.full(len(df.index),abf.name))
         df = df.assign(__fold_name=np.full(len(df.index),os.path.dirname(abf.filePath)))
+    if rheobase and spikes_found:
         rheo_sweep = df['sweep Number'].to_numpy()[0]
         abf.setSweep(int(rheo_sweep - 1))
         rheobase_current = abf.sweepC[np.argmax(abf.sweepC)]
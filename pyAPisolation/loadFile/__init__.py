@@ -1,2 +1,3 @@
-from .loadNWB import loadNWB, loadFile
-from .loadABF import loadABF
\ No newline at end of file
+from .loadNWB import loadNWB, loadFile, probeFile, probeNWB
+from .loadABF import loadABF, probeABF, openABF
+from .fileCache import enable_cache, disable_cache, get_cache
\ No newline at end of file
@@ -0,0 +1,156 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+#opt-in: nothing is cached until enable_cache is called, or the PYAPISOLATION_CACHE_DIR environment variable is set
+CACHE_ENV_VAR = 'PYAPISOLATION_CACHE_DIR'
+DEFAULT_MAX_BYTES = 4 * 1024**3
+TMP_SUFFIX = '.tmp'
+_CACHE = None
+
+
+def enable_cache(cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, hash_content=False):
+    """Turns on the on-disk cache of decoded sweep arrays, used by loadFile (and so cellData).
+
+    Args:
+        cache_dir (str, optional): where to store the cache. Defaults to ~/.pyAPisolation/cache.
+        max_bytes (int, optional): size cap, the least recently used entries are evicted past this. Defaults to 4 GB.
+        hash_content (bool, optional): key entries on a hash of the full file contents, rather than the path, size and mtime. Defaults to False.
+
+    Returns:
+        fileCache: the cache object
+    """
+    global _CACHE
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.pyAPisolation', 'cache')
+    _CACHE = fileCache(cache_dir, max_bytes=max_bytes, hash_content=hash_content)
+    return _CACHE
+
+def disable_cache():
+    global _CACHE
+    _CACHE = None
+
+def get_cache():
+    """Returns the active cache, or None if caching is off"""
+    if _CACHE is None and os.environ.get(CACHE_ENV_VAR):
+        enable_cache(os.environ[CACHE_ENV_VAR])
+    return _CACHE
+
+
+class cachedFile(object):
+    """Stand in for the pyabf / nwb object on a cache hit. Holds the file metadata saved with the arrays"""
+    def __init__(self, meta):
+        self.__dict__.update(meta)
+
+    def __repr__(self):
+        return f"cachedFile object: {self.file}"
+
+
+class fileCache(object):
+    """
+    An on-disk cache of decoded sweep arrays. Each file gets a folder holding dataY.npy, dataC.npy, the time axis and a meta.json,
+    and hits are loaded with np.load(mmap_mode='r'), so a reload reads (almost) nothing until the sweeps are used.
+    Entries are keyed on the file path, size and mtime (or on the full file contents if hash_content is True), so a changed file is never served stale.
+    Past max_bytes, the least recently used entries are evicted.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, hash_content=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, file_path):
+        file_path = os.path.abspath(file_path)
+        h = hashlib.blake2b(digest_size=16)
+        if self.hash_content:
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        else:
+            stat = os.stat(file_path)
+            h.update(f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+        return h.hexdigest()
+
+    def load(self, file_path):
+        """Returns (dataX, dataY, dataC, cachedFile) for the file, or None on a miss"""
+        entry = os.path.join(self.cache_dir, self.key(file_path))
+        meta_path = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            dataY = np.load(os.path.join(entry, 'dataY.npy'), mmap_mode='r')
+            dataC = np.load(os.path.join(entry, 'dataC.npy'), mmap_mode='r')
+            dataX = np.load(os.path.join(entry, 'dataX.npy'), mmap_mode='r')
+        except Exception:
+            #a partial or corrupt entry, drop it and reload from the file
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        if dataX.ndim == 1:
+            #only the shared time row was stored
+            dataX = np.broadcast_to(dataX, dataY.shape)
+        #mark the entry as recently used
+        os.utime(meta_path)
+        meta['file'] = file_path
+        return dataX, dataY, dataC, cachedFile(meta)
+
+    def store(self, file_path, dataX, dataY, dataC, file_obj=None):
+        """Saves the decoded arrays of the file. Uneven (object) sweeps are not cached"""
+        if any([not isinstance(x, np.ndarray) or x.dtype == object for x in (dataX, dataY, dataC)]):
+            return False
+        key = self.key(file_path)
+        entry = os.path.join(self.cache_dir, key)
+        #each writer gets its own temp folder, so concurrent misses on one file (e.g. two pool workers) never write into the same place
+        tmp = tempfile.mkdtemp(prefix=key + '.', suffix=TMP_SUFFIX, dir=self.cache_dir)
+        np.save(os.path.join(tmp, 'dataY.npy'), dataY)
+        np.save(os.path.join(tmp, 'dataC.npy'), dataC)
+        #a broadcast time axis is just one row
+        np.save(os.path.join(tmp, 'dataX.npy'), dataX[0] if dataX.ndim == 2 and dataX.strides[0] == 0 else dataX)
+        meta = {'file': os.path.abspath(file_path), 'protocol': str(getattr(file_obj, 'protocol', '') or ''), 'sweepCount': int(dataY.shape[0])}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        #write to a temp folder then move, so a crash never leaves a half written entry behind
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            #the entry exists, stored by another writer that missed at the same time. The key covers the file size and mtime,
+            #so it holds the same arrays (and a corrupt one is dropped on load)
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return True
+
+    def entries(self):
+        """Returns a list of (last used time, size in bytes, path) for each entry, least recently used first"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(TMP_SUFFIX):
+                #an entry still being written
+                continue
+            entry = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry, 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = sum([os.path.getsize(os.path.join(entry, x)) for x in os.listdir(entry)])
+            entries.append((os.path.getmtime(meta_path), size, entry))
+        return sorted(entries)
+
+    def size(self):
+        return sum([x[1] for x in self.entries()])
+
+    def evict(self):
+        """Drops the least recently used entries until the cache is under max_bytes"""
+        entries = self.entries()
+        total = sum([x[1] for x in entries])
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
@@ -2,12 +2,95 @@ import numpy as np
 import pyabf
 
 
-def loadABF(file_path, return_obj=False):
+def loadABF(file_path, return_obj=False, dtype=None):
     '''
     Employs pyABF to generate numpy arrays of the ABF data. Optionally returns abf object.
     Same I/O as loadNWB
+    The sweeps are a (sweeps, samples) view of the data pyabf has already decoded, and the command waveforms are generated for all sweeps in one pass.
+    Files with variable length sweeps fall back to loading sweep by sweep.
+    dtype (optional): cast the time, response and command arrays to this dtype (e.g. np.float32 to halve the memory). Defaults to None (no cast).
     '''
     abf = pyabf.ABF(file_path)
+    if _has_fixed_length_sweeps(abf):
+        npdataX, npdataY, npdataC = _loadABF_fixed(abf)
+    else:
+        npdataX, npdataY, npdataC = _loadABF_sweepwise(abf)
+
+    if dtype is not None:
+        if npdataX.dtype != dtype:
+            npdataX = np.broadcast_to(npdataX[0].astype(dtype), npdataX.shape) if npdataX.strides[0] == 0 else npdataX.astype(dtype)
+        npdataY = npdataY.astype(dtype, copy=False)
+        npdataC = npdataC.astype(dtype, copy=False)
+
+    if return_obj == True:
+
+        return npdataX, npdataY, npdataC, abf
+    else:
+
+        return npdataX, npdataY, npdataC
+
+    ##Final return incase if statement fails somehow
+    return npdataX, npdataY, npdataC
+
+
+def openABF(file_path, protocol_name=''):
+    '''
+    Opens an ABF, reading the header once. The sweep data is only loaded (into the same pyabf.ABF) if the protocol contains protocol_name,
+    otherwise the header only object is returned, so callers can check abf.protocol without a second open.
+    Loading into the header only object uses a private pyabf method, if that is missing or fails (e.g. another pyabf version) the file is opened again in full.
+    '''
+    abf = pyabf.ABF(file_path, loadData=False)
+    if protocol_name in (abf.protocol or ''):
+        if not hasattr(abf, '_loadAndScaleData'):
+            return pyabf.ABF(file_path)
+        try:
+            with open(abf.abfFilePath, 'rb') as fb:
+                abf._loadAndScaleData(fb)
+            abf.setSweep(0)
+        except Exception:
+            abf = pyabf.ABF(file_path)
+    return abf
+
+def _has_fixed_length_sweeps(abf):
+    #same check pyabf uses in setSweep
+    if abf.sweepCount > 1 and hasattr(abf, "_synchArraySection"):
+        return len(set(abf._synchArraySection.lLength)) == 1
+    return True
+
+def _loadABF_fixed(abf, channel=0):
+    sweepCount = abf.sweepCount
+    pointCount = abf.sweepPointCount
+    #abf.data is (channels, points), each sweep is a contiguous run of sweepPointCount points, so this is a view, not a copy
+    npdataY = abf.data[channel, :sweepCount * pointCount].reshape(sweepCount, pointCount)
+    #every sweep shares the same time axis, so only a single row is stored, the rest is a read-only broadcast view
+    npdataX = np.broadcast_to(np.arange(pointCount) * abf.dataSecPerPoint, (sweepCount, pointCount))
+    npdataC = _abf_command_waveforms(abf, channel, sweepCount, pointCount)
+    #match the state setSweep would leave the abf object in
+    abf.setSweep(sweepCount - 1, channel=channel)
+    return npdataX, npdataY, npdataC
+
+def _abf_command_waveforms(abf, channel, sweepCount, pointCount):
+    """Generates the command waveform of every sweep. Mirrors pyabf's sweepC / stimulusWaveform, but builds the epoch table once,
+    instead of once per sweep"""
+    stimulus = abf.stimulusByChannel[channel]
+    if abf.abfVersion["major"] == 1:
+        nWaveformEnable = abf._headerV1.nWaveformEnable[channel]
+        nWaveformSource = abf._headerV1.nWaveformSource[channel]
+    else:
+        nWaveformEnable = abf._dacSection.nWaveformEnable[channel]
+        nWaveformSource = abf._dacSection.nWaveformSource[channel]
+
+    npdataC = np.empty((sweepCount, pointCount), dtype=np.float64)
+    if nWaveformEnable != 0 and nWaveformSource == 1:
+        epochTable = pyabf.waveform.EpochTable(abf, channel)
+        for sweep in range(sweepCount):
+            npdataC[sweep] = epochTable.epochWaveformsBySweep[sweep].getWaveform()[:pointCount]
+    else:
+        #holding level, custom stimulus file, or unknown, in every case the same waveform for each sweep
+        npdataC[:] = stimulus.stimulusWaveform(0)[:pointCount]
+    return npdataC
+
+def _loadABF_sweepwise(abf):
     dataX = []
     dataY = []
     dataC = []
@@ -22,14 +105,23 @@ def loadABF(file_path, return_obj=False):
     npdataX = np.vstack(dataX)
     npdataY = np.vstack(dataY)
     npdataC = np.vstack(dataC)
-
-    if return_obj == True:
-
-        return npdataX, npdataY, npdataC, abf
-    else:
-
-        return npdataX, npdataY, npdataC
-
-    ##Final return incase if statement fails somehow
     return npdataX, npdataY, npdataC
 
+
+def probeABF(file_path):
+    '''
+    Reads only the ABF header (no sweep data is decoded) and returns a dict of the file metadata.
+    Useful for filtering files by protocol before paying for a full load.
+    Same keys as probeNWB
+    '''
+    abf = pyabf.ABF(file_path, loadData=False)
+    return {'file': file_path,
+            'protocol': abf.protocol if abf.protocol is not None else '',
+            'sweepCount': abf.sweepCount,
+            'sampleRate': abf.dataRate,
+            'sweepPointCount': abf.sweepPointCount,
+            'sweepLengthSec': abf.sweepLengthSec,
+            'channelCount': abf.channelCount,
+            'respUnits': abf.adcUnits[0] if len(abf.adcUnits) else '',
+            'stimUnits': abf.dacUnits[0] if len(abf.dacUnits) else '',
+            'datetime': abf.abfDateTime.isoformat() if hasattr(abf.abfDateTime, 'isoformat') else str(abf.abfDateTime)}
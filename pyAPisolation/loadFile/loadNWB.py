@@ -1,5 +1,6 @@
 import numpy as np
-from .loadABF import loadABF
+from .loadABF import loadABF, probeABF
+from .fileCache import get_cache
 try:
     import h5py
     ##Does not import when using python-matlab interface on windows machines
@@ -7,7 +8,7 @@ except:
     print("h5py import fail")
 import pandas as pd
 
-def loadFile(file_path, return_obj=False, old=False):
+def loadFile(file_path, return_obj=False, old=False, load_into_mem=True, use_cache=True):
     """Loads the nwb object and returns three arrays dataX, dataY, dataC and optionally the object.
     same input / output as loadABF for easy pipeline inclusion
 
@@ -15,6 +16,9 @@ def loadFile(file_path, return_obj=False, old=False):
         file_path (str): [description]
         return_obj (bool, optional): return the NWB object to access various properites. Defaults to False.
         old (bool, optional): use the old indexing method, uneeded in most cases. Defaults to False.
+        load_into_mem (bool, optional): for nwb files, False returns lazy sweep arrays that read from disk on demand (see loadNWB). Defaults to True.
+        use_cache (bool, optional): use the on-disk cache of decoded arrays, if it is enabled (see fileCache.enable_cache). On a hit the arrays are
+            read-only memory maps and the returned object is a cachedFile holding the file metadata. Defaults to True.
 
     Returns:
         dataX: time (should be seconds)
@@ -22,13 +26,90 @@ def loadFile(file_path, return_obj=False, old=False):
         dataC: current (should be pA)
         dt: time step (should be seconds)
     """    
+    cache = get_cache() if (use_cache and load_into_mem) else None
+    if cache is not None:
+        cached = cache.load(file_path)
+        if cached is not None:
+            return cached if return_obj else cached[:3]
+
     if file_path.endswith(".nwb"):
-        return loadNWB(file_path, return_obj, old)
+        loaded = loadNWB(file_path, True, old, load_into_mem=load_into_mem)
     elif file_path.endswith(".abf"):
-        return loadABF(file_path, return_obj)
+        loaded = loadABF(file_path, True)
     else:
         raise Exception("File type not supported")
 
+    if cache is not None:
+        cache.store(file_path, *loaded)
+    return loaded if return_obj else loaded[:3]
+
+
+def probeFile(file_path):
+    """Reads only the file metadata (no sweep data) and returns it as a dict. Dispatches on the file extension, like loadFile.
+    Used to filter files (e.g. by protocol) before loading any waveforms.
+
+    Args:
+        file_path (str): path to the .abf or .nwb file
+
+    Returns:
+        dict: file, protocol, sweepCount, sampleRate, sweepPointCount, sweepLengthSec, channelCount, respUnits, stimUnits, datetime
+    """
+    if file_path.endswith(".nwb"):
+        return probeNWB(file_path)
+    elif file_path.endswith(".abf"):
+        return probeABF(file_path)
+    else:
+        raise Exception("File type not supported")
+
+def probeNWB(file_path):
+    """Reads the nwb attributes and dataset shapes only, none of the sweep data is read from disk.
+    Same keys as probeABF. Only the sweeps passing check_stimulus are counted, matching nwbFile.
+
+    Args:
+        file_path (str): path to the nwb file
+
+    Returns:
+        dict: file, protocol, sweepCount, sampleRate, sweepPointCount, sweepLengthSec, channelCount, respUnits, stimUnits, datetime
+    """
+    with h5py.File(file_path,  "r") as f:
+        acq_keys = list(f['acquisition'].keys())
+        stim_keys = list(f['stimulus']['presentation'].keys())
+        index_to_use = []
+        protocols = []
+        for key_resp, key_stim in zip(acq_keys, stim_keys):
+            sweep_dict = dict(f['acquisition'][key_resp].attrs.items())
+            if check_stimulus(sweep_dict, key_resp):
+                index_to_use.append((key_resp, key_stim))
+                protocols.append(_sweep_protocol(sweep_dict))
+        meta = {'file': file_path, 'protocol': _join_protocols(protocols), 'sweepCount': len(index_to_use), 'sampleRate': np.nan,
+                'sweepPointCount': np.nan, 'sweepLengthSec': np.nan, 'channelCount': 1, 'respUnits': '', 'stimUnits': '',
+                'datetime': _decode(f['session_start_time'][()]) if 'session_start_time' in f else ''}
+        if len(index_to_use) > 0:
+            resp = f['acquisition'][index_to_use[-1][0]]
+            meta['sampleRate'] = resp['starting_time'].attrs['rate']
+            meta['sweepPointCount'] = max([f['acquisition'][x[0]]['data'].shape[0] for x in index_to_use])
+            meta['sweepLengthSec'] = meta['sweepPointCount'] / meta['sampleRate']
+            meta['respUnits'] = _decode(resp['data'].attrs.get('unit', ''))
+            meta['stimUnits'] = _decode(f['stimulus']['presentation'][index_to_use[-1][1]]['data'].attrs.get('unit', ''))
+    return meta
+
+def _decode(value):
+    try:
+        return value.decode() #sometimes its encoded... sometimes its not
+    except:
+        return str(value)
+
+def _sweep_protocol(sweep_dict):
+    """Returns the stimulus name of a sweep from its attributes"""
+    if 'stimulus_description' in sweep_dict.keys():
+        return _decode(sweep_dict['stimulus_description'])
+    elif 'description' in sweep_dict.keys():
+        return _decode(sweep_dict['description'])
+    return ''
+
+def _join_protocols(protocols):
+    """NWB files can hold several stimuli, so the file protocol is the unique sweep protocols in order of appearance"""
+    return ', '.join(dict.fromkeys(protocols))
 
 
 def loadNWB(file_path, return_obj=False, old=False, load_into_mem=True):
@@ -39,7 +120,9 @@ def loadNWB(file_path, return_obj=False, old=False, load_into_mem=True):
         file_path (str): [description]
         return_obj (bool, optional): return the NWB object to access various properites. Defaults to False.
         old (bool, optional): use the old indexing method, uneeded in most cases. Defaults to False.
-        load_into_mem (bool, optional): load the data into memory. Defaults to True.        load_into_mem (bool, optional): load the data into memory. Defaults to True.
+        load_into_mem (bool, optional): load the data into memory. Defaults to True. If False, the file is kept open and dataX, dataY, dataC
+            are lazySweeps arrays, which only read the sweeps / time windows that are indexed (e.g. dataY[3] or dataY[3, 1000:2000]).
+            In this case close the file with nwb.close() (return_obj=True), or use the nwbFile object as a context manager.
 
     Returns:
         dataX: time (should be seconds)
@@ -62,15 +145,10 @@ def loadNWB(file_path, return_obj=False, old=False, load_into_mem=True):
         dataX = np.asarray(nwb.dataX, dtype=np.dtype('O')) ##Assumes if they are still lists its due to uneven size
         dataY = np.asarray(nwb.dataY, dtype=np.dtype('O')) #Casts them as numpy object types to deal with this
         dataC = np.asarray(nwb.dataC, dtype=np.dtype('O'))
-    elif load_into_mem==True:
-        dataX = nwb.dataX #If they are numpy arrays just pass them
+    else:
+        dataX = nwb.dataX #If they are numpy arrays (or lazy sweeps) just pass them
         dataY = nwb.dataY
         dataC = nwb.dataC
-    else:
-        ##If not loading into memory just pass the lists
-        dataX = []
-        dataY = []
-        dataC = []
 
     if return_obj == True:
         return dataX, dataY, dataC, nwb
@@ -88,7 +166,10 @@ def loadNWB(file_path, return_obj=False, old=False, load_into_mem=True):
 class nwbFile(object):
 
     def __init__(self, file_path, load_into_mem=True):
-        with h5py.File(file_path,  "r") as f:
+        #in lazy mode the file stays open, the sweeps are read on demand, see close()
+        self._file = None
+        f = h5py.File(file_path,  "r")
+        try:
             ##Load some general properities
             acq_keys = list(f['acquisition'].keys())
             stim_keys = list(f['stimulus']['presentation'].keys())
@@ -97,11 +178,14 @@ class nwbFile(object):
             #self.temp = f['general']['Temperature'][()]
             ## Find the index's with long square
             index_to_use = []
+            protocols = []
             for key_resp, key_stim in sweeps: 
                 sweep_dict = dict(f['acquisition'][key_resp].attrs.items())
                 if check_stimulus(sweep_dict, key_resp):
                     index_to_use.append((key_resp, key_stim)) 
+                    protocols.append(_sweep_protocol(sweep_dict))
             self.sweepCount = len(index_to_use)
+            self.protocol = _join_protocols(protocols)
             if len(index_to_use)==0:
                 #set rate etc to nan
                 self.rate = {'rate':np.nan}
@@ -129,23 +213,30 @@ class nwbFile(object):
                 
                 if load_into_mem==True:
                     temp_dataY = np.asarray(f['acquisition'][sweep_resp]['data'][()]) * dict(f['acquisition'][sweep_resp]['data'].attrs.items())['conversion'] 
-                    temp_dataX = np.cumsum(np.hstack((0, np.full(temp_dataY.shape[0]-1,data_space_s))))
+                    temp_dataX = np.arange(temp_dataY.shape[0]) * data_space_s
                     temp_dataC = np.asarray(f['stimulus']['presentation'][sweep_stim]['data'][()]) * dict(f['stimulus']['presentation'][sweep_stim]['data'].attrs.items())['conversion']
                     dataY.append(temp_dataY)
                     dataX.append(temp_dataX)
                     dataC.append(temp_dataC)
                 else:
                     dataY.append(f['acquisition'][sweep_resp]['data'])
-                    dataX.append(f['acquisition'][sweep_resp]['starting_time'])
+                    dataX.append(data_space_s)
                     dataC.append(f['stimulus']['presentation'][sweep_stim]['data'])
                 sweep_dict_resp = dict(f['acquisition'][sweep_resp].attrs.items())
                 sweep_dict_resp.update(dict(f['acquisition'][sweep_resp]['data'].attrs.items()))
                 sweep_dict_stim = dict(f['stimulus']['presentation'][sweep_stim].attrs.items())
                 sweep_dict_stim.update(dict(f['stimulus']['presentation'][sweep_stim]['data'].attrs.items()))
                 self.sweepMetadata.append(dict(resp_dict = sweep_dict_resp, stim_dict=sweep_dict_stim))
+            if load_into_mem==False:
+                lengths = [x.shape[0] for x in dataY]
+                self.dataY = lazySweeps(_dataset_reader(dataY, [x['resp_dict']['conversion'] for x in self.sweepMetadata]), lengths)
+                self.dataC = lazySweeps(_dataset_reader(dataC, [x['stim_dict']['conversion'] for x in self.sweepMetadata]), [x.shape[0] for x in dataC])
+                self.dataX = lazySweeps(_time_reader(lengths, dataX), lengths)
+                self._file = f
+                return
             try:
                 ##Try to vstack assuming all sweeps are same length
-                self.dataX = np.vstack(dataX)
+                self.dataX = _stack_time(dataX)
                 self.dataC = np.vstack(dataC)
                 self.dataY = np.vstack(dataY)
             except:
@@ -153,8 +244,93 @@ class nwbFile(object):
                 self.dataX = dataX
                 self.dataC = dataC
                 self.dataY = dataY
+        finally:
+            if self._file is None:
+                f.close()
         return
 
+    def close(self):
+        """Closes the file, only needed when loaded with load_into_mem=False"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class lazySweeps(object):
+    """
+    A read-on-demand stand in for a (sweeps, samples) array. Indexing reads only what is asked for from the open nwb file:
+        sweeps[3]              -> sweep 3 as a np.array
+        sweeps[3, 1000:2000]   -> samples 1000 to 2000 of sweep 3
+        sweeps[2:5], sweeps[[0, 4]] -> a 2d array of those sweeps (object array if the sweeps are uneven)
+    np.asarray(sweeps) reads everything. The conversion factor is applied on read.
+    """
+    def __init__(self, reader, lengths):
+        #reader(sweep, sample_key) returns the requested samples of a single sweep
+        self._reader = reader
+        self.lengths = list(lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def shape(self):
+        return (len(self.lengths), max(self.lengths) if len(self.lengths) else 0)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            sweep_key, sample_key = key
+        else:
+            sweep_key, sample_key = key, slice(None)
+        if isinstance(sweep_key, (int, np.integer)):
+            return self._reader(range(len(self))[sweep_key], sample_key)
+        sweeps = np.arange(len(self))[sweep_key]
+        return _stack_sweeps([self._reader(i, sample_key) for i in sweeps])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+
+def _dataset_reader(datasets, conversions):
+    def reader(sweep, sample_key):
+        return np.asarray(datasets[sweep][sample_key], dtype=np.float64) * conversions[sweep]
+    return reader
+
+def _time_reader(lengths, dts):
+    #the time axis is never stored, only the requested window is generated
+    def reader(sweep, sample_key):
+        return np.asarray(range(lengths[sweep])[sample_key]) * dts[sweep]
+    return reader
+
+def _stack_sweeps(sweeps):
+    try:
+        return np.vstack(sweeps)
+    except ValueError:
+        data = np.empty(len(sweeps), dtype=object)
+        data[:] = sweeps
+        return data
+
+def _stack_time(dataX):
+    """Stacks the sweep time arrays. If every sweep has the same time axis (the usual case) only one row is kept,
+    and the rest is a read-only broadcast view of it"""
+    if isinstance(dataX[0], np.ndarray) and all([x.shape == dataX[0].shape and np.array_equal(x, dataX[0]) for x in dataX[1:]]):
+        return np.broadcast_to(dataX[0], (len(dataX), dataX[0].shape[0]))
+    return np.vstack(dataX)
+
 class stim_names:
     stim_inc = ['long', '1000']
     stim_exc = ['rheo', 'Rf50_']
@@ -208,6 +384,7 @@ class old_nwbFile(object):
             ##Load some general properities
             sweeps = list(f['acquisition'].keys()) ##Sweeps are stored as keys
             self.sweepCount = len(sweeps)
+            self.protocol = _join_protocols([_sweep_protocol(dict(f['acquisition'][x].attrs.items())) for x in sweeps])
             self.rate = dict(f['acquisition'][sweeps[0]]['starting_time'].attrs.items())
             self.sweepYVars = dict(f['acquisition'][sweeps[0]]['data'].attrs.items())
             self.sweepCVars = dict(f['stimulus']['presentation'][sweeps[0]]['data'].attrs.items())
@@ -220,14 +397,14 @@ class old_nwbFile(object):
                 ##Load the response and stim
                 data_space_s = 1/(dict(f['acquisition'][sweeps[0]]['starting_time'].attrs.items())['rate'])
                 temp_dataY = np.asarray(f['acquisition'][sweep]['data'][()])
-                temp_dataX = np.cumsum(np.hstack((0, np.full(temp_dataY.shape[0]-1,data_space_s))))
+                temp_dataX = np.arange(temp_dataY.shape[0]) * data_space_s
                 temp_dataC = np.asarray(f['stimulus']['presentation'][sweep]['data'][()])
                 dataY.append(temp_dataY)
                 dataX.append(temp_dataX)
                 dataC.append(temp_dataC)
             try:
                 ##Try to vstack assuming all sweeps are same length
-                self.dataX = np.vstack(dataX)
+                self.dataX = _stack_time(dataX)
                 self.dataC = np.vstack(dataC)
                 self.dataY = np.vstack(dataY)
             except:
@@ -0,0 +1,404 @@
+#############
+# A numpy spike detector, that works on a whole (sweeps, samples) block at once.
+# It follows the same steps (and gives the same spike table) as ipfx.feature_extractor.SpikeFeatureExtractor.process,
+# but each step is done for every spike of every sweep at once with array operations, rather than sweep by sweep, spike by spike.
+# Select it with param_dict['backend'] = 'numpy' in the feature extractor
+#############
+import sys
+import logging
+import numpy as np
+import pandas as pd
+import scipy.signal as signal
+
+logger = logging.getLogger(__name__)
+
+#the ipfx defaults for the fixed parameters of the trough / threshold analysis
+CLIP_TOL = 1.0
+HEAVY_FILTER = 1.
+TERM_FRAC = 0.01
+ADP_THRESH = 0.5
+ADP_TOL = 0.5
+FLAT_INTERVAL = 0.002
+ADP_MAX_DELTA_T = 0.005
+ADP_MAX_DELTA_V = 10.
+
+
+def has_fixed_dt(x):
+    """Checks every sweep of the block has the same, fixed sample interval (ipfx's has_fixed_dt, for all the sweeps)"""
+    #a broadcast time axis only needs the one row
+    dt = np.diff(x[:1], axis=1) if x.strides[0] == 0 else np.diff(x, axis=1)
+    return dt.size > 0 and bool(np.allclose(dt, dt[0, 0])) and dt[0, 0] > sys.float_info.epsilon
+
+def block_dvdt(x, y, filter=None):
+    """ dV/dt of every sweep of the block, the same as ipfx.time_series_utils.calculate_dvdt run on each sweep.
+    takes:
+        x (np.array): The time array of the sweeps (2d array), must have a fixed dt (see has_fixed_dt)
+        y (np.array): The voltage array of the sweeps (2d array)
+        filter (float): cutoff frequency for the 4-pole low-pass bessel filter, in kHz. None or 0 for no filter
+    returns:
+        dvdt (np.array): (sweeps, samples - 1) in V/s
+    """
+    if filter:
+        filt_coeff = (filter * 1e3) / ((1. / (x[0, 1] - x[0, 0])) / 2.)
+        if filt_coeff < 0 or filt_coeff >= 1:
+            raise ValueError("bessel coeff ({:f}) is outside of valid range [0,1); cannot filter sampling frequency {:.1f} kHz with cutoff frequency {:.1f} kHz.".format(
+                filt_coeff, (1. / (x[0, 1] - x[0, 0])) / 1e3, filter))
+        b, a = signal.bessel(4, filt_coeff, "low")
+        y = signal.filtfilt(b, a, y, axis=1)
+    dt = np.diff(x[:1], axis=1) if x.strides[0] == 0 else np.diff(x, axis=1)
+    return 1e-3 * np.diff(y, axis=1) / dt
+
+def time_index(x, t_0):
+    """The index of the sample closest to t_0 in each sweep (ipfx's find_time_index, for all the sweeps). t_0 may be a scalar or one value per sweep"""
+    t_0 = np.broadcast_to(np.asarray(t_0, dtype=np.float64), (x.shape[0],))
+    if x.strides[0] == 0 and np.all(t_0 == t_0[0]):
+        return np.full(x.shape[0], np.argmin(np.abs(x[0] - t_0[0])))
+    return np.argmin(np.abs(x - t_0[:, None]), axis=1)
+
+
+#=== segment reductions ===
+#spikes are addressed by their flat index into the (sweeps, samples) block, and most steps reduce over a [start, stop) segment of samples per spike.
+#these helpers do the reduction for all the segments at once. Empty segments return -1
+
+def _segments(starts, stops):
+    lengths = np.clip(stops - starts, 0, None)
+    offsets = np.cumsum(lengths) - lengths
+    seg = np.repeat(np.arange(starts.shape[0]), lengths)
+    idx = np.arange(lengths.sum()) - offsets[seg] + starts[seg]
+    return idx, seg, offsets, lengths > 0
+
+def _seg_reduce(values, mask, starts, stops, first=True):
+    #first (or last) index of each segment where mask is True
+    idx, seg, offsets, nonempty = _segments(starts, stops)
+    out = np.full(starts.shape[0], -1, dtype=np.int64)
+    if idx.shape[0] == 0:
+        return out
+    hit = mask(values[idx], seg)
+    if first:
+        found = np.minimum.reduceat(np.where(hit, idx, np.iinfo(np.int64).max), offsets[nonempty])
+        out[nonempty] = np.where(found == np.iinfo(np.int64).max, -1, found)
+    else:
+        out[nonempty] = np.maximum.reduceat(np.where(hit, idx, -1), offsets[nonempty])
+    return out
+
+def _seg_argext(values, starts, stops, fn=np.maximum):
+    #the first index of the max (np.maximum) or min (np.minimum) of each segment, same as np.argmax / np.argmin
+    idx, seg, offsets, nonempty = _segments(starts, stops)
+    out = np.full(starts.shape[0], -1, dtype=np.int64)
+    if idx.shape[0] == 0:
+        return out
+    vals = values[idx]
+    ext = np.full(starts.shape[0], np.nan)
+    ext[nonempty] = fn.reduceat(vals, offsets[nonempty])
+    hit = (vals == ext[seg]) | (np.isnan(vals) & np.isnan(ext[seg]))
+    found = np.minimum.reduceat(np.where(hit, idx, np.iinfo(np.int64).max), offsets[nonempty])
+    out[nonempty] = found
+    return out
+
+def _next_in_sweep(values, sweep, end):
+    #the value of the next spike in the same sweep, or end (per sweep) for the last spike of each sweep
+    nxt = end[sweep].copy()
+    same = sweep[1:] == sweep[:-1]
+    nxt[:-1][same] = values[1:][same]
+    return nxt
+
+def _prev_in_sweep(values, sweep, start):
+    prev = start[sweep].copy()
+    same = sweep[1:] == sweep[:-1]
+    prev[1:][same] = values[:-1][same]
+    return prev
+
+def _last_in_sweep(sweep):
+    last = np.ones(sweep.shape[0], dtype=bool)
+    last[:-1] = sweep[1:] != sweep[:-1]
+    return last
+
+def _sweep_mean(values, sweep, n_sweeps):
+    counts = np.bincount(sweep, minlength=n_sweeps)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.bincount(sweep, weights=values, minlength=n_sweeps) / counts
+
+
+def detect_spikes(x, y, c=None, start=None, end=None, filter=10., dv_cutoff=20., max_interval=0.005, min_height=2., min_peak=-30.,
+                  thresh_frac=0.05, reject_at_stim_start_interval=0, dvdt=None, times_only=False):
+    """ Detects the spikes in every sweep of a block, and returns the same spike table per sweep as ipfx's SpikeFeatureExtractor.process.
+    takes:
+        x (np.array): The time array of the sweeps (2d array, sweeps x samples), with a fixed dt
+        y (np.array): The voltage array of the sweeps (2d array)
+        c (np.array): The current array of the sweeps (2d array, optional)
+        start, end (float or np.array): The time window for spike detection, a scalar or one value per sweep. Defaults to the whole sweep
+        filter, dv_cutoff, max_interval, min_height, min_peak, thresh_frac, reject_at_stim_start_interval: As in ipfx's SpikeFeatureExtractor
+        dvdt (np.array, optional): precomputed block_dvdt(x, y, filter)
+        times_only (bool): If True, stop once the thresholds and peaks are found, and return only their columns (see spike_times_table)
+    returns:
+        spike_dfs (list): One dataframe per sweep, empty for sweeps without spikes
+    """
+    x = np.asarray(x, dtype=np.float64)
+    #keep float32 recordings in float32, ipfx does its arithmetic (and reports the voltages) in the dtype of the data
+    y = np.asarray(y)
+    if y.dtype.kind != 'f':
+        y = y.astype(np.float64)
+    n_sweeps, n = y.shape
+    x = np.broadcast_to(x, y.shape)
+    start = np.broadcast_to(np.asarray(x[:, 0] if start is None else start, dtype=np.float64), (n_sweeps,))
+    end = np.broadcast_to(np.asarray(x[:, -1] if end is None else end, dtype=np.float64), (n_sweeps,))
+    if dvdt is None:
+        dvdt = block_dvdt(x, y, filter)
+    #pad dV/dt to the shape of the block, so flat indexes address the same sample in both
+    D = np.hstack((dvdt, np.full((n_sweeps, 1), np.nan))).ravel()
+    V = np.ascontiguousarray(y).ravel()
+    T = np.ascontiguousarray(x).ravel()
+    row = np.arange(n_sweeps) * n
+    start_index = time_index(x, start)
+    end_index = time_index(x, end)
+
+    #=== putative spikes: positive going crossings of dv_cutoff inside the window
+    above = dvdt >= dv_cutoff
+    cols = np.arange(n - 2)
+    crossings = ~above[:, :-1] & above[:, 1:] & (cols >= start_index[:, None]) & (cols <= end_index[:, None] - 2)
+    sweep, col = np.nonzero(crossings)
+    spikes = row[sweep] + col
+    #only keep a crossing if dV/dt went negative since the previous one
+    #neg[b] - neg[a] is the number of negative dV/dt samples in [a, b)
+    neg = np.hstack((np.zeros((n_sweeps, 1), dtype=np.int64), np.cumsum(dvdt < 0, axis=1))).ravel()
+    negs = lambda a, b: neg[b] - neg[a] > 0
+    same = sweep[1:] == sweep[:-1]
+    keep = np.ones(spikes.shape[0], dtype=bool)
+    keep[1:] = ~same | negs(spikes[:-1], spikes[1:])
+    spikes, sweep = spikes[keep], sweep[keep]
+
+    if not spikes.size:
+        return [pd.DataFrame() for _ in range(n_sweeps)]
+
+    #=== peaks, and drop the putative spikes that do not look like spikes
+    peaks = _seg_argext(V, spikes, _next_in_sweep(spikes, sweep, row + end_index))
+    same = sweep[1:] == sweep[:-1]
+    diff_mask = ~same | negs(peaks[:-1], spikes[1:])
+    keep_peak, keep_spike = np.append(diff_mask, True), np.insert(diff_mask, 0, True)
+    spikes, peaks, sweep = spikes[keep_spike], peaks[keep_peak], sweep[keep_spike]
+    mask = (V[peaks] >= min_peak) & ((V[peaks] - V[spikes]) >= min_height)
+    spikes, peaks, sweep = spikes[mask], peaks[mask], sweep[mask]
+    if not spikes.size:
+        return [pd.DataFrame() for _ in range(n_sweeps)]
+
+    #=== upstrokes and thresholds
+    upstrokes = _seg_argext(D, spikes, peaks)
+    upstrokes = np.where(upstrokes < 0, spikes, upstrokes)
+    target = (_sweep_mean(D[upstrokes], sweep, n_sweeps) * thresh_frac)[sweep]
+    prev = _prev_in_sweep(upstrokes, sweep, row)
+    thresholds = _seg_reduce(D, lambda v, seg: v <= target[seg], prev + 1, upstrokes + 1, first=False)
+    thresholds = np.where(thresholds < 0, prev, thresholds)
+
+    #=== check_thresholds_and_peaks
+    if reject_at_stim_start_interval > 0:
+        mask = T[thresholds] > (start[sweep] + reject_at_stim_start_interval)
+        thresholds, peaks, upstrokes, sweep = thresholds[mask], peaks[mask], upstrokes[mask], sweep[mask]
+    same = sweep[1:] == sweep[:-1]
+    overlaps = np.flatnonzero(same & (thresholds[1:] <= peaks[:-1] + 1))
+    if overlaps.size:
+        thresholds, sweep = np.delete(thresholds, overlaps + 1), np.delete(sweep, overlaps + 1)
+        peaks, upstrokes = np.delete(peaks, overlaps), np.delete(upstrokes, overlaps)
+    too_long = np.flatnonzero(T[peaks] - T[thresholds] >= max_interval)
+    if too_long.size:
+        thresholds, peaks, upstrokes, sweep = _fix_long_spikes(x, V, D, T, thresholds, peaks, upstrokes, sweep, too_long, max_interval, thresh_frac, n)
+    if not thresholds.size:
+        return [pd.DataFrame() for _ in range(n_sweeps)]
+    I = np.ascontiguousarray(np.broadcast_to(c, y.shape)).ravel() if c is not None else None
+    bounds = np.searchsorted(sweep, np.arange(n_sweeps + 1))
+    if times_only:
+        spike_dfs = [pd.DataFrame() for _ in range(n_sweeps)]
+        for s in np.unique(sweep):
+            sl = slice(bounds[s], bounds[s + 1])
+            spike_dfs[s] = spike_times_table(T, V, I, thresholds[sl], peaks[sl], row=row[s])
+        return spike_dfs
+    #a spike is clipped if the voltage never returns to threshold after the last peak of the sweep
+    last = _last_in_sweep(sweep)
+    clipped = np.zeros(sweep.shape[0], dtype=bool)
+    tail = _seg_reduce(V, lambda v, seg: v <= (V[thresholds[last]] + CLIP_TOL)[seg], peaks[last], (row + end_index + 1)[sweep[last]])
+    clipped[last] = tail < 0
+
+    #=== the other features
+    upstrokes = _seg_argext(D, thresholds, peaks)
+    upstrokes = np.where(upstrokes < 0, thresholds, upstrokes)
+    troughs = _seg_argext(V, peaks, _next_in_sweep(thresholds, sweep, row + end_index), fn=np.minimum).astype(np.float64)
+    troughs[(last & clipped) | (troughs < 0)] = np.nan
+    downstrokes = np.full(sweep.shape[0], np.nan)
+    valid = ~clipped & ~np.isnan(troughs)
+    downstrokes[valid] = _seg_argext(D, peaks[valid], troughs[valid].astype(np.int64), fn=np.minimum)
+    trough_details = _trough_details(x, y, V, D, T, thresholds, peaks, sweep, clipped, row + end_index, n)
+    isi_types, fast_troughs, adps, slow_troughs, clipped = trough_details
+    widths = _widths(V, T, thresholds, peaks, fast_troughs, clipped)
+
+    #=== pack the spike tables, one per sweep
+    spike_dfs = [pd.DataFrame() for _ in range(n_sweeps)]
+    for s in np.unique(sweep):
+        sl = slice(bounds[s], bounds[s + 1])
+        spike_dfs[s] = _spike_table(V, D, T, I, row[s], thresholds[sl], peaks[sl], troughs[sl], upstrokes[sl], downstrokes[sl], isi_types[s],
+                                    fast_troughs[sl], adps[sl], slow_troughs[sl], clipped[sl], widths[sl])
+    return spike_dfs
+
+def _fix_long_spikes(x, V, D, T, thresholds, peaks, upstrokes, sweep, too_long, max_interval, thresh_frac, n):
+    #the rare spikes whose peak is too far from threshold: re-find the threshold from the peak, or the peak from the threshold, else drop them.
+    #done spike by spike, the same as ipfx's check_thresholds_and_peaks
+    thresholds, peaks = thresholds.copy(), peaks.copy()
+    target = (_sweep_mean(D[upstrokes], sweep, x.shape[0]) * thresh_frac)[sweep]
+    last = _last_in_sweep(sweep)
+    drop = []
+    for i in too_long:
+        logger.info("Need to recalculate threshold-peak pair that exceeds maximum allowed interval ({:f} s)".format(max_interval))
+        s, row = sweep[i], sweep[i] * n
+        t_0 = np.argmin(np.abs(x[s] - (T[peaks[i]] - max_interval))) + row
+        below_target = np.flatnonzero(D[upstrokes[i]:t_0:-1] <= target[i])
+        if not below_target.size:
+            t_0 = np.argmin(np.abs(x[s] - (T[thresholds[i]] + 2 * max_interval))) + row
+            new_peak = np.argmax(V[thresholds[i]:t_0]) + thresholds[i]
+            if T[new_peak] - T[thresholds[i]] < max_interval and (last[i] or T[new_peak] < T[thresholds[i + 1]]):
+                peaks[i] = new_peak
+            else:
+                logger.info("Could not redetermine threshold-peak pair - dropping that pair")
+                drop.append(i)
+        else:
+            thresholds[i] = upstrokes[i] - below_target[0]
+    if drop:
+        thresholds, peaks, upstrokes, sweep = [np.delete(a, drop) for a in (thresholds, peaks, upstrokes, sweep)]
+    return thresholds, peaks, upstrokes, sweep
+
+def _trough_details(x, y, V, D, T, thresholds, peaks, sweep, clipped, end_index, n):
+    #ipfx's analyze_trough_details for all the spikes: the fast trough (end of the spike), the ADP, the slow trough and the isi type
+    n_spikes = sweep.shape[0]
+    fast, adp, slow = np.full(n_spikes, np.nan), np.full(n_spikes, np.nan), np.full(n_spikes, np.nan)
+    detour = np.zeros(n_spikes, dtype=bool)
+    orig_clipped = clipped
+    clipped = clipped.copy()
+    valid = np.flatnonzero(~clipped)
+    if valid.size:
+        #heavily filtered dV/dt, only for the sweeps with spikes
+        spiking = np.unique(sweep)
+        D_hvy = np.full((x.shape[0], n), np.nan)
+        D_hvy[spiking, :-1] = block_dvdt(x[spiking], y[spiking], HEAVY_FILTER)
+        D_hvy = D_hvy.ravel()
+
+        v_sweep = sweep[valid]
+        nxt = _next_in_sweep(thresholds[valid], v_sweep, end_index)
+        pk = peaks[valid]
+        downstroke = _seg_argext(D, pk, nxt, fn=np.minimum)
+        target = TERM_FRAC * D[downstroke]
+        term = _seg_reduce(D, lambda v, seg: v >= target[seg], downstroke, nxt)
+        found = (downstroke >= 0) & (term >= 0)
+        clipped[valid[~found]] = True
+        valid, nxt, term = valid[found], nxt[found], term[found]
+        fast[valid] = term
+
+        #could there be an ADP?
+        cross = _seg_reduce(D_hvy, lambda v, seg: v >= ADP_THRESH, term, nxt)
+        maybe = (cross >= 0)
+        maybe[maybe] = T[cross[maybe]] - T[term[maybe]] < FLAT_INTERVAL
+        zero = np.full(valid.shape[0], -1)
+        zero[maybe] = _seg_reduce(D_hvy, lambda v, seg: v <= 0, cross[maybe], nxt[maybe])
+        maybe &= zero >= 0
+        min_adp = np.full(valid.shape[0], -1)
+        min_adp[maybe] = _seg_argext(V, zero[maybe], nxt[maybe], fn=np.minimum)
+        maybe[maybe] = ((V[zero[maybe]] - V[min_adp[maybe]] >= ADP_TOL) & (V[zero[maybe]] - V[term[maybe]] <= ADP_MAX_DELTA_V) &
+                        (T[zero[maybe]] - T[term[maybe]] <= ADP_MAX_DELTA_T))
+        adp[valid[maybe]] = zero[maybe]
+        slow[valid[maybe]] = min_adp[maybe]
+        detour[valid[maybe]] = True
+        #no ADP, but did the voltage keep dropping after the end of the spike?
+        min_term = _seg_argext(V, term, nxt, fn=np.minimum)
+        drop = ~maybe & (V[term] - V[min_term] >= ADP_TOL)
+        slow[valid[drop]] = min_term[drop]
+        detour[valid[drop]] = True
+
+    #the ADP and slow trough of the last spike of a sweep are not reliable, ipfx drops them
+    last = _last_in_sweep(sweep)
+    adp[last] = np.nan
+    slow[last] = np.nan
+
+    #the isi types, built per sweep the way ipfx does, so the dtypes match
+    isi_types = {}
+    bounds = np.searchsorted(sweep, np.arange(sweep.max() + 2)) if n_spikes else []
+    for s in np.unique(sweep):
+        sl = np.arange(bounds[s], bounds[s + 1])
+        types = np.array([np.nan if np.isnan(fast[i]) else ("detour" if detour[i] else "direct") for i in sl if not orig_clipped[i]])
+        if np.any(orig_clipped[sl]):
+            types = np.append(types, np.zeros(np.count_nonzero(orig_clipped[sl])) * np.nan)
+        isi_types[s] = types
+    return isi_types, fast, adp, slow, clipped
+
+def _widths(V, T, thresholds, peaks, troughs, clipped):
+    #ipfx's find_widths for all the spikes: the full width at half height (trough to peak, or threshold to peak if the trough is above threshold)
+    widths = np.full(thresholds.shape[0], np.nan)
+    use = ~np.isnan(troughs) & ~clipped
+    if not np.any(use):
+        return widths
+    spk, pk, tr = thresholds[use], peaks[use], troughs[use].astype(np.int64)
+    levels = (V[pk] - V[tr]) / 2. + V[tr]
+    below = levels < V[spk]
+    levels[below] = ((V[pk] - V[spk]) / 2. + V[spk])[below]
+    width_starts = _seg_reduce(V, lambda v, seg: v <= levels[seg], spk + 1, pk + 1, first=False)
+    width_ends = _seg_reduce(V, lambda v, seg: v <= levels[seg], pk, tr)
+    found = (width_starts >= 0) & (width_ends >= 0)
+    w = np.full(spk.shape[0], np.nan)
+    w[found] = T[width_ends[found]] - T[width_starts[found]]
+    widths[use] = w
+    return widths
+
+def spike_times_table(T, V, I, thresholds, peaks, row=0):
+    """ The threshold and peak columns of the spike table of one sweep, same values, order and dtypes as ipfx's SpikeFeatureExtractor.process.
+    For when only the spike times are needed, and the troughs, widths etc. are not computed
+    takes:
+        T, V, I (np.array): The time, voltage and current (or None) of the sweep, or of a flattened block of sweeps
+        thresholds, peaks (np.array): The indexes of the thresholds and peaks of the spikes, into T, V and I
+        row (int): The index of the first sample of the sweep into T, V and I. Defaults to 0
+    returns:
+        spikes_df (pd.DataFrame): threshold_index, threshold_t, threshold_v, (threshold_i), peak_index, peak_t, peak_v, (peak_i)
+    """
+    spikes_df = {}
+    for k, indexes in (("threshold", thresholds), ("peak", peaks)):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        spikes_df[k + "_index"] = indexes - row
+        spikes_df[k + "_t"] = T[indexes]
+        spikes_df[k + "_v"] = V[indexes]
+        if I is not None:
+            spikes_df[k + "_i"] = I[indexes]
+    return pd.DataFrame(spikes_df)
+
+def _spike_table(V, D, T, I, row, thresholds, peaks, troughs, upstrokes, downstrokes, isi_types, fast_troughs, adps, slow_troughs, clipped, widths):
+    #the spike table of one sweep, same columns, order and dtypes as ipfx's SpikeFeatureExtractor.process
+    spikes_df = {}
+    def add_points(k, indexes, dvdt=False):
+        valid = ~np.isnan(indexes)
+        vals = indexes[valid].astype(np.int64)
+        #pandas keeps the dtype of the values (ints, float32 voltages) when ipfx fills every row of a column it set to nan first,
+        #or when it fills some rows of a new column (the _t / _v of the upstroke and downstroke)
+        full = np.all(valid)
+        spikes_df[k + "_index"] = vals - row if full else np.where(valid, indexes - row, np.nan)
+        def _column(source, new=False):
+            if full:
+                return source[vals]
+            column = np.full(indexes.shape[0], np.nan, dtype=source.dtype if new else np.float64)
+            column[valid] = source[vals]
+            return column
+        if dvdt:
+            spikes_df[k] = _column(D)
+            if len(vals) == 0:
+                return
+        for name, source in (("_t", T), ("_v", V), ("_i", None if dvdt else I)):
+            if source is not None:
+                spikes_df[k + name] = _column(source, new=dvdt)
+
+    spikes_df["threshold_index"] = None
+    spikes_df["clipped"] = clipped
+    add_points("threshold", thresholds.astype(np.float64))
+    add_points("peak", peaks.astype(np.float64))
+    add_points("trough", troughs)
+    add_points("upstroke", upstrokes.astype(np.float64), dvdt=True)
+    add_points("downstroke", downstrokes, dvdt=True)
+    spikes_df["isi_type"] = isi_types
+    add_points("fast_trough", fast_troughs)
+    add_points("adp", adps)
+    add_points("slow_trough", slow_troughs)
+    spikes_df["width"] = widths
+    spikes_df = pd.DataFrame(spikes_df)
+    spikes_df["upstroke_downstroke_ratio"] = spikes_df["upstroke"] / -spikes_df["downstroke"]
+    return spikes_df
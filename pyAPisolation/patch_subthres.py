@@ -1,4 +1,6 @@
 import sys
+import time
+import functools
 import numpy as np
 from numpy import genfromtxt
 import os
@@ -7,14 +9,302 @@ import matplotlib.pyplot as plt
 import scipy.signal as signal
 from scipy import interpolate
 from scipy.optimize import curve_fit
-from scipy.stats import mode
 from ipfx import subthresh_features as subt
 from ipfx import feature_extractor as fx
 from . import patch_utils
+from .dataset import cell_epochs
 import pyabf
 #from brian2.units import ohm, Gohm, amp, volt, mV, second, pA
 
 
+#=== analysis context ===
+class subthresContext(object):
+    """
+    The derived signals of one cell (or a subset of its sweeps), computed once, lazily, and shared by the subthreshold functions.
+    Any function decorated with accepts_context can be handed the context in place of its leading (dataT, dataV, dataI) arrays,
+    e.g. compute_sag(ctx, time_aft) is compute_sag(ctx.dataT, ctx.meanV, ctx.meanI, time_aft).
+    Takes:
+        dataT: 1d array, the time of the sweeps (a 2d array uses its first row)
+        dataV: 2d array (sweeps x samples), or 1d for a single sweep, the voltage
+        dataI: 2d array (sweeps x samples), or 1d for a single sweep, the current
+        indices: the sweeps (rows) to average, defaults to all of them
+    """
+    def __init__(self, dataT, dataV, dataI, indices=None):
+        dataT = np.asarray(dataT)
+        self.dataT = dataT[0] if dataT.ndim > 1 else dataT
+        self.dataV = np.atleast_2d(dataV)
+        self.dataI = np.atleast_2d(dataI)
+        self.indices = np.arange(self.dataV.shape[0]) if indices is None else np.asarray(indices)
+        self._meanV = None
+        self._meanI = None
+        self._diffI = None
+        self._epochs = None
+
+    @property
+    def meanV(self):
+        if self._meanV is None:
+            self._meanV = np.nanmean(self.dataV[self.indices, :], axis=0)
+        return self._meanV
+
+    @property
+    def meanI(self):
+        if self._meanI is None:
+            self._meanI = np.nanmean(self.dataI[self.indices, :], axis=0)
+        return self._meanI
+
+    @property
+    def dt(self):
+        return self.dataT[1] - self.dataT[0]
+
+    @property
+    def diffI(self):
+        if self._diffI is None:
+            self._diffI = np.diff(self.meanI)
+        return self._diffI
+
+    @property
+    def epochs(self):
+        #(downward, upward) the indices of the first negative and first positive step of the mean current, as found by the subthreshold functions
+        if self._epochs is None:
+            downward = np.nonzero(self.diffI < 0)[0]
+            upward = np.nonzero(self.diffI > 0)[0]
+            self._epochs = (downward[0] if len(downward) else None, upward[0] if len(upward) else None)
+        return self._epochs
+
+def accepts_context(*signals):
+    """ Lets the decorated function take a subthresContext in place of its leading array arguments.
+    signals names the context attributes that stand in for them, in order, e.g. ('dataT', 'meanV', 'meanI')
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if len(args) > 0 and isinstance(args[0], subthresContext):
+                args = tuple(getattr(args[0], name) for name in signals) + args[1:]
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#=== sweep block metrics ===
+#The per sweep metrics computed over a (sweeps x samples) block at once. Each is a reduction over index windows found for all the sweeps together
+#(from the steps of their current, or the stimulus epoch table), so a cell is a handful of array operations rather than a loop over its sweeps.
+#The scalar functions (rmp_mode, membrane_resistance, compute_sag, subthres_a) run the same code on a one sweep block.
+
+def _first_true(mask):
+    #the index of the first True of each row, -1 if there is none
+    if mask.shape[1] == 0:
+        return np.full(mask.shape[0], -1)
+    first = np.argmax(mask, axis=1)
+    return np.where(mask[np.arange(mask.shape[0]), first], first, -1)
+
+def step_indices(dataI):
+    """ Finds the steps of each sweep of a current block, as the scalar functions do with np.diff.
+    Takes:
+        dataI: 2d array (sweeps x samples), or 1d for a single sweep, the current
+    returns:
+        downward: 1d int array, the index of the first negative step of each sweep, -1 if there is none
+        upward: 1d int array, the index of the first positive step of each sweep, -1 if there is none
+        rise: 1d int array, the index of the largest step up of each sweep (np.argmax of its diff)
+    """
+    diff_I = np.diff(np.atleast_2d(dataI), axis=1)
+    rise = np.argmax(diff_I, axis=1) if diff_I.shape[1] > 0 else np.zeros(diff_I.shape[0], dtype=np.int64)
+    return _first_true(diff_I < 0), _first_true(diff_I > 0), rise
+
+def _window(length, start, stop):
+    #(sweeps x samples) mask of the per sweep windows [start:stop), with python slice semantics (negative indices count from the end)
+    start = np.clip(np.where(start < 0, start + length, start), 0, length)
+    stop = np.clip(np.where(stop < 0, stop + length, stop), 0, length)
+    idx = np.arange(length)
+    return (idx >= start[:, None]) & (idx < stop[:, None])
+
+def _window_mean(data, window, skipna=False):
+    #the per sweep mean of data over the window, nan where it is empty (as np.mean / np.nanmean of an empty slice)
+    if skipna:
+        window = window & ~np.isnan(data)
+    sums = np.sum(np.where(window, data, 0), axis=1, dtype=np.float64)
+    counts = np.sum(window, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def _time_index(t, t_0):
+    #tsu.find_time_index for a vector of times, returns the indices and whether each time is within t (the function asserts it)
+    t_0 = np.asarray(t_0)
+    in_range = (t[0] <= t_0) & (t_0 <= t[-1])
+    return np.argmin(np.abs(t[None, :] - t_0[:, None]), axis=1), in_range
+
+def rmp_mode_block(dataV, dataI, downward=None):
+    """ The resting membrane potential of each sweep, the mode of its voltage (rounded to 0.25 mV) before its first negative step.
+    Takes:
+        dataV: 2d array (sweeps x samples), the voltage
+        dataI: 2d array (sweeps x samples), the current
+        downward: 1d int array, the index of the first negative step of each sweep (-1 if none). Defaults to step_indices(dataI)
+    returns:
+        rmp: 1d array, nan for the sweeps without a negative step
+    """
+    dataV = np.atleast_2d(dataV)
+    if downward is None:
+        downward = step_indices(dataI)[0]
+    downward = np.asarray(downward)
+    rows = np.arange(dataV.shape[0])
+    stop = np.where(downward >= 0, downward, 0)
+    width = int(np.max(stop, initial=0))
+    if width == 0:
+        return np.full(dataV.shape[0], np.nan)
+    idx = np.arange(width)
+    values = np.round(dataV[:, :width] * 4) / 4
+    values = np.where((idx < stop[:, None]) & ~np.isnan(values), values, np.inf)
+    values.sort(axis=1)
+    #count along the runs of equal values, the first position of the longest run is the mode (the smallest value on a tie, as scipy.stats.mode)
+    run_start = np.ones(values.shape, dtype=bool)
+    run_start[:, 1:] = values[:, 1:] != values[:, :-1]
+    run_start = np.maximum.accumulate(np.where(run_start, idx, 0), axis=1)
+    counts = np.where(np.isfinite(values), idx - run_start + 1, 0)
+    best = np.argmax(counts, axis=1)
+    return np.where(counts[rows, best] > 0, values[rows, best], np.nan)
+
+def membrane_resistance_block(dataT, dataV, dataI, downward=None, rise=None):
+    """ The input resistance of each sweep, from the voltage drop (100 samples away from the edges) over its first negative step.
+    Takes:
+        dataT: 1d array, the time of the sweeps
+        dataV: 2d array (sweeps x samples), the voltage
+        dataI: 2d array (sweeps x samples), the current
+        downward, rise: 1d int arrays, the first negative step and the largest step up of each sweep. Default to step_indices(dataI)
+    returns:
+        resistance: 1d array, in ohms, nan for the sweeps without a negative step
+    """
+    dataV, dataI = np.atleast_2d(dataV), np.atleast_2d(dataI)
+    if downward is None or rise is None:
+        steps = step_indices(dataI)
+        downward = steps[0] if downward is None else downward
+        rise = steps[2] if rise is None else rise
+    downward, rise = np.asarray(downward), np.asarray(rise)
+    length = dataV.shape[1]
+    found = downward >= 0
+    down = np.where(found, downward, 0)
+    end_index = down + np.trunc((rise - down) / 2).astype(np.int64)
+    upperC = _window_mean(dataV, _window(length, np.zeros_like(down), down - 100))
+    lowerC = _window_mean(dataV, _window(length, down + 100, end_index - 100))
+    diff = -1 * np.abs(upperC - lowerC)
+    I_lower = dataI[np.arange(dataI.shape[0]), np.minimum(down + 1, dataI.shape[1] - 1)]
+    #v = IR
+    #r = v/I
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (diff / 1000) / (I_lower / 1000000000000) #mv -> V, pA -> A
+    return np.where(found, r, np.nan) #in ohms
+
+def _sag_windows(dataT, dataV, dataI, time_aft, downward=None, upward=None):
+    #the windows compute_sag measures in, for each sweep. returns a dict of per sweep arrays, valid is False where the sag can not be measured
+    dataV = np.atleast_2d(dataV)
+    if downward is None or upward is None:
+        steps = step_indices(dataI)
+        downward = steps[0] if downward is None else downward
+        upward = steps[1] if upward is None else upward
+    downward, upward = np.asarray(downward), np.asarray(upward)
+    time_aft = time_aft / 100
+    if time_aft > 1:
+        time_aft = 1
+    length = dataV.shape[1]
+    rows = np.arange(dataV.shape[0])
+    dt = dataT[1] - dataT[0] #in s
+    end_index = upward - int(0.100/dt)
+    end_index2 = upward - np.trunc((upward - downward) * time_aft).astype(np.int64)
+    end_index = np.where(end_index < downward, upward - 5, end_index)
+    vm = _window_mean(dataV, _window(length, end_index, upward), skipna=True)
+    min_window = _window(length, downward, end_index2)
+    min_point = np.argmin(np.where(min_window, dataV, np.inf), axis=1)
+    avg_min = dataV[rows, min_point]
+    valid = (downward >= 0) & (upward >= 0) & min_window.any(axis=1)
+    return {'downward': downward, 'upward': upward, 'end_index': end_index, 'min_point': min_point, 'valid': valid,
+            'sag': np.where(valid, avg_min - vm, np.nan), 'min': np.where(valid, avg_min, np.nan)}
+
+def compute_sag_block(dataT, dataV, dataI, time_aft, downward=None, upward=None):
+    """ The voltage sag of each sweep, the minimum over the start of the hyperpolarizing step (time_aft percent of it) less the mean voltage of its last 100 ms.
+    Takes:
+        dataT: 1d array, the time of the sweeps
+        dataV: 2d array (sweeps x samples), the voltage
+        dataI: 2d array (sweeps x samples), the current
+        time_aft: the percent of the step to search for the minimum in
+        downward, upward: 1d int arrays, the first negative and positive step of each sweep. Default to step_indices(dataI)
+    returns:
+        sag: 1d array, nan for the sweeps where it can not be measured
+        min: 1d array, the minimum voltage of each sweep
+    """
+    windows = _sag_windows(dataT, dataV, dataI, time_aft, downward=downward, upward=upward)
+    return windows['sag'], windows['min']
+
+def subthres_a_block(dataT, dataV, dataI, lowerlim, upperlim, epochs=None):
+    """ subthres_a for a block of sweeps. The sag ratio and the voltage deflection are measured as the ipfx functions do, over all the sweeps at once;
+    the membrane time constant is a fit, run per sweep (subt.time_constant).
+    Takes:
+        dataT: 1d array, the time of the sweeps
+        dataV: 2d array (sweeps x samples), the voltage
+        dataI: 2d array (sweeps x samples), the current
+        lowerlim, upperlim: unused, kept for subthres_a
+        epochs: stimEpochs, the stimulus epoch table of the block (one sweep per row). Defaults to None, scanning dataI
+    returns:
+        sag, taum, deflection: 1d arrays, nan for the sweeps that are not hyperpolarized or can not be measured
+        deflection_index: 1d int array, the index of the voltage deflection, -1 for those sweeps
+    """
+    dataT = np.asarray(dataT)
+    dataV, dataI = np.atleast_2d(dataV), np.atleast_2d(dataI)
+    n_sweeps, length = dataV.shape
+    rows = np.arange(n_sweeps)
+    nan = np.full(n_sweeps, np.nan)
+    #the hyperpolarizing segment of each sweep
+    if epochs is not None:
+        hyperpolarized = np.array([epochs.points(k, -1) > 0 for k in rows], dtype=bool)
+        segments = [epochs.segment(k, -1) for k in rows]
+        dwninf = np.array([-1 if seg[0] is None else seg[0] for seg in segments], dtype=np.int64)
+        upinf = np.array([-1 if seg[1] is None else seg[1] for seg in segments], dtype=np.int64)
+    else:
+        hyperpolarized = dataI[rows, np.argmin(dataI, axis=1)] < 0
+        negative = dataI < 0
+        dwninf = _first_true(negative)
+        upinf = np.where(dwninf >= 0, dataI.shape[1] - 1 - _first_true(negative[:, ::-1]), -1)
+    valid = hyperpolarized & (dwninf >= 0)
+    lowerlim_t = np.clip(dataT[np.maximum(dwninf, 0)] - 0.1, 0, 1e9)
+    upperlim_t = dataT[np.maximum(upinf, 0)]
+
+    #subt.sag and subt.voltage_deflection, each find_time_index is only valid (does not assert) within the sweep
+    start_index, in_range = _time_index(dataT, lowerlim_t)
+    valid &= in_range
+    end_index, in_range = _time_index(dataT, upperlim_t)
+    valid &= in_range
+    deflect_window = _window(length, start_index, end_index)
+    valid &= deflect_window.any(axis=1)
+    min_index = np.argmin(np.where(deflect_window, dataV, np.inf), axis=1)
+    max_index = np.argmax(np.where(deflect_window, dataV, -np.inf), axis=1)
+    peak_start, in_range = _time_index(dataT, dataT[min_index] - 0.005 / 2.)
+    valid &= in_range
+    peak_end, in_range = _time_index(dataT, dataT[min_index] + 0.005 / 2.)
+    valid &= in_range
+    baseline_start, in_range = _time_index(dataT, lowerlim_t - 0.03)
+    valid &= in_range
+    steady_start, in_range = _time_index(dataT, upperlim_t - 0.03)
+    valid &= in_range
+    v_peak_avg = _window_mean(dataV, _window(length, peak_start, peak_end))
+    v_baseline = _window_mean(dataV, _window(length, baseline_start, start_index))
+    v_steady = _window_mean(dataV, _window(length, steady_start, end_index))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sag = (v_peak_avg - v_steady) / (v_peak_avg - v_baseline)
+    #the deflection is a max if the current is not negative halfway through the segment
+    halfway, in_range = _time_index(dataT, (upperlim_t - lowerlim_t) / 2. + lowerlim_t)
+    valid &= in_range
+    deflection_index = np.where(dataI[rows, halfway] >= 0, max_index, min_index)
+
+    for k in np.flatnonzero(hyperpolarized & ~valid):
+        print("Subthreshold Processing Error ")
+        print(f"sweep {k}: the hyperpolarizing segment is not within the sweep")
+    taum = nan.copy()
+    for k in np.flatnonzero(valid):
+        try:
+            taum[k] = subt.time_constant(dataT, dataV[k], dataI[k], start=lowerlim_t[k], end=upperlim_t[k])
+        except Exception as e:
+            print("Subthreshold Processing Error ")
+            print(e.args)
+            valid[k] = False
+    return (np.where(valid, sag, nan), np.where(valid, taum, nan), np.where(valid, dataV[rows, deflection_index], nan),
+            np.where(valid, deflection_index, -1))
+
 ##Declare our options at default
 
 def exp_grow(t, a, b, alpha):
@@ -26,11 +316,20 @@ def exp_decay_2p(t, a, b1, alphaFast, b2, alphaSlow):
 def exp_decay_1p(t, a, b1, alphaFast):
     return a + b1*np.exp(-alphaFast*t)
 
+def exp_decay_2p_jac(t, a, b1, alphaFast, b2, alphaSlow):
+    e1, e2 = np.exp(-alphaFast*t), np.exp(-alphaSlow*t)
+    return np.stack((np.ones_like(t), e1, -b1*t*e1, e2, -b2*t*e2), axis=1)
+
+def exp_decay_1p_jac(t, a, b1, alphaFast):
+    e1 = np.exp(-alphaFast*t)
+    return np.stack((np.ones_like(t), e1, -b1*t*e1), axis=1)
+
 def rm_decay_2p(t, Iinj, Rm, alphaFast, Re, alphaSlow, a):
     v = a + (Iinj * (Rm * (1 - np.exp(-t/alphaFast)) + Re * (1 - np.exp(-t/alphaSlow))))
     v = v * 1000#in Volts to mV
     return v
 
+@accepts_context('dataT', 'meanV', 'meanI')
 def exp_growth_factor(dataT,dataV,dataI, alpha, end_index=1, plot=False):
     try:
         dt = dataT[1] - dataT[0]
@@ -67,17 +366,18 @@ def deriv(x,y):
     xfirst=0.5*(x[:-1]+x[1:])
     return xfirst, yfirst
 
+@accepts_context('meanV', 'meanI')
 def rmp_mode(dataV, dataI):
 
     pre = find_downward(dataI)
-
-    mode_vm = mode(np.round(dataV[:pre]*4)/4, nan_policy='omit')[0][0]
+    mode_vm = rmp_mode_block(dataV, dataI, downward=[pre])[0]
     return mode_vm
 
 def mem_resist_alt(cm_alt, slow_decay):
     rm_alt = cm_alt / slow_decay
     return 1/rm_alt
 
+@accepts_context('dataT', 'meanV', 'meanI')
 def exp_rm_factor(dataT,dataV,dataI, time_aft, decay_slow, abf_id='abf', plot=False, root_fold=''):
     try:
         time_aft = time_aft / 100
@@ -125,30 +425,199 @@ def find_downward(dataI):
     downwardinfl = np.nonzero(np.where(diff_I<0, diff_I, 0))[0][0]
     return downwardinfl
 
-def exp_decay_factor(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False, root_fold=''):
+#=== decay fits ===
+#the decay fits start from exp_decay_p0 rather than scipy's default guess (all ones), and run through fit_curve, with an evaluation / time budget
+FIT_MAX_NFEV = 50000 #evaluations of the model per fit
+FIT_MAX_TIME = None #seconds per fit, None for no limit
+
+class _fitBudgetExceeded(Exception):
+    pass
+
+def exp_decay_p0(t, v, n_phases=2, rates=None, fast_bounds=(0, np.inf)):
+    """ A deterministic initial guess for exp_decay_1p (n_phases=1) or exp_decay_2p (n_phases=2). For every decay rate (or pair of rates) of a grid,
+    the offset and amplitudes are solved by linear least squares, and the best fitting rates are kept (variable projection over the grid).
+    takes:
+        t (np.array): the time of the trace, from 0 (s)
+        v (np.array): the voltage of the trace, or one row per trace sharing t. The grid is then set up once for all of them
+        n_phases (int): 1 or 2
+        rates (np.array): the grid of decay rates to try (1/s). Defaults to 48 log spaced rates from 0.1 to 1000
+        fast_bounds (tuple): only try fast rates within these bounds, to match those of the fit
+    returns:
+        p0 (np.array): (a, b1, alphaFast) or (a, b1, alphaFast, b2, alphaSlow), the fast phase first. One row per trace if v is 2d
+    """
+    #a guess does not need every sample, a couple thousand evenly spaced ones will do
+    step = max(len(t) // 2000, 1)
+    t = np.asarray(t, dtype=np.float64)[::step]
+    v = np.asarray(v, dtype=np.float64)
+    V = np.atleast_2d(v)[:, ::step]
+    rates = np.geomspace(0.1, 1000, 48) if rates is None else np.asarray(rates, dtype=np.float64)
+    X = np.hstack((np.ones((t.shape[0], 1)), np.exp(-np.outer(t, rates))))
+    G = X.T @ X
+    r = X.T @ V.T
+    if n_phases == 1:
+        cols = np.stack((np.zeros(rates.shape[0], dtype=np.int64), np.arange(1, rates.shape[0] + 1)), axis=1)
+    else:
+        slow, fast = np.triu_indices(rates.shape[0], k=1)
+        in_bounds = (rates[fast] >= fast_bounds[0]) & (rates[fast] <= fast_bounds[1])
+        if np.any(in_bounds):
+            slow, fast = slow[in_bounds], fast[in_bounds]
+        cols = np.stack((np.zeros(slow.shape[0], dtype=np.int64), fast + 1, slow + 1), axis=1)
+    #the normal equations of every rate combination (and trace) at once, with a touch of ridge so nearly equal rates do not make them singular
+    A = G[cols[:, :, None], cols[:, None, :]]
+    A = A + np.eye(cols.shape[1]) * (1e-12 * np.trace(G) / G.shape[0])
+    b = r[cols]
+    coef = np.linalg.solve(A, b)
+    sse = np.sum(V * V, axis=1) - np.sum(b * coef, axis=1)
+    best = np.nanargmin(sse, axis=0)
+    traces = np.arange(V.shape[0])
+    coef, alphas = coef[best, :, traces], rates[cols[best, 1:] - 1]
+    if n_phases == 1:
+        p0 = np.column_stack((coef[:, 0], coef[:, 1], alphas[:, 0]))
+    else:
+        p0 = np.column_stack((coef[:, 0], coef[:, 1], alphas[:, 0], coef[:, 2], alphas[:, 1]))
+    return p0 if v.ndim > 1 else p0[0]
+
+def fit_curve(func, t, v, p0, bounds=(-np.inf, np.inf), max_nfev=None, max_time=None, presample=2000, **kwargs):
+    """ scipy.optimize.curve_fit with an evaluation and time budget. Rather than raising, it returns the best parameters found and how the fit ended.
+    Traces longer than presample points are first fit on an evenly spaced subsample, and the full fit starts from there, so it only has a few steps left to take.
+    takes:
+        func, t, v, p0, bounds, kwargs: as in curve_fit. p0 is clipped to the bounds
+        max_nfev (int): the maximum number of evaluations of func per fit, including those for the jacobian (a call of an analytic jac counts as one). Defaults to FIT_MAX_NFEV
+        max_time (float): the maximum time for the whole fit in seconds. Defaults to FIT_MAX_TIME
+        presample (int): the length of the subsample fit first, None to fit the full trace only. Defaults to 2000
+    returns:
+        popt (np.array): the fitted parameters, or the best found before the budget ran out (NaN if the fit failed)
+        status (str): 'converged', 'max_nfev' (the evaluation budget ran out), 'timeout', or 'failed'
+    """
+    max_nfev = FIT_MAX_NFEV if max_nfev is None else max_nfev
+    max_time = FIT_MAX_TIME if max_time is None else max_time
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    t = np.asarray(t, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    p0 = np.clip(np.asarray(p0, dtype=np.float64), *[np.broadcast_to(bound, len(p0)) for bound in bounds])
+    if presample is not None and len(t) > 2 * presample:
+        step = len(t) // presample
+        popt, status = _fit_curve(func, t[::step], v[::step], p0, bounds, max_nfev, deadline, kwargs)
+        if status == 'timeout':
+            return popt, status
+        if np.all(np.isfinite(popt)):
+            p0 = popt
+    return _fit_curve(func, t, v, p0, bounds, max_nfev, deadline, kwargs)
+
+def _fit_curve(func, t, v, p0, bounds, max_nfev, deadline, kwargs):
+    state = {'nfev': 0, 'best': None, 'best_sse': np.inf}
+    def _spend():
+        #every call of the model or its jacobian comes out of the same budget
+        if state['nfev'] >= max_nfev:
+            raise _fitBudgetExceeded('max_nfev')
+        if deadline is not None and time.perf_counter() > deadline:
+            raise _fitBudgetExceeded('timeout')
+        state['nfev'] += 1
+    def _func(t, *params):
+        _spend()
+        out = func(t, *params)
+        residuals = out - v
+        sse = np.dot(residuals, residuals)
+        if sse < state['best_sse']:
+            state['best'], state['best_sse'] = np.array(params), sse
+        return out
+    if callable(kwargs.get('jac')):
+        jac = kwargs['jac']
+        def _jac(t, *params):
+            _spend()
+            return jac(t, *params)
+        kwargs = dict(kwargs, jac=_jac)
+    try:
+        popt, _ = curve_fit(_func, t, v, p0=p0, bounds=bounds, maxfev=max_nfev, **kwargs)
+        return popt, 'converged'
+    except _fitBudgetExceeded as e:
+        status = str(e)
+    except RuntimeError:
+        #scipy's own evaluation limit
+        status = 'max_nfev'
+    except Exception:
+        return np.full(len(p0), np.nan), 'failed'
+    if state['best'] is None:
+        return np.full(len(p0), np.nan), 'failed'
+    return state['best'], status
+
+def _fit_decay_2p(t, v, p0, bounds, curve_1p, max_nfev=None, max_time=None):
+    #fits exp_decay_2p with the fast phase bounded. The two phase model holds the one phase one (b1 = 0), so if it fits worse than curve_1p
+    #it is stuck in a local minimum, and is given a second start from the one phase fit.
+    #At b1 = 0 the fit has no gradient in alphaFast, which would never move off its guess, so both starts put the fast amplitude just above its bound
+    def _lift_fast(p0):
+        p0 = np.clip(np.asarray(p0, dtype=np.float64), bounds[0], bounds[1])
+        if not p0[1] > bounds[0][1]:
+            p0[1] = bounds[0][1] + 0.01 * np.abs(p0[3])
+        return p0
+    curve, status = fit_curve(exp_decay_2p, t, v, _lift_fast(p0), bounds=bounds, max_nfev=max_nfev, max_time=max_time, jac=exp_decay_2p_jac, xtol=None)
+    def _sse(func, params):
+        residuals = v - func(t, *params)
+        return np.dot(residuals, residuals)
+    if np.all(np.isfinite(curve_1p)) and not _sse(exp_decay_2p, curve) <= _sse(exp_decay_1p, curve_1p):
+        p0 = _lift_fast((curve_1p[0], 0, bounds[0][2], curve_1p[1], curve_1p[2]))
+        retry, retry_status = fit_curve(exp_decay_2p, t, v, p0, bounds=bounds, max_nfev=max_nfev, max_time=max_time, jac=exp_decay_2p_jac, xtol=None)
+        if _sse(exp_decay_2p, retry) < _sse(exp_decay_2p, curve):
+            curve, status = retry, retry_status
+    return curve, status
+
+def _fast_phase_resolved(t, v, curve):
+    #the fast phase of a two phase fit is only resolved if it explains more of the trace than the noise variance of a single sample
+    #(and than a millionth of the trace's variance, for noiseless traces). Below that its amplitude is about 0, and its rate is wherever the fit happened to stop
+    fast = curve[1] * np.exp(-curve[2] * t)
+    residuals = v - exp_decay_2p(t, *curve)
+    noise = np.dot(residuals, residuals) / max(len(t) - len(curve), 1)
+    return np.dot(fast, fast) > max(noise, 1e-6 * np.sum((v - np.mean(v))**2))
+
+def _decay_window(dataI, time_aft):
+    #the fit window of exp_decay_factor, from the start of the hyperpolarizing step to time_aft percent of it
+    time_aft = min(time_aft / 100, 1)
+    diff_I = np.diff(dataI)
+    downwardinfl = np.nonzero(np.where(diff_I<0, diff_I, 0))[0][0]
+    end_index = downwardinfl + int((np.argmax(diff_I)- downwardinfl) * time_aft)
+    return downwardinfl, end_index
+
+def _decay_r_squared(t1, v, func, params):
+    residuals = v - func(t1, *params)
+    return 1 - np.sum(residuals**2) / np.sum((v - np.mean(v))**2)
+
+def _fit_decays(t1, v, p0_2p, p0_1p, max_nfev=None, max_time=None, presample=2000, fallback_2p=None, fallback_1p=None, jac=False):
+    #the two and one phase fits of exp_decay_factor, returns curve, curve2, r_squared_2p, r_squared_1p, status
+    #a fit that does not converge, or does not improve on its fallback guess (by 1e-6 of the variance), is redone from the fallback.
+    #On a flat trace no start improves on any other, and this gives the same fit as starting from the fallback in the first place.
+    #The analytic jacobians are off by default, with the slow phase unbounded they let the fit chase alphaSlow off to infinity on flat traces
+    def _fit(func, p0, fallback, func_jac, **kwargs):
+        curve, status = fit_curve(func, t1, v, p0, max_nfev=max_nfev, max_time=max_time, presample=presample, **(dict(kwargs, jac=func_jac) if jac else kwargs))
+        if fallback is not None:
+            fallback = np.clip(fallback, *kwargs.get('bounds', (-np.inf, np.inf)))
+        if fallback is not None and (status != 'converged' or not _decay_r_squared(t1, v, func, curve) > _decay_r_squared(t1, v, func, fallback) + 1e-6):
+            retry, retry_status = fit_curve(func, t1, v, fallback, max_nfev=max_nfev, max_time=max_time, **kwargs)
+            if not _decay_r_squared(t1, v, func, curve) > _decay_r_squared(t1, v, func, retry) + 1e-6:
+                curve, status = retry, retry_status
+        return curve, status
+    status = {}
+    curve, status['2p'] = _fit(exp_decay_2p, p0_2p, fallback_2p, exp_decay_2p_jac, bounds=([-np.inf,  0, 0.1,  0, 0], [np.inf, np.inf, 500, np.inf, np.inf]), xtol=None)
+    if curve[4] > curve[2] and curve[4] <= 500:
+        #keep the fast phase first
+        curve = curve[[0, 3, 4, 1, 2]]
+    curve2, status['1p'] = _fit(exp_decay_1p, p0_1p, fallback_1p, exp_decay_1p_jac)
+    return curve, curve2, _decay_r_squared(t1, v, exp_decay_2p, curve), _decay_r_squared(t1, v, exp_decay_1p, curve2), status
+
+@accepts_context('dataT', 'meanV', 'meanI')
+def exp_decay_factor(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False, root_fold='', max_nfev=None, max_time=None, return_status=False):
+     """ Fits the one and two phase exponential decays to the voltage response to a hyperpolarizing step.
+     The fits start from exp_decay_p0, with an evaluation / time budget per fit (max_nfev, max_time, see fit_curve).
+     If return_status, also returns the status of each fit {'2p': ..., '1p': ...}, 'converged', 'max_nfev', 'timeout' or 'failed'
+     """
+     status = {'2p': 'failed', '1p': 'failed'}
      try:
-        time_aft = time_aft / 100
-        if time_aft > 1:
-            time_aft = 1
-
-        diff_I = np.diff(dataI)
-        downwardinfl = np.nonzero(np.where(diff_I<0, diff_I, 0))[0][0]
-        end_index = downwardinfl + int((np.argmax(diff_I)- downwardinfl) * time_aft)
+        downwardinfl, end_index = _decay_window(dataI, time_aft)
         
         upperC = np.amax(dataV[downwardinfl:end_index])
         lowerC = np.amin(dataV[downwardinfl:end_index])
-        diff = np.abs(upperC - lowerC)
         t1 = dataT[downwardinfl:end_index] - dataT[downwardinfl]
-        SpanFast=(upperC-lowerC)*1*.01
-        curve, pcov_2p = curve_fit(exp_decay_2p, t1, dataV[downwardinfl:end_index], maxfev=50000,  bounds=([-np.inf,  0, 0.1,  0, 0], [np.inf, np.inf, 500, np.inf, np.inf]), xtol=None)
-        curve2, pcov_1p = curve_fit(exp_decay_1p, t1, dataV[downwardinfl:end_index], maxfev=50000,  bounds=(-np.inf, np.inf))
-        residuals_2p = dataV[downwardinfl:end_index]- exp_decay_2p(t1, *curve)
-        residuals_1p = dataV[downwardinfl:end_index]- exp_decay_1p(t1, *curve2)
-        ss_res_2p = np.sum(residuals_2p**2)
-        ss_res_1p = np.sum(residuals_1p**2)
-        ss_tot = np.sum((dataV[downwardinfl:end_index]-np.mean(dataV[downwardinfl:end_index]))**2)
-        r_squared_2p = 1 - (ss_res_2p / ss_tot)
-        r_squared_1p = 1 - (ss_res_1p / ss_tot)
+        curve, curve2, r_squared_2p, r_squared_1p, status = _fit_decays(t1, dataV[downwardinfl:end_index], exp_decay_p0(t1, dataV[downwardinfl:end_index], 2),
+                                                                        exp_decay_p0(t1, dataV[downwardinfl:end_index], 1), max_nfev=max_nfev, max_time=max_time)
         if plot == True:
 
             plt.figure(2)
@@ -167,12 +636,86 @@ def exp_decay_factor(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False, root
         tau_1p = 1/curve2[2]
         fast = np.min([tau1, tau2])
         slow = np.max([tau1, tau2])
+        if return_status:
+            return tau1, tau2, curve, r_squared_2p, r_squared_1p, tau_1p, status
         return tau1, tau2, curve, r_squared_2p, r_squared_1p, tau_1p
      except:
+        if return_status:
+            return np.nan, np.nan, np.array([np.nan,np.nan,np.nan,np.nan,np.nan]), np.nan, np.nan, np.nan, status
         return np.nan, np.nan, np.array([np.nan,np.nan,np.nan,np.nan,np.nan]), np.nan, np.nan, np.nan
 
 
-def exp_decay_factor_alt(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False, root_fold=''):
+def exp_decay_factor_batch(dataT, dataV, dataI, time_aft, max_nfev=None, max_time=None, return_status=False):
+     """ exp_decay_factor for every sweep of a cell at once. The grid guesses of exp_decay_p0 are set up once for all the sweeps sharing a fit window.
+     The cell average is fit first, and each sweep's fits start from the decay rates of the previous sweep (or of the average), with the offset and
+     amplitudes solved for that sweep. Neighbouring sweeps differ little, so the fits only have a few steps left to take.
+     Rates are only passed on from fits that explain at least half the variance. A sweep with no usable warm start, or whose warm started fit does not
+     explain half its variance either (e.g. it has no decay to speak of), is fit as exp_decay_factor would.
+     takes:
+        dataT (np.array): the time, one sweep (shared by all) or one row per sweep
+        dataV, dataI (np.array): the voltage and current, one row per sweep
+        time_aft, max_nfev, max_time, return_status: as in exp_decay_factor
+     returns:
+        fits (list): the output of exp_decay_factor for each sweep, in order
+     """
+     dataV = np.atleast_2d(dataV)
+     dataI = np.atleast_2d(dataI)
+     shared_t = np.ndim(dataT) == 1
+     dataT = np.broadcast_to(dataT, dataV.shape)
+     def _seed(curve, curve2, r_squared_2p, r_squared_1p):
+        #the rates to warm start the next sweep from
+        if not (r_squared_2p >= 0.5 and r_squared_1p >= 0.5 and np.all(np.isfinite(curve)) and np.all(np.isfinite(curve2))):
+            return None
+        return np.sort(curve[[2, 4]]), curve2[[2]]
+     #the grid guesses, for all the sweeps with the same window (and time) at once
+     windows, cold = {}, {}
+     for i, sweepI in enumerate(dataI):
+        try:
+            window = _decay_window(sweepI, time_aft)
+        except Exception:
+            continue
+        windows.setdefault(window if shared_t else window + (i,), []).append(i)
+     for key, rows in windows.items():
+        start, end = key[:2]
+        t1 = dataT[rows[0], start:end] - dataT[rows[0], start]
+        for i, p0_2p, p0_1p in zip(rows, exp_decay_p0(t1, dataV[rows, start:end], 2), exp_decay_p0(t1, dataV[rows, start:end], 1)):
+            cold[i] = ((start, end), p0_2p, p0_1p)
+     average = exp_decay_factor(dataT[0], np.nanmean(dataV, axis=0), np.nanmean(dataI, axis=0), time_aft, max_nfev=max_nfev, max_time=max_time)
+     average_rates = _seed(average[2], np.array([np.nan, np.nan, 1 / average[5]]), average[3], average[4])
+     rates = average_rates
+     fits = []
+     for i, (sweepT, sweepV) in enumerate(zip(dataT, dataV)):
+        status = {'2p': 'failed', '1p': 'failed'}
+        out = (np.nan, np.nan, np.array([np.nan,np.nan,np.nan,np.nan,np.nan]), np.nan, np.nan, np.nan)
+        try:
+            (start, end), p0_2p, p0_1p = cold[i]
+            t1 = sweepT[start:end] - sweepT[start]
+            v = sweepV[start:end]
+            fit = None
+            if rates is not None:
+                #the warm started fits are redone cold if they do not fit, so they can use the analytic jacobians
+                fit = _fit_decays(t1, v, exp_decay_p0(t1, v, 2, rates=rates[0]), exp_decay_p0(t1, v, 1, rates=rates[1]), max_nfev=max_nfev, max_time=max_time,
+                                  presample=None, fallback_2p=p0_2p, fallback_1p=p0_1p, jac=True)
+            if fit is None or _seed(*fit[:4]) is None:
+                fit = _fit_decays(t1, v, p0_2p, p0_1p, max_nfev=max_nfev, max_time=max_time)
+            curve, curve2, r_squared_2p, r_squared_1p, status = fit
+            out = (1 / curve[2], 1 / curve[4], curve, r_squared_2p, r_squared_1p, 1 / curve2[2])
+            rates = _seed(curve, curve2, r_squared_2p, r_squared_1p)
+            rates = average_rates if rates is None else rates
+        except Exception:
+            #as exp_decay_factor, a sweep that can not be fit (e.g. no hyperpolarizing step) gives NaNs
+            pass
+        fits.append(out + (status,) if return_status else out)
+     return fits
+
+
+@accepts_context('dataT', 'meanV', 'meanI')
+def exp_decay_factor_alt(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False, root_fold='', max_nfev=None, max_time=None, return_status=False):
+     """ As exp_decay_factor, but fit over 10 - 95% of the way to the minimum voltage, with the fast phase bounded to 100 - 500 /s.
+     A two phase fit that ends up worse than the one phase fit is restarted from the latter (see _fit_decay_2p).
+     If the fast phase is not resolved (its amplitude is about 0), its rate and tau are NaN and the 2p status is 'degenerate'
+     """
+     status = {'2p': 'failed', '1p': 'failed'}
      try:
         time_aft = time_aft / 100
         if time_aft > 1:
@@ -193,9 +736,10 @@ def exp_decay_factor_alt(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False,
         SpanFast=(upperC-lowerC)*1*.01
 
         guess = (lowerC, diff, 50)
-        curve2, pcov_1p = curve_fit(exp_decay_1p, t1, dataV[downwardinfl:end_index], maxfev=50000, p0=guess,
-                                      bounds=([-np.inf, diff-15, 2], [np.inf, diff+15, 750]), xtol=None)
-        curve, pcov_2p = curve_fit(exp_decay_2p, t1, dataV[downwardinfl:end_index], maxfev=50000,  bounds=([-np.inf,  0, 100,  0, 0], [np.inf, np.inf, 500, np.inf, np.inf]), xtol=None)
+        curve2, status['1p'] = fit_curve(exp_decay_1p, t1, dataV[downwardinfl:end_index], guess,
+                                         bounds=([-np.inf, diff-15, 2], [np.inf, diff+15, 750]), max_nfev=max_nfev, max_time=max_time, jac=exp_decay_1p_jac, xtol=None)
+        curve, status['2p'] = _fit_decay_2p(t1, dataV[downwardinfl:end_index], exp_decay_p0(t1, dataV[downwardinfl:end_index], 2, fast_bounds=(100, 500)),
+                                            ([-np.inf,  0, 100,  0, 0], [np.inf, np.inf, 500, np.inf, np.inf]), curve2, max_nfev=max_nfev, max_time=max_time)
         
         residuals_2p = dataV[downwardinfl:end_index]- exp_decay_2p(t1, *curve)
         residuals_1p = dataV[downwardinfl:end_index]- exp_decay_1p(t1, *curve2)
@@ -204,6 +748,10 @@ def exp_decay_factor_alt(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False,
         ss_tot = np.sum((dataV[downwardinfl:end_index]-np.mean(dataV[downwardinfl:end_index]))**2)
         r_squared_2p = 1 - (ss_res_2p / ss_tot)
         r_squared_1p = 1 - (ss_res_1p / ss_tot)
+        if np.all(np.isfinite(curve)) and not _fast_phase_resolved(t1, dataV[downwardinfl:end_index], curve):
+            curve = curve.copy()
+            curve[2] = np.nan
+            status['2p'] = 'degenerate'
         if plot == True:
             end_index2 = downwardinfl + int((np.argmax(diff_I)- downwardinfl) * time_aft)
             t1 = dataT[downwardinfl:end_index2] - dataT[downwardinfl]
@@ -223,8 +771,12 @@ def exp_decay_factor_alt(dataT,dataV,dataI, time_aft, abf_id='abf', plot=False,
         tau_1p = 1/curve2[2]
         fast = np.min([tau1, tau2])
         slow = np.max([tau1, tau2])
+        if return_status:
+            return tau1, tau2, curve, r_squared_2p, r_squared_1p, tau_1p, status
         return tau1, tau2, curve, r_squared_2p, r_squared_1p, tau_1p
      except:
+        if return_status:
+            return np.nan, np.nan, np.array([np.nan,np.nan,np.nan,np.nan,np.nan]), np.nan, np.nan, np.nan, status
         return np.nan, np.nan, np.array([np.nan,np.nan,np.nan,np.nan,np.nan]), np.nan, np.nan, np.nan
 
 def df_select_by_col(df, string_to_find):
@@ -250,70 +802,36 @@ def df_select_by_col(df, string_to_find):
 
 
 
+@accepts_context('dataT', 'meanV', 'meanI')
 def compute_sag(dataT,dataV,dataI, time_aft, plot=False, clear=True):
-   try:
-         time_aft = time_aft / 100
-         if time_aft > 1:
-                time_aft = 1   
-         diff_I = np.diff(dataI)
-         upwardinfl = np.nonzero(np.where(diff_I>0, diff_I, 0))[0][0]
-         test = dataT[upwardinfl]
-         diff_I = np.diff(dataI)
-         downwardinfl = np.nonzero(np.where(diff_I<0, diff_I, 0))[0][0]
-         dt = dataT[1] - dataT[0] #in s
-         end_index = upwardinfl - int(0.100/dt)
-         end_index2 = upwardinfl - int((upwardinfl - downwardinfl) * time_aft)
-         if end_index<downwardinfl:
-             end_index = upwardinfl - 5
-         vm = np.nanmean(dataV[end_index:upwardinfl])
-         
-         min_point = downwardinfl + np.argmin(dataV[downwardinfl:end_index2])
-         test = dataT[downwardinfl]
-         test2 = dataT[end_index]
-         avg_min = np.nanmean(dataV[min_point])
-         sag_diff = avg_min - vm
-         sag_diff_plot = np.arange(avg_min, vm, 1)
-         if plot==True:
-             try:
-                 plt.figure(num=99)
-                 if clear:
-                    plt.clf()
-                 plt.plot(dataT[downwardinfl:int(upwardinfl+1000)], dataV[downwardinfl:int(upwardinfl + 1000)], label="Data")
-                 plt.scatter(dataT[min_point], dataV[min_point], c='r', marker='x', zorder=99, label="Min Point")
-                 plt.scatter(dataT[end_index:upwardinfl], dataV[end_index:upwardinfl], c='g', zorder=99, label="Mean Vm Measured")
-                 plt.plot(dataT[np.full(sag_diff_plot.shape[0], min_point, dtype=np.int64)], sag_diff_plot, label=f"Sag of {sag_diff}")
-                 #plt.legend()
-                 plt.pause(0.05)
-             except:
-                 print("plot fail")
-         
-         return sag_diff, avg_min
-   except:
-         return np.nan, np.nan
+    windows = _sag_windows(dataT, dataV, dataI, time_aft)
+    if not windows['valid'][0]:
+        return np.nan, np.nan
+    sag_diff, avg_min = windows['sag'][0], windows['min'][0]
+    if plot==True:
+        try:
+            downwardinfl, upwardinfl = windows['downward'][0], windows['upward'][0]
+            end_index, min_point = windows['end_index'][0], windows['min_point'][0]
+            sag_diff_plot = np.arange(avg_min, avg_min - sag_diff, 1)
+            plt.figure(num=99)
+            if clear:
+                plt.clf()
+            plt.plot(dataT[downwardinfl:int(upwardinfl+1000)], dataV[downwardinfl:int(upwardinfl + 1000)], label="Data")
+            plt.scatter(dataT[min_point], dataV[min_point], c='r', marker='x', zorder=99, label="Min Point")
+            plt.scatter(dataT[end_index:upwardinfl], dataV[end_index:upwardinfl], c='g', zorder=99, label="Mean Vm Measured")
+            plt.plot(dataT[np.full(sag_diff_plot.shape[0], min_point, dtype=np.int64)], sag_diff_plot, label=f"Sag of {sag_diff}")
+            #plt.legend()
+            plt.pause(0.05)
+        except:
+            print("plot fail")
+    return sag_diff, avg_min
         
 
 
 
+@accepts_context('dataT', 'meanV', 'meanI')
 def membrane_resistance(dataT,dataV,dataI):
-    try:
-        diff_I = np.diff(dataI)
-        downwardinfl = np.nonzero(np.where(diff_I<0, diff_I, 0))[0][0]
-        end_index = downwardinfl + int((np.argmax(diff_I)- downwardinfl)/2)
-        
-        upperC = np.mean(dataV[:downwardinfl-100])
-        lowerC = np.mean(dataV[downwardinfl+100:end_index-100])
-        diff = -1 * np.abs(upperC - lowerC)
-        I_lower = dataI[downwardinfl+1]
-        t1 = dataT[downwardinfl:end_index] - dataT[downwardinfl]
-        #v = IR
-        #r = v/I
-        v_ = diff / 1000 # in mv -> V
-        I_ = I_lower / 1000000000000 #in pA -> A
-        r = v_/I_
-
-        return r #in ohms
-    except: 
-        return np.nan
+    return membrane_resistance_block(dataT, dataV, dataI)[0] #in ohms
 
 def mem_cap(resist, tau_2p, tau_1p =np.nan):
     #tau = RC
@@ -327,15 +845,11 @@ def mem_cap_alt(resist, tau, b2, deflection):
     cm = tau / rm2
     return cm
 
-def determine_subt(abf, idx_bounds):
-    
-    dataC =[]
-    for sweep in abf.sweepList:
-        abf.setSweep(sweep)
-        sweepdiff = abf.sweepC[idx_bounds[0]:idx_bounds[1]]
-        dataC.append(sweepdiff)
-    dataC = np.vstack(dataC)
-    deflections = np.unique(np.where(dataC<0)[0])
+def determine_subt(abf, idx_bounds, epochs=None):
+    #the sweeps with a hyperpolarizing command within idx_bounds, read from the stimulus epoch table of the file (built from the abf if not given)
+    if epochs is None:
+        epochs = cell_epochs(abf)
+    deflections = epochs.sweeps_with(-1, idx_bounds[0], idx_bounds[1])
     return deflections
 
 def nonzero_1d(a):
@@ -397,7 +911,7 @@ def ladder_rm(dataT, dataV, dataI):
 
 
 
-def subthres_a(dataT, dataV, dataI, lowerlim, upperlim):
+def subthres_a(dataT, dataV, dataI, lowerlim, upperlim, epochs=None):
     """Analyze the subthreshold features of the current using allen institute's method.
 
     Args:
@@ -406,36 +920,17 @@ def subthres_a(dataT, dataV, dataI, lowerlim, upperlim):
         dataI (_type_): _description_
         lowerlim (_type_): _description_
         upperlim (_type_): _description_
+        epochs (stimEpochs, optional): the stimulus epoch table of this sweep (as its only sweep). Defaults to None, scanning dataI
 
     Returns:
         _type_: _description_
     """
-    if dataI[np.argmin(dataI)] < 0: #if the current is negative check
-                        try:
-                            if lowerlim < 0.1:
-                                b_lowerlim = 0.1
-                            else:
-                                b_lowerlim = 0.1
-
-                            #get only the hyperpor segments
-                            dwninf, upinf = find_hyperpolarization_segment(dataT, dataI, lowerlim, upperlim)
-                            lowerlim_t = np.clip(dataT[dwninf]  - 0.1, 0, 1e9)
-                            upperlim_t = dataT[upinf]
-
-                            #temp_spike_df['baseline voltage' + real_sweep_number] = subt.baseline_voltage(dataT, dataV, start=b_lowerlim)
-                            sag = subt.sag(dataT,dataV,dataI, start=lowerlim_t, end=upperlim_t)
-                            taum = subt.time_constant(dataT,dataV,dataI, start=lowerlim_t, end=upperlim_t)
-                            
-                            voltage_deflection = subt.voltage_deflection(dataT,dataV,dataI, start=lowerlim_t, end=upperlim_t)
-                            return sag, taum, voltage_deflection
-                        except Exception as e:
-                            print("Subthreshold Processing Error ")
-                            print(e.args)
-                            return np.nan, np.nan, [np.nan, np.nan]
-    else:
+    sag, taum, deflection, deflection_index = subthres_a_block(dataT, dataV, dataI, lowerlim, upperlim, epochs=epochs)
+    if deflection_index[0] < 0:
         return np.nan, np.nan, [np.nan, np.nan]
+    return sag[0], taum[0], (deflection[0], deflection_index[0])
 
-def find_hyperpolarization_segment(dataT, dataI, lowerlim, upperlim):
+def find_hyperpolarization_segment(dataT, dataI, lowerlim, upperlim, epochs=None):
     """Finds the hyperpolarization segment, assuming the current is a square pulse. Or the hyperpolarization is continuous.
 
     Args:
@@ -443,7 +938,13 @@ def find_hyperpolarization_segment(dataT, dataI, lowerlim, upperlim):
         dataI (_type_): _description_
         lowerlim (_type_): _description_
         upperlim (_type_): _description_
+        epochs (stimEpochs, optional): the stimulus epoch table of this sweep (as its only sweep). Defaults to None, scanning dataI
     """
+    if epochs is not None:
+        downwardinfl, upwardinfl = epochs.segment(0, -1)
+        if downwardinfl is None:
+            raise IndexError("no hyperpolarizing epoch in the sweep")
+        return downwardinfl, upwardinfl
     #copy dataI so we dont change the original
     dataI = dataI.copy()
     #clip greater than 0 to 0
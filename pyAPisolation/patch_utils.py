@@ -1,17 +1,27 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import sys
+import contextlib
+import functools
+import threading
 import logging
 import pyabf
 from scipy import interpolate
 from scipy.optimize import curve_fit
 import scipy.signal as signal
+from ipfx import time_series_utils as tsu
 from .dataset import cellData
 
 logger = logging.getLogger(__name__)
 
 
-def load_protocols(path):
+def load_protocols(path, use_index=False):
+    if use_index:
+        #read the protocols from the persistent file index, only new or changed files are opened
+        from .database.fileIndex import fileIndex
+        with fileIndex(path, extensions=('.abf',)) as index:
+            return index.protocols()
     protocol = []
     for root,dir,fileList in os.walk(path):
         for filename in fileList:
@@ -70,28 +80,79 @@ def plotabf(abf, spiketimes, lowerlim, upperlim, sweep_plots):
         print('plot failed')
 
 def build_running_bin(array, time, start, end, bin=20, time_units='s', kind='nearest'):
+    binned_, time_bins = build_running_bins(array, time, start, end, bin=bin, time_units=time_units, kind=kind)
+    return binned_[0, :, 0], time_bins
+
+def build_running_bins(values, time, start, end, bin=20, time_units='s', kind='nearest', groups=None, n_groups=None):
+    """
+    Bins several features by spike time in one pass, the nanmean of each feature in each time bin. Empty bins are filled
+    with the nearest spike (or the interp1d of kind), or with the mean if the group has a single spike.
+    Spikes from several sweeps can be binned in the same call by passing the sweep of each spike in groups.
+    takes:
+        values: array (n_spikes, n_features) or (n_spikes,), the features to bin
+        time: array (n_spikes,), the spike times
+        start, end: the start and end time of the bins
+        bin: the bin width, in ms
+        time_units: 's' or 'ms', the units of time, start and end
+        kind: the interpolation used to fill empty bins
+        groups (optional): array (n_spikes,) of ints in [0, n_groups), the group (sweep) of each spike
+        n_groups (optional): the number of groups, groups with no spikes are all nan. Defaults to groups.max() + 1
+    returns:
+        binned: array (n_groups, n_bins, n_features)
+        time_bins: the bin edges, in ms
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    time = np.asarray(time, dtype=np.float64)
     if time_units == 's':
         start = start * 1000
         end = end* 1000
-
         time = time*1000
     time_bins = np.arange(start, end+bin, bin)
-    binned_ = np.full(time_bins.shape[0], np.nan, dtype=np.float64)
+    n_bins, n_features = time_bins.shape[0], values.shape[1]
+    if groups is None:
+        groups = np.zeros(time.shape[0], dtype=np.intp)
+    groups = np.asarray(groups, dtype=np.intp)
+    if n_groups is None:
+        n_groups = groups.max() + 1 if groups.shape[0] > 0 else 1
+
+    #digitize once, then a single bincount over every (feature, group, bin) cell
     index_ = np.digitize(time, time_bins)
-    uni_index_ = np.unique(index_)
-    for time_ind in uni_index_:
-        data = np.asarray(array[index_==time_ind])
-        data = np.nanmean(data)
-        binned_[time_ind] = data
-    nans = np.isnan(binned_)
+    in_range = index_ < n_bins #spikes past the last bin edge have no bin
+    cells = (groups * n_bins + index_)[in_range]
+    n_cells = n_groups * n_bins
+    keys = (np.arange(n_features) * n_cells + cells[:, None]).ravel()
+    flat = values[in_range].ravel()
+    finite = ~np.isnan(flat)
+    sums = np.bincount(keys[finite], weights=flat[finite], minlength=n_cells * n_features)
+    counts = np.bincount(keys[finite], minlength=n_cells * n_features)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = (sums / counts).reshape(n_features, n_groups, n_bins).transpose(1, 2, 0)
+
+    nans = np.isnan(binned)
     if np.any(nans):
-        if time.shape[0] > 1:
-            f = interpolate.interp1d(time, array, kind=kind, fill_value="extrapolate")
-            new_data = f(time_bins)
-            binned_[nans] = new_data[nans]
-        else:
-            binned_[nans] = np.nanmean(array)
-    return binned_, time_bins
+        #the spikes sorted by group then time, so each group is a contiguous, time sorted run
+        order = np.lexsort((time, groups))
+        bounds = np.searchsorted(groups[order], np.arange(n_groups + 1))
+        for group in np.flatnonzero(np.any(nans, axis=(1, 2))):
+            idx = order[bounds[group]:bounds[group + 1]]
+            if idx.shape[0] > 1:
+                fill = _interp_fill(time[idx], values[idx], time_bins, kind)
+            elif idx.shape[0] == 1:
+                fill = np.broadcast_to(values[idx], binned[group].shape)
+            else:
+                continue
+            binned[group][nans[group]] = fill[nans[group]]
+    return binned, time_bins
+
+def _interp_fill(time, values, time_bins, kind='nearest'):
+    #time sorted ascending. For nearest, the same lookup as interpolate.interp1d(kind='nearest', fill_value="extrapolate"), but for all the features at once
+    if kind != 'nearest':
+        return interpolate.interp1d(time, values, kind=kind, axis=0, fill_value="extrapolate")(time_bins)
+    x_bds = time / 2.0
+    x_bds = x_bds[1:] + x_bds[:-1]
+    return values[np.searchsorted(x_bds, time_bins, side='left').clip(0, time.shape[0] - 1)]
 
 def create_dir(fp):
     if os.path.exists(fp):
@@ -131,31 +192,173 @@ def find_downward(dataI):
     downwardinfl = np.nonzero(np.where(diff_I<0, diff_I, 0))[0][0]
     return downwardinfl
 
-def find_non_zero_range(dataT, dataI):
+def find_non_zero_range(dataT, dataI, epochs=None, sweep=0):
+    #with the stimulus epoch table of the file (see dataset.stimEpochs), the range is read from the table of that sweep rather than scanning dataI
+    if epochs is not None:
+        first, last = epochs.non_zero_range(sweep)
+        if first is None:
+            return (0, 0)
+        return (dataT[first], dataT[last])
     non_zero_points = np.nonzero(dataI)[0]
     if len(non_zero_points) == 0:
         return (0, 0)
     return (dataT[non_zero_points[0]], dataT[non_zero_points[-1]])
 
-def filter_bessel(data_V, fs, cutoff):
-    """_summary_
+@functools.lru_cache(maxsize=64)
+def bessel_sos(order, cutoff, fs):
+    """ Second order sections of a low-pass bessel filter (norm='phase'), cached on (order, cutoff, fs).
+    Raises a ValueError if the cutoff is not between 0 and the nyquist frequency (fs / 2)
+    """
+    if not 0 < cutoff < fs / 2:
+        raise ValueError(f"bessel filter cutoff ({cutoff:.1f} Hz) must be above 0 and below the nyquist frequency ({fs / 2:.1f} Hz) of the data")
+    return signal.bessel(order, cutoff, 'low', norm='phase', fs=fs, output='sos')
+
+def filter_bessel(data_V, fs, cutoff, order=4, axis=-1):
+    """ Zero phase (forward-backward) low-pass bessel filter. Works on a single sweep, or on a whole (sweeps, samples) array at once.
 
     Args:
-        data_V (_type_): _description_
-        abf (_type_): _description_
-        cutoff (_type_): _description_
+        data_V (np.array): the data to filter, filtered along axis
+        fs (float): the sample rate of the data, in Hz
+        cutoff (float): the cutoff frequency, in Hz. Must be below the nyquist frequency (fs / 2)
+        order (int, optional): the filter order. Defaults to 4.
+        axis (int, optional): the time axis of data_V. Defaults to -1.
 
     Returns:
-        _type_: _description_
+        np.array: the filtered data
+    """
+    sos = bessel_sos(int(order), float(cutoff), float(fs))
+    return signal.sosfiltfilt(sos, data_V, axis=axis)
+
+def use_bessel(cutoff):
+    """Checks if a bessel_filter setting asks for a filter. None, -1 (or any value <= 0) means no filter"""
+    return cutoff is not None and cutoff > 0
+
+
+class signalCache(object):
     """
-    #filter the abf with 5 khz lowpass
-    #if the cutoff is lower than critical frequency, filter the data
-    try:
-        b, a = signal.bessel(4, cutoff, 'low', norm='phase', fs=fs)
-        dataV = signal.filtfilt(b, a, data_V)
-    except:
-        dataV = data_V
-    return dataV
+    A cache of the derived signals of a sweep: the low-pass filtered voltage and dV/dt, per (sweep, filter). Computed the same way as
+    ipfx.time_series_utils.calculate_dvdt, so the spike detection, the rejected spike analysis, the downstroke search and the plots can all share one copy.
+    Other derived signals (the pre-filtered block, the putative spikes) can be cached with cached().
+    Entries are keyed on the sweep buffers (address, shape, strides and dtype of v and t) and hold a reference to them, so an address is never reused while cached.
+    Nothing is cached outside of a `with cache.scope():` block, and the cache is cleared when the outermost block exits,
+    so data edited in place between runs is never served stale.
+    Takes:
+        maxsize: int, the number of entries to keep (least recently used are dropped first)
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.enabled = True
+        self._depth = 0
+        self._entries = {}
+        self._lock = threading.RLock() #sweeps may be analyzed in threads
+        self.hits = 0
+        self.misses = 0
+
+    @contextlib.contextmanager
+    def scope(self, maxsize=None):
+        #maxsize: keep at least this many entries while in the scope, e.g. to hold every sweep of a file when it is analyzed several times
+        with self._lock:
+            self._depth += 1
+            old_maxsize = self.maxsize
+            self.maxsize = max(self.maxsize, maxsize or 0)
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._depth -= 1
+                self.maxsize = old_maxsize
+                if self._depth == 0:
+                    self.clear()
+
+    @property
+    def active(self):
+        return self.enabled and self._depth > 0
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def _key(kind, arrays, params):
+        def _buffer(arr):
+            return (arr.__array_interface__['data'][0], arr.shape, arr.strides, arr.dtype.str)
+        return (kind, tuple(_buffer(arr) for arr in arrays), params)
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                entry = self._entries.pop(key)
+                self._entries[key] = entry #move to the end
+                return entry[-1]
+            self.misses += 1
+            return None
+
+    def _put(self, key, arrays, value):
+        if not self.active:
+            return value
+        value = np.asarray(value)
+        value.setflags(write=False) #shared between callers
+        with self._lock:
+            self._entries[key] = (arrays, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.pop(next(iter(self._entries)))
+        return value
+
+    def cached(self, kind, arrays, params, compute):
+        """ Any other signal derived from some arrays, e.g. the bessel filtered block of sweeps, or the putative spikes of a sweep.
+        takes:
+            kind (str): the name of the signal
+            arrays (tuple): the arrays it is derived from, keyed on their buffers
+            params (tuple): the (hashable) settings it is derived with
+            compute (callable): computes it (without arguments) when it is not cached
+        """
+        arrays = tuple(np.asarray(arr) for arr in arrays)
+        key = self._key(kind, arrays, params)
+        value = self._get(key) if self.active else None
+        if value is None:
+            value = self._put(key, arrays, compute())
+        return value
+
+    def filtered(self, v, t, filter=None):
+        """ The voltage low-pass filtered with a 4-pole bessel filter (filtfilt), as in calculate_dvdt. Returned as is if filter is None / 0, or t does not have a fixed dt.
+        takes:
+            v (np.array): the voltage of the sweep in mV (1d array)
+            t (np.array): the time of the sweep in s (1d array)
+            filter (float): the cutoff frequency in kHz
+        """
+        v, t = np.asarray(v), np.asarray(t)
+        if not filter or not tsu.has_fixed_dt(t):
+            return v
+        def _filter():
+            sample_freq = 1. / (t[1] - t[0])
+            filt_coeff = (filter * 1e3) / (sample_freq / 2.)
+            if filt_coeff < 0 or filt_coeff >= 1:
+                raise ValueError("bessel coeff ({:f}) is outside of valid range [0,1); cannot filter sampling frequency {:.1f} kHz with cutoff frequency {:.1f} kHz.".format(filt_coeff, sample_freq / 1e3, filter))
+            b, a = signal.bessel(4, filt_coeff, "low")
+            return signal.filtfilt(b, a, v, axis=0)
+        return self.cached('filtered', (v, t), float(filter), _filter)
+
+    def dvdt(self, v, t, filter=None):
+        """ dV/dt of the sweep in V/s, low-pass filtered first if filter is given. The same as ipfx.time_series_utils.calculate_dvdt
+        takes:
+            v (np.array): the voltage of the sweep in mV (1d array)
+            t (np.array): the time of the sweep in s (1d array)
+            filter (float): the cutoff frequency in kHz (optional)
+        """
+        v, t = np.asarray(v), np.asarray(t)
+        def _dvdt():
+            dv = np.diff(self.filtered(v, t, filter))
+            dt = np.diff(t)
+            #some data sources report duplicate timestamps, so we require that dt is not 0
+            mask = np.fabs(dt) > sys.float_info.epsilon
+            return 1e-3 * dv[mask] / dt[mask]
+        return self.cached('dvdt', (v, t), float(filter or 0), _dvdt)
+
+    def seed(self, v, t, filter, dvdt):
+        """ Stores a dV/dt computed elsewhere (e.g. a row of patch_spikes.block_dvdt), it must equal dvdt(v, t, filter)"""
+        v, t = np.asarray(v), np.asarray(t)
+        if self.active:
+            self._put(self._key('dvdt', (v, t), float(filter or 0)), (v, t), dvdt)
 
 def parse_user_input(x=None, y=None, c=None, file=None):
     """ Try to parse the user input and return the parsed values. The user may pass in a single sweep, a list of sweeps, or a range of sweeps. or a file containing the sweeps. 
@@ -0,0 +1,164 @@
+#############
+# A two level work scheduler. Jobs (e.g. one per file) are split into tasks (e.g. chunks of sweeps), and the tasks of every open job
+# share one pool of workers, under a single core budget. This way one long file is spread over all the cores rather than holding
+# a single worker at the tail of a batch, while the results are still reassembled per job, in order.
+#############
+import heapq
+import queue
+import logging
+import traceback
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+def _call(func, args):
+    return func(*args)
+
+def _format_error(error):
+    #the traceback of an error raised in a worker process is attached as the cause
+    return ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+
+
+class workScheduler(object):
+    """
+    Runs jobs made of tasks over one pool of workers.
+    A job is a generator. It yields a list of tasks, each a (func, args) tuple with func a module level (picklable) function, and is sent back
+    the list of their return values, in the same order. It keeps going until it returns its result. If a task raises, the error is thrown into the job.
+    The tasks of all the open jobs are queued together, the earliest opened job first, so the jobs finish roughly in order and only as many jobs
+    are opened (e.g. files loaded) as it takes to keep the workers busy.
+    Takes:
+        n_jobs: int, the core budget (number of workers). 1 runs every task in this process, in order
+        pool: str, 'process' or 'thread' workers. Falls back to threads inside a daemonic process (e.g. a pool worker), which can not start processes
+        max_in_flight: int, the maximum number of tasks handed to the pool but not yet collected. Defaults to 2 * n_jobs
+        max_open_jobs: int, the maximum number of jobs started but not yet finished. Defaults to 2 * n_jobs
+    """
+    def __init__(self, n_jobs=1, pool='process', max_in_flight=None, max_open_jobs=None):
+        self.n_jobs = max(int(n_jobs), 1)
+        self.pool = pool
+        self.max_in_flight = max(int(max_in_flight or 2 * self.n_jobs), self.n_jobs)
+        self.max_open_jobs = max(int(max_open_jobs or 2 * self.n_jobs), 1)
+
+    def map(self, func, items, catch_errors=False):
+        """Runs func(item) for each item as a single task job. Yields (index, result, error) as they finish"""
+        def _job(item):
+            result = yield [(func, (item,))]
+            return result[0]
+        return self.run((_job(item) for item in items), catch_errors=catch_errors)
+
+    def run(self, jobs, catch_errors=False):
+        """ Runs the jobs. Yields (index, result, error) for each job as it finishes, in completion order.
+        If catch_errors, a job that raises is yielded with result None and the formatted traceback as the error, and the rest carry on.
+        Otherwise the error is raised here.
+        """
+        if self.n_jobs == 1:
+            for out in self._run_serial(jobs, catch_errors):
+                yield out
+            return
+        pool = self.pool
+        if pool == 'process' and mp.current_process().daemon:
+            logger.debug('Running the tasks in threads, as this process is a pool worker')
+            pool = 'thread'
+        pool_class = ThreadPool if pool == 'thread' else mp.Pool
+        with pool_class(processes=self.n_jobs) as workers:
+            for out in self._run_pool(workers, jobs, catch_errors):
+                yield out
+
+    def _resume(self, job, values=None, error=None):
+        #advances the job, returns (tasks, None) if it wants tasks run, or (None, result) once it is done
+        while True:
+            try:
+                tasks = job.throw(error) if error is not None else job.send(values)
+            except StopIteration as stop:
+                return None, stop.value
+            tasks = list(tasks)
+            if len(tasks) > 0:
+                return tasks, None
+            values, error = [], None
+
+    def _finish(self, i, error, catch_errors):
+        if not catch_errors:
+            raise error
+        return i, None, _format_error(error)
+
+    def _run_serial(self, jobs, catch_errors):
+        for i, job in enumerate(jobs):
+            values, error = None, None
+            try:
+                while True:
+                    tasks, result = self._resume(job, values, error)
+                    if tasks is None:
+                        break
+                    values, error = [], None
+                    try:
+                        values = [func(*args) for func, args in tasks]
+                    except Exception as e:
+                        error = e
+            except Exception as e:
+                yield self._finish(i, e, catch_errors)
+                continue
+            yield i, result, None
+
+    def _run_pool(self, workers, jobs, catch_errors):
+        jobs = enumerate(jobs)
+        jobs_left = True
+        open_jobs = {} #index -> [job, results, tasks pending, error]
+        ready = [] #heap of (job index, task index, func, args)
+        done = queue.Queue()
+        in_flight = 0
+
+        def _queue(i, tasks):
+            open_jobs[i][1] = [None] * len(tasks)
+            open_jobs[i][2] = len(tasks)
+            for k, (func, args) in enumerate(tasks):
+                heapq.heappush(ready, (i, k, func, args))
+
+        def _advance(i, values=None, error=None):
+            #resume job i, returns the finished (index, result, error) or None if it queued more tasks
+            try:
+                tasks, result = self._resume(open_jobs[i][0], values, error)
+            except Exception as e:
+                del open_jobs[i]
+                return self._finish(i, e, catch_errors)
+            if tasks is None:
+                del open_jobs[i]
+                return i, result, None
+            _queue(i, tasks)
+            return None
+
+        while True:
+            #open more jobs while the queue is too short to keep the workers busy
+            while jobs_left and len(ready) < self.max_in_flight and len(open_jobs) < self.max_open_jobs:
+                try:
+                    i, job = next(jobs)
+                except StopIteration:
+                    jobs_left = False
+                    break
+                open_jobs[i] = [job, None, 0, None]
+                out = _advance(i)
+                if out is not None:
+                    yield out
+            #hand the tasks to the pool, earliest job first
+            while ready and in_flight < self.max_in_flight:
+                i, k, func, args = heapq.heappop(ready)
+                workers.apply_async(_call, (func, args),
+                                    callback=lambda value, key=(i, k): done.put((key, value, None)),
+                                    error_callback=lambda error, key=(i, k): done.put((key, None, error)))
+                in_flight += 1
+            if in_flight == 0:
+                if not jobs_left and not ready:
+                    break
+                continue
+            (i, k), value, error = done.get()
+            in_flight -= 1
+            state = open_jobs[i]
+            state[1][k] = value
+            state[2] -= 1
+            if error is not None and state[3] is None:
+                state[3] = error
+            if state[2] == 0:
+                out = _advance(i, state[1], state[3])
+                state[3] = None
+                if out is not None:
+                    yield out
@@ -1,6 +1,14 @@
 import numpy as np
 import pandas as pd
 import sys
+import os
+import copy
+import json
+import hashlib
+import tempfile
+import functools
+import threading
+from collections import OrderedDict
 
 DEBUG = True
 def debug_wrap(func):
@@ -62,4 +70,205 @@ class arg_wrap(object):
         return args
 
     def _prompt_gui(self):
-        raise NotImplementedError("GUI not yet implemented")
\ No newline at end of file
+        raise NotImplementedError("GUI not yet implemented")
+
+
+# === memoization ===
+
+def source_hash(package_dir):
+    """Returns a hash of the contents of the .py files under package_dir, so any edit to the code gives a new hash"""
+    relpaths = []
+    for folder, dirs, files in os.walk(package_dir):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        relpaths += [os.path.relpath(os.path.join(folder, f), package_dir) for f in files if f.endswith('.py')]
+    h = hashlib.blake2b(digest_size=8)
+    for relpath in sorted(relpaths):
+        h.update(relpath.replace(os.sep, '/').encode())
+        with open(os.path.join(package_dir, relpath), 'rb') as fb:
+            h.update(fb.read())
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def package_version():
+    """Returns the version of the pyAPisolation code that is running, a hash of its source files (the bin scripts run from a source tree
+    that is not installed, where the installed version never changes). Falls back to the installed version, or 'unknown', if the source cannot be read"""
+    try:
+        return 'src-' + source_hash(os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        pass
+    try:
+        from importlib.metadata import version
+        return version('pyAPisolation')
+    except Exception:
+        return 'unknown'
+
+def canonical_params(param_dict):
+    """Returns a string key for a param_dict that does not depend on key order, or on int vs float / numpy vs python numbers (7 == 7.0 == np.float32(7))"""
+    def _canon(value):
+        if isinstance(value, dict):
+            return {str(k): _canon(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [_canon(v) for v in value]
+        if isinstance(value, (bool, np.bool_)) or value is None:
+            return value if value is None else bool(value)
+        if isinstance(value, (int, float, np.integer, np.floating)):
+            return float(value)
+        return str(value)
+    return json.dumps(_canon(param_dict if param_dict is not None else {}), sort_keys=True)
+
+def array_key(*arrays):
+    """Returns a hash of the contents of the arrays. Broadcast views (e.g. a shared time axis) are hashed by their single row"""
+    h = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        if arr is None:
+            h.update(b'None')
+            continue
+        if not isinstance(arr, np.ndarray) or arr.dtype == object:
+            for row in arr:
+                h.update(array_key(np.asarray(row)).encode())
+            continue
+        h.update(f"{arr.shape}{arr.dtype}".encode())
+        if arr.ndim == 2 and arr.strides[0] == 0:
+            arr = arr[0]
+        h.update(np.ascontiguousarray(arr).data)
+    return h.hexdigest()
+
+def file_key(file_path):
+    """Returns a key for a file on disk, based on its path, size and mtime, so an edited file never matches"""
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    return f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+class memoCache(object):
+    """
+    An in-memory LRU cache of function results, with an optional disk tier (joblib files in disk_dir) that survives between sessions.
+    Takes:
+        maxsize: int, the number of results to keep in memory
+        disk_dir (optional): str, folder for the disk tier (default: None, memory only)
+        max_bytes (optional): int, size cap of the disk tier, the least recently used files are evicted past this (default: 1 GB)
+    """
+    def __init__(self, maxsize=128, disk_dir=None, max_bytes=1024**3):
+        self.maxsize = maxsize
+        self.disk_dir = disk_dir
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self._memory = OrderedDict()
+        self._lock = threading.RLock() #analyze_sweep may be called from several threads
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '.joblib')
+
+    def get(self, key):
+        """Returns (hit, value)"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return True, self._memory[key]
+        if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+            from joblib import load
+            try:
+                value = load(self._disk_path(key))
+                #mark the file as recently used
+                os.utime(self._disk_path(key))
+            except Exception:
+                #evicted in the meantime, or unreadable
+                value = None
+            else:
+                self._put_memory(key, value)
+                self.hits += 1
+                return True, value
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+        if self.disk_dir is not None:
+            from joblib import dump
+            os.makedirs(self.disk_dir, exist_ok=True)
+            #each writer dumps to its own temp file then renames it, so a reader (another thread or worker process) never loads a half written file
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.disk_dir)
+            os.close(fd)
+            try:
+                dump(value, tmp)
+                os.replace(tmp, self._disk_path(key))
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            self.evict()
+
+    def _put_memory(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def entries(self):
+        """Returns a list of (last used time, size in bytes, path) for each file of the disk tier, least recently used first"""
+        entries = []
+        if self.disk_dir is None or not os.path.exists(self.disk_dir):
+            return entries
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.joblib'):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                #removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Drops the least recently used files of the disk tier until it is under max_bytes"""
+        entries = self.entries()
+        total = sum([x[1] for x in entries])
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+        if disk:
+            for _, _, path in self.entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def memoize(cache, key_func):
+    """
+    Decorator, caches the results of the function in cache (a memoCache), keyed on key_func(*args, **kwargs).
+    If key_func returns None (e.g. the inputs cannot be keyed) the function is just called.
+    Results are deep copied in and out of the cache, so callers are free to modify what they get back.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return func(*args, **kwargs)
+            key = key_func(*args, **kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            hit, value = cache.get(key)
+            if hit:
+                return copy.deepcopy(value)
+            value = func(*args, **kwargs)
+            cache.put(key, copy.deepcopy(value))
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
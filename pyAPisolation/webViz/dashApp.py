@@ -355,7 +355,7 @@ class dashBackend():
                 if isinstance(fold, (list, tuple, np.ndarray, pd.Series)):
                     fold = fold.to_numpy()[0]
                 file_path = os.path.join(fold, active_row_id + ".abf")
-                x, y, c = loadABF(file_path)
+                x, y, c = loadFile(file_path)
 
                 cutoff = np.argmin(np.abs(x-2.50))
                 x, y = x[:, :cutoff], y[:, :cutoff]
@@ -11,7 +11,7 @@ from scipy.signal import resample, decimate
 from pyAPisolation.patch_ml import *
 from pyAPisolation.patch_utils import *
 from pyAPisolation.featureExtractor import *
-from pyAPisolation.loadFile import loadABF
+from pyAPisolation.loadFile import loadABF, loadFile
 import pyabf
 from http.server import HTTPServer, CGIHTTPRequestHandler
 import matplotlib.pyplot as plt
@@ -45,7 +45,7 @@ def generate_plots(df, static, filename='filename', foldername='foldername.1'):
     folders = df['foldername.1'].to_numpy()
     full_y = []   
     for f, fp in zip(ids, folders):
-        x, y, z = loadABF(os.path.join(fp,f+'.abf')) 
+        x, y, z = loadFile(os.path.join(fp,f+'.abf')) 
         y = decimate(y, 4, axis=1)
         x = decimate(x, 4, axis=1)
         idx = np.argmin(np.abs(x-2.5))
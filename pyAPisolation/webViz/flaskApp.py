@@ -17,7 +17,7 @@ class tsServer:
         @self.app.route('/api/<string:data_id>')
         def get_data(data_id):
             foldername = request.args.get('foldername')
-            x, y, z = loadFile.loadABF(os.path.join(foldername, data_id+'.abf'))
+            x, y, z = loadFile.loadFile(os.path.join(foldername, data_id+'.abf'))
             y = decimate(y, 4, axis=1)
             x = decimate(x, 4, axis=1)
             idx = np.argmin(np.abs(x-2.5))
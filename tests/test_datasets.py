@@ -1,5 +1,5 @@
 import numpy as np
-from pyAPisolation.dataset import cellData
+from pyAPisolation.dataset import cellData, stimEpochs
 from pyAPisolation.database import tsDatabase
 import os
 from joblib import load
@@ -46,6 +46,205 @@ def test_x_y_c():
     print('All tests passed')
 
 
+def test_implicit_time():
+    y = np.random.rand(10, 1000)
+    c = np.random.rand(10, 1000)
+    data = cellData(dataY=y, dataC=c, dt=1e-4)
+
+    #the time axis is a view of a single row
+    assert data.dataX.shape == y.shape
+    assert data.dataX.strides[0] == 0
+    assert np.allclose(data.dataX[3], np.arange(1000) * 1e-4)
+    assert data.sampleRate == 1e4
+    assert np.isclose(data.sweepLengthSec, 999 * 1e-4)
+
+    data.setSweep(2)
+    assert np.all(data.sweepX == data.dataX[2])
+
+
+def test_stim_epochs():
+    #a hyperpolarizing step, then a ladder of depolarizing steps (the first at 0)
+    c = np.zeros((4, 1000))
+    c[:, 100:300] = -20
+    for i in range(4):
+        c[i, 400:700] = 10 * i
+    data = cellData(dataY=np.random.rand(4, 1000), dataC=c, dt=1e-4)
+    epochs = data.epochs
+    assert epochs is data.epochs #built once
+    table = epochs.table
+    assert list(table.columns) == ['sweep', 'epoch', 'start', 'end', 'amplitude', 'polarity']
+    assert len(table[table.sweep == 0]) == 3 and len(table[table.sweep == 3]) == 5
+    #the queries match a scan of the command
+    for i in range(4):
+        idx, delta = epochs.steps(i)
+        diff = np.diff(c[i])
+        assert np.array_equal(idx, np.flatnonzero(diff)) and np.array_equal(delta, diff[diff != 0])
+        assert epochs.first_step(i, -1) == np.flatnonzero(diff < 0)[0]
+        assert epochs.segment(i, -1) == (100, 299)
+        assert epochs.non_zero_range(i) == (100, 699 if i > 0 else 299)
+        assert epochs.points(i) == np.count_nonzero(c[i])
+    assert np.array_equal(epochs.step_counts(), np.count_nonzero(np.diff(c, axis=1), axis=1))
+    assert np.array_equal(epochs.sweeps_with(1, 0, -1), [1, 2, 3])
+    assert len(epochs.sweeps_with(-1, 300, 400)) == 0
+    assert epochs.select(2).table.drop(columns='sweep').equals(table[table.sweep == 2].drop(columns='sweep').reset_index(drop=True))
+    #uneven sweeps give the same epochs
+    assert stimEpochs.from_command(list(c)).table.equals(table)
+
+
+def test_probe_file(tmp_path):
+    #write a small abf, the probe should report the header without loading the data
+    import pyabf
+    from pyAPisolation.loadFile import probeFile, loadFile
+    y = np.random.rand(4, 2000).astype(np.float32)
+    file = str(tmp_path / 'probe.abf')
+    pyabf.abfWriter.writeABF1(y, file, 10000)
+
+    meta = probeFile(file)
+    assert meta['sweepCount'] == 4
+    assert meta['sampleRate'] == 10000
+    assert meta['sweepPointCount'] == 2000
+
+    dataX, dataY, dataC = loadFile(file)
+    assert dataY.shape == (meta['sweepCount'], meta['sweepPointCount'])
+
+
+def test_open_abf(tmp_path, monkeypatch):
+    #the data is only loaded for a matching protocol, and still loads if pyabf's private loader fails
+    import pyabf
+    from pyAPisolation.loadFile import openABF
+    y = np.random.rand(3, 2000).astype(np.float32)
+    file = str(tmp_path / 'open.abf')
+    pyabf.abfWriter.writeABF1(y, file, 10000)
+    assert not hasattr(openABF(file, 'not the protocol'), 'data')
+    expected = openABF(file).data
+    #a private loader that fails on the header only object, the full open that follows still loads
+    load_data = pyabf.ABF._loadAndScaleData
+    calls = []
+    def _fail_first(abf, fb):
+        calls.append(abf)
+        if len(calls) == 1:
+            raise TypeError('changed signature')
+        return load_data(abf, fb)
+    monkeypatch.setattr(pyabf.ABF, '_loadAndScaleData', _fail_first)
+    np.testing.assert_array_equal(openABF(file).data, expected)
+    assert len(calls) == 2
+    np.testing.assert_allclose(expected[0].reshape(3, 2000), y, atol=1e-3)
+
+
+def _write_nwb(file, y, c, rate=10000.):
+    #bare bones nwb layout, enough for the nwbFile loader
+    import h5py
+    with h5py.File(file, 'w') as f:
+        for i in range(y.shape[0]):
+            g = f.create_group(f'acquisition/sweep_{i:03d}')
+            g.attrs['stimulus_description'] = b'Long Square'
+            g.attrs['neurodata_type'] = b'CurrentClampSeries'
+            g.create_dataset('data', data=y[i] / 1000).attrs['conversion'] = 1000.
+            g.create_dataset('starting_time', data=0.).attrs['rate'] = rate
+            s = f.create_group(f'stimulus/presentation/stim_{i:03d}')
+            s.create_dataset('data', data=c[i]).attrs['conversion'] = 1.
+
+
+def test_lazy_nwb(tmp_path):
+    from pyAPisolation.loadFile import loadNWB
+    y = np.random.rand(5, 1000)
+    c = np.random.rand(5, 1000)
+    file = str(tmp_path / 'lazy.nwb')
+    _write_nwb(file, y, c)
+
+    dataX, dataY, dataC = loadNWB(file)
+    lazyX, lazyY, lazyC, nwb = loadNWB(file, return_obj=True, load_into_mem=False)
+    assert len(lazyY) == 5
+    assert np.allclose(lazyY[2], dataY[2])
+    assert np.allclose(lazyY[2, 100:200], dataY[2, 100:200])
+    assert np.allclose(lazyC[1:3], dataC[1:3])
+    assert np.allclose(np.asarray(lazyX), dataX)
+    nwb.close()
+
+
+def test_file_cache(tmp_path):
+    import pyabf
+    from pyAPisolation.loadFile import loadFile, enable_cache, disable_cache
+    file = str(tmp_path / 'cache.abf')
+    pyabf.abfWriter.writeABF1(np.random.rand(3, 1000).astype(np.float32), file, 10000)
+
+    cache = enable_cache(str(tmp_path / 'cache'))
+    try:
+        dataX, dataY, dataC = loadFile(file)
+        cachedX, cachedY, cachedC, obj = loadFile(file, return_obj=True)
+        assert isinstance(cachedY, np.memmap)
+        assert np.array_equal(cachedY, dataY)
+        assert np.array_equal(cachedX, dataX)
+        assert len(cache.entries()) == 1
+
+        #concurrent misses on one file each write their own temp folder, and the ones that lose the race are dropped
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(4) as workers:
+            stored = list(workers.map(lambda _: cache.store(file, dataX, dataY, dataC), range(8)))
+        assert all(stored)
+        assert len(os.listdir(cache.cache_dir)) == 1
+        assert np.array_equal(loadFile(file)[1], dataY)
+
+        #past the size cap the entry is evicted
+        cache.max_bytes = 0
+        cache.evict()
+        assert len(cache.entries()) == 0
+    finally:
+        disable_cache()
+
+
+def test_file_index(tmp_path):
+    import pyabf
+    from pyAPisolation.database.fileIndex import fileIndex
+    for i in range(3):
+        pyabf.abfWriter.writeABF1(np.random.rand(2, 1000).astype(np.float32), str(tmp_path / f'cell_{i}.abf'), 10000)
+
+    index = fileIndex(str(tmp_path))
+    assert len(index) == 3
+    assert index.query()['sweepCount'].to_list() == [2, 2, 2]
+    index.close()
+
+    #the second scan should only re-read the changed and new files
+    pyabf.abfWriter.writeABF1(np.random.rand(4, 1000).astype(np.float32), str(tmp_path / 'cell_0.abf'), 10000)
+    os.remove(tmp_path / 'cell_2.abf')
+    with fileIndex(str(tmp_path), refresh=False) as index:
+        counts = index.refresh()
+        assert counts == {'added': 0, 'updated': 1, 'removed': 1, 'unchanged': 1}
+        assert index.lookup(str(tmp_path / 'cell_0.abf'))['sweepCount'] == 4
+
+
+def test_file_index_read_only(tmp_path, monkeypatch):
+    #a root that can not be written to gets its sidecar in the user's home, or in memory
+    import sqlite3
+    import pyabf
+    from pyAPisolation.database.fileIndex import fileIndex
+    root = tmp_path / 'share'
+    root.mkdir()
+    pyabf.abfWriter.writeABF1(np.random.rand(2, 1000).astype(np.float32), str(root / 'cell.abf'), 10000)
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    connect = sqlite3.connect
+    def _connect(path, *args, **kwargs):
+        if str(path).startswith(str(root)) or (blocked_home and str(path).startswith(str(tmp_path / 'home'))):
+            raise sqlite3.OperationalError('unable to open database file')
+        return connect(path, *args, **kwargs)
+    monkeypatch.setattr(sqlite3, 'connect', _connect)
+    for blocked_home, where in [(False, str(tmp_path / 'home')), (True, ':memory:')]:
+        with fileIndex(str(root)) as index:
+            assert index.index_path.startswith(where)
+            assert index.files() == [str(root / 'cell.abf')]
+    assert not os.path.exists(root / '.pyAPisolation_index.sqlite')
+
+
+def test_index_skipped_files(tmp_path):
+    #the files with an unreadable header are reported as skipped whether the folder is globbed or indexed
+    from pyAPisolation.featureExtractor import batch_feature_extract
+    with open(tmp_path / 'broken.abf', 'wb') as f:
+        f.write(b'not an abf')
+    skipped = [batch_feature_extract(str(tmp_path), {}, protocol_name='', return_skipped=True, use_index=use_index)[3] for use_index in (False, True)]
+    assert skipped[0]['filename'].to_list() == skipped[1]['filename'].to_list() == ['broken.abf']
+    assert skipped[1]['reason'].str.startswith('could not read header').all()
+
+
 def test_database():
     df = load(f'{os.path.dirname(__file__)}/test_data/known_good_df.joblib')
     db = tsDatabase.tsDatabase(dataframe=df, id_col='filename')
@@ -7,17 +7,218 @@
 # The known good df is saved in the test_data folder
 
 import os
+import pytest
 import pandas as pd
 import numpy as np
 from joblib import dump, load
-from pyAPisolation.featureExtractor import batch_feature_extract, save_data_frames, DEFAULT_DICT, analyze_spike_times
-from pyAPisolation.patch_utils import load_protocols
+from pyAPisolation import featureExtractor
+from pyAPisolation.featureExtractor import batch_feature_extract, batch_subthreshold_extract, analyze_subthres, save_subthres_data, save_data_frames, DEFAULT_DICT, analyze_spike_times, analyze_sweep, prescreen_sweeps, sweep_may_spike, SIGNAL_CACHE, PRESCREEN_COUNTS, \
+    analyze_sweepset, SWEEPSET_MEMO, SWEEP_MEMO, process_files, analyze, feature_stages, param_grid_extract
+from pyAPisolation.patch_utils import load_protocols, build_running_bin, build_running_bins, filter_bessel
+from pyAPisolation.patch_spikes import detect_spikes
+from pyAPisolation.patch_subthres import exp_decay_factor, exp_decay_factor_alt, exp_decay_factor_batch, exp_decay_p0, fit_curve, exp_decay_2p, exp_decay_2p_jac, subthresContext, compute_sag, \
+    membrane_resistance, rmp_mode, subthres_a, step_indices, rmp_mode_block, membrane_resistance_block, compute_sag_block, subthres_a_block
+from pyAPisolation.dataset import cellData
+from pyAPisolation.utils import source_hash, package_version, memoCache
+from ipfx import feature_extractor
 import glob
 
 COLS_TO_SKIP = ['Best Fit', 'Curve fit b1', #random / moving api
                  'foldername', 'protocol', #not a feature
                  ]
 
+#the spike detection params the synthetic cells are analyzed with
+SPIKING_PARAMS = {'start': 0.1, 'end': 0.4, 'filter': 0, 'dv_cutoff': 7., 'max_interval': 0.005, 'min_height': 2., 'min_peak': -10., 'thresh_frac': 0.2, 'stim_find': False}
+
+def _spiking_cell(n_sweeps=4, dur=0.5, fs=20000, seed=0):
+    #a small hodgkin huxley cell, with a step of increasing current, for when the recorded data is not around
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(dur * fs)) / fs
+    I = np.zeros((n_sweeps, t.shape[0]))
+    I[:, (t >= 0.1) & (t < 0.4)] = 4. + 4. * np.arange(n_sweeps)[:, None]
+    V, m, h, n = np.full(n_sweeps, -65.), np.full(n_sweeps, 0.05), np.full(n_sweeps, 0.6), np.full(n_sweeps, 0.32)
+    y = np.zeros(I.shape)
+    dt = 1000. / fs / 2
+    for k in range(t.shape[0]):
+        for _ in range(2):
+            m += dt * (0.1 * (V + 40) / (1 - np.exp(-(V + 40) / 10)) * (1 - m) - 4 * np.exp(-(V + 65) / 18) * m)
+            h += dt * (0.07 * np.exp(-(V + 65) / 20) * (1 - h) - h / (1 + np.exp(-(V + 35) / 10)))
+            n += dt * (0.01 * (V + 55) / (1 - np.exp(-(V + 55) / 10)) * (1 - n) - 0.125 * np.exp(-(V + 65) / 80) * n)
+            V = V + dt * (I[:, k] - 120 * m**3 * h * (V - 50) - 36 * n**4 * (V + 77) - 0.3 * (V + 54.4))
+        y[:, k] = V
+    return np.tile(t, (n_sweeps, 1)), y + rng.normal(0, 0.3, y.shape), I
+
+def _spiking_abf(file_path, n_sweeps=4, seed=0):
+    #writes _spiking_cell to an abf file, returns its path
+    import pyabf
+    x, y, c = _spiking_cell(n_sweeps=n_sweeps, seed=seed)
+    pyabf.abfWriter.writeABF1(y.astype(np.float32), str(file_path), 20000)
+    return str(file_path)
+
+
+def test_running_bins():
+    #binning several sweeps in one call should match binning them one by one
+    rng = np.random.default_rng(0)
+    times = [np.sort(rng.uniform(0.1, 0.9, n)) for n in [0, 1, 2, 7, 25]]
+    values = [rng.normal(size=(x.shape[0], 3)) for x in times]
+    values[3][2, 1] = np.nan
+    groups = np.concatenate([np.full(x.shape[0], i) for i, x in enumerate(times)])
+    binned, time_bins = build_running_bins(np.vstack(values), np.concatenate(times), 0.1, 0.9, groups=groups, n_groups=len(times))
+    assert binned.shape == (len(times), time_bins.shape[0], 3)
+    assert np.all(np.isnan(binned[0]))
+    for i in range(1, len(times)):
+        for j in range(3):
+            assert np.allclose(binned[i, :, j], build_running_bin(values[i][:, j], times[i], 0.1, 0.9)[0], equal_nan=True)
+    assert np.allclose(binned[1], values[1][0])
+
+
+def test_prescreen():
+    #flat sweeps are screened out, a sweep with a fast rise inside the window is not, and ipfx agrees
+    x = np.tile(np.arange(20000) / 20000., (3, 1))
+    y = np.full(x.shape, -70.) + np.random.default_rng(0).normal(scale=0.01, size=x.shape)
+    y[2, 10000:10010] = np.linspace(-70, 30, 10)
+    y[2, 10010:10100] = np.linspace(30, -70, 90)
+    params = {'filter': 0, 'dv_cutoff': 20., 'start': 0.1, 'end': 0.9, 'min_peak': -10.}
+    crossings = prescreen_sweeps(x, y, params)
+    may_spike = [sweep_may_spike(crossings[i], x[i], 0.1, 0.9) for i in range(3)]
+    assert may_spike == [False, False, True]
+    for i in range(2):
+        assert analyze_sweep(x[i], y[i], np.zeros(x.shape[1]), params)[0].empty
+    #outside the window, no crossing
+    assert not sweep_may_spike(crossings[2], x[2], 0.6, 0.9)
+
+
+def test_memoize(tmp_path):
+    #a hit is an equal deep copy, so changing it leaves the cache alone, and other params or array contents miss
+    x, y, c = _spiking_cell(n_sweeps=1)
+    #analyze_sweep takes the ipfx params only
+    params = {key: value for key, value in SPIKING_PARAMS.items() if key != 'stim_find'}
+    SWEEP_MEMO.clear()
+    SWEEP_MEMO.hits = SWEEP_MEMO.misses = 0
+    first = analyze_sweep(x[0], y[0], c[0], params)
+    assert (SWEEP_MEMO.hits, SWEEP_MEMO.misses) == (0, 1)
+    #the same contents in another array hit
+    hit = analyze_sweep(x[0].copy(), y[0].copy(), c[0].copy(), dict(params))
+    assert (SWEEP_MEMO.hits, SWEEP_MEMO.misses) == (1, 1)
+    assert hit[0] is not first[0] and len(first[0]) > 0
+    pd.testing.assert_frame_equal(hit[0], first[0])
+    np.testing.assert_equal(hit[1], first[1])
+    hit[0]['peak_v'] = 0.
+    hit[1].clear()
+    again = analyze_sweep(x[0], y[0], c[0], params)
+    pd.testing.assert_frame_equal(again[0], first[0])
+    np.testing.assert_equal(again[1], first[1])
+    #another param, or changed samples, miss
+    analyze_sweep(x[0], y[0], c[0], dict(params, dv_cutoff=10.))
+    assert SWEEP_MEMO.misses == 2
+    y_changed = y[0].copy()
+    y_changed[100] += 1.
+    analyze_sweep(x[0], y_changed, c[0], params)
+    assert (SWEEP_MEMO.hits, SWEEP_MEMO.misses) == (2, 3)
+    #a loaded cellData that is edited after a run is analyzed again, not returned from the cache
+    data = cellData(file=_spiking_abf(tmp_path / 'cell.abf', n_sweeps=3))
+    _, before, _ = analyze_sweepset(file=data, param_dict=dict(SPIKING_PARAMS))
+    data.dataY[:] = -70.
+    _, spikes, _ = analyze_sweepset(file=data, param_dict=dict(SPIKING_PARAMS))
+    _, expected, _ = analyze_sweepset(data.dataX, data.dataY, data.dataC, param_dict=dict(SPIKING_PARAMS))
+    assert len(spikes) == len(expected) < len(before)
+
+
+def test_memo_disk(tmp_path):
+    #the disk tier is shared between caches (e.g. worker processes), only ever read whole, and kept under max_bytes by dropping the least recently used files
+    from concurrent.futures import ThreadPoolExecutor
+    values = {f'key {i}': np.full(1000, float(i)) for i in range(4)}
+    cache = memoCache(maxsize=1, disk_dir=str(tmp_path))
+    cache.put('key 0', values['key 0'])
+    cache.max_bytes = int(3.5 * os.path.getsize(cache._disk_path('key 0')))
+    for key in ['key 1', 'key 2']:
+        cache.put(key, values[key])
+    #another session reads key 0, so key 1 is the least recently used when key 3 goes past the cap
+    other = memoCache(maxsize=1, disk_dir=str(tmp_path))
+    hit, value = other.get('key 0')
+    assert hit and np.array_equal(value, values['key 0'])
+    cache.put('key 3', values['key 3'])
+    other.clear()
+    assert [other.get(key)[0] for key in values] == [True, False, True, True]
+    #writers and readers of the same keys at once, every hit is a whole value
+    def _put_get(i):
+        cache = memoCache(maxsize=1, disk_dir=str(tmp_path / 'shared'))
+        key = f'key {i % 2}'
+        cache.put(key, values[key])
+        return [cache.get(f'key {k}') for k in range(2) for _ in range(5)]
+    with ThreadPoolExecutor(8) as workers:
+        results = list(workers.map(_put_get, range(16)))
+    for k, (hit, value) in enumerate([x for result in results for x in result]):
+        assert not hit or np.array_equal(value, values[f'key {k // 5 % 2}'])
+    assert sorted([x.endswith('.joblib') for x in os.listdir(tmp_path / 'shared')]) == [True, True]
+    cache.clear(disk=True)
+    assert cache.entries() == [] and not cache.get('key 0')[0]
+
+
+def test_source_hash(tmp_path):
+    #the code version the memo and checkpoints are keyed on changes with any edit to the source
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.py').write_text('x = 1')
+    (tmp_path / 'sub' / 'b.py').write_text('y = 1')
+    (tmp_path / 'notes.txt').write_text('not code')
+    first = source_hash(str(tmp_path))
+    (tmp_path / 'notes.txt').write_text('still not code')
+    assert source_hash(str(tmp_path)) == first
+    (tmp_path / 'sub' / 'b.py').write_text('y = 2')
+    assert source_hash(str(tmp_path)) != first
+    assert package_version().startswith('src-')
+
+
+def test_prescreen_counts(tmp_path):
+    #the sweeps counted in worker processes add up in the parent, to the same counts as a serial run
+    import pyabf
+    x, y, c = _spiking_cell(n_sweeps=3)
+    y[0] = -65. #a flat sweep, skipped by the prescreen
+    files = [str(tmp_path / f'cell_{i}.abf') for i in range(2)]
+    for file in files:
+        pyabf.abfWriter.writeABF1(y.astype(np.float32), file, 20000)
+    params = dict(SPIKING_PARAMS)
+    SWEEPSET_MEMO.enabled = False
+    try:
+        for n_jobs, chunksize in [(1, 8), (2, 2), (2, 8)]:
+            PRESCREEN_COUNTS.reset()
+            list(process_files(files, params, '', n_jobs=n_jobs, chunksize=chunksize, pool='process'))
+            assert (PRESCREEN_COUNTS['sweeps'], PRESCREEN_COUNTS['skipped']) == (6, 2)
+    finally:
+        SWEEPSET_MEMO.enabled = True
+
+
+def test_signal_cache():
+    #the cached dV/dt is the same as ipfx computes, and each (sweep, filter) is only computed once in a scope
+    x, y, c = _spiking_cell(n_sweeps=2)
+    SIGNAL_CACHE.hits = SIGNAL_CACHE.misses = 0
+    with SIGNAL_CACHE.scope():
+        for f in (None, 0, 5.):
+            dvdt = SIGNAL_CACHE.dvdt(y[0], x[0], f)
+            assert np.array_equal(dvdt, 1e-3 * np.diff(SIGNAL_CACHE.filtered(y[0], x[0], f)) / np.diff(x[0]))
+            assert SIGNAL_CACHE.dvdt(y[0], x[0], f) is dvdt
+        #a view of the same sweep hits, another sweep does not
+        assert SIGNAL_CACHE.dvdt(y[0][:], x[0], 5.) is dvdt
+        assert SIGNAL_CACHE.dvdt(y[1], x[1], 5.) is not dvdt
+        #the spike detection reads from the cache
+        analyze_sweep.__wrapped__(x[0], y[0], c[0], {'filter': 5., 'start': 0.1, 'end': 0.4})
+        assert SIGNAL_CACHE.hits > 4
+    #cleared on leaving the scope
+    assert len(SIGNAL_CACHE._entries) == 0
+    assert SIGNAL_CACHE.dvdt(y[0], x[0], 5.) is not dvdt
+
+
+def test_filter_bessel():
+    #all the sweeps filtered at once match one at a time, and a cutoff above nyquist is an error
+    x, y, c = _spiking_cell(n_sweeps=2)
+    filtered = filter_bessel(y, 20000, 2000.)
+    assert np.array_equal(filtered[1], filter_bessel(y[1], 20000, 2000.))
+    assert np.std(np.diff(filtered)) < np.std(np.diff(y))
+    with pytest.raises(ValueError):
+        filter_bessel(y, 20000, 12000.)
+    with pytest.raises(ValueError):
+        analyze_sweep(x[0], y[0], c[0], {'start': 0.1, 'end': 0.4}, bessel_filter=10000)
+
 
 def test_dataframe_save():
     # Run the feature extractor
@@ -97,6 +298,341 @@ def test_feature_extractor():
 
         assert False, f"Dataframes are not equal, mean percent error is {np.nanmean(diff)*100}"
 
+def test_numpy_backend():
+    #the numpy spike detector should give the same spike tables as ipfx
+    files = glob.glob(os.path.expanduser('~/Dropbox/sara_cell_v2') + '/**/*.abf', recursive=True)
+    cells = [cellData(file=f) for f in files[:5]]
+    if len(cells) == 0:
+        x, y, c = _spiking_cell()
+        #abf recordings are float32, ipfx keeps the voltages in float32
+        cells = [cellData(dataX=x, dataY=y, dataC=c), cellData(dataX=x, dataY=y.astype(np.float32), dataC=c)]
+    params = [{key: value for key, value in SPIKING_PARAMS.items() if key != 'stim_find'},
+              {'start': 0.1, 'end': 0.25, 'filter': 5, 'dv_cutoff': 20., 'max_interval': 0.001, 'thresh_frac': 0.05}]
+    n_spikes = 0
+    for cell in cells:
+        x, y, c = cell.dataX, cell.dataY, cell.dataC
+        for param in params:
+            spike_dfs = detect_spikes(x, y, c, **param)
+            for i in range(y.shape[0]):
+                expected = feature_extractor.SpikeFeatureExtractor(**param).process(x[i], y[i], c[i])
+                pd.testing.assert_frame_equal(spike_dfs[i], expected, check_exact=False, rtol=1e-9)
+                n_spikes += len(expected)
+    assert n_spikes > 0
+
+
+def test_sweep_n_jobs():
+    #the sweeps analyzed in a pool give the same frames as the serial loop
+    x, y, c = _spiking_cell(n_sweeps=6)
+    params = dict(SPIKING_PARAMS)
+    SWEEPSET_MEMO.enabled = False
+    try:
+        serial = analyze_sweepset(x, y, c, param_dict=params)
+        pooled = [analyze_sweepset(x, y, c, param_dict=dict(params, sweep_n_jobs=3, sweep_pool=pool)) for pool in ['thread', 'process']]
+    finally:
+        SWEEPSET_MEMO.enabled = True
+    for frames in pooled:
+        for a, b in zip(serial, frames):
+            pd.testing.assert_frame_equal(a, b)
+
+
+def test_process_files(tmp_path, monkeypatch):
+    #the files split into sweep chunks over a pool give the same frames as analyzing each file
+    files = [_spiking_abf(tmp_path / f'cell_{i}.abf', n_sweeps=5, seed=i) for i in range(2)]
+    params = dict(SPIKING_PARAMS)
+    SWEEPSET_MEMO.enabled = False
+    try:
+        expected = [analyze_sweepset(file=f, param_dict=params) for f in files]
+        out = list(process_files(files, params, '', n_jobs=2, chunksize=2, pool='thread'))
+        out_process = list(process_files(files, params, '', n_jobs=2, chunksize=2, pool='process'))
+        #files run whole in a worker do not start a sweep pool of their own
+        sweep_pools = []
+        run_sweeps = featureExtractor._run_sweeps
+        monkeypatch.setattr(featureExtractor, '_run_sweeps', lambda tasks, n_jobs=1, pool='process': sweep_pools.append(n_jobs) or run_sweeps(tasks, n_jobs, pool))
+        whole = list(process_files(files, dict(params, sweep_n_jobs=4, sweep_pool='thread'), '', n_jobs=2, chunksize=8, pool='thread'))
+    finally:
+        SWEEPSET_MEMO.enabled = True
+    assert sweep_pools == [1, 1]
+    #the loaded files are not kept once the run is done
+    assert len(featureExtractor._WORKER_DATA._memory) == 0
+    assert sorted([x[0] for x in out]) == [0, 1]
+    assert sorted([x[0] for x in out_process]) == [0, 1]
+    for i, result, error in out + out_process + whole:
+        assert error is None
+        for a, b in zip(expected[i], result):
+            pd.testing.assert_frame_equal(a, b)
+
+
+def test_checkpoint(tmp_path, monkeypatch):
+    #a resumed run only processes the missing, failed or edited files, and merges to the same frames as an uninterrupted run
+    files = [_spiking_abf(tmp_path / f'cell_{i}.abf', n_sweeps=2, seed=i) for i in range(3)]
+    params = dict(SPIKING_PARAMS)
+    checkpoint_dir = str(tmp_path / 'checkpoint')
+    expected = batch_feature_extract(files, params, protocol_name='')
+
+    processed = []
+    run_files = featureExtractor.process_files
+    monkeypatch.setattr(featureExtractor, 'process_files', lambda filelist, *args, **kwargs: processed.append(list(filelist)) or run_files(filelist, *args, **kwargs))
+    def _run():
+        processed.clear()
+        return batch_feature_extract(files, params, protocol_name='', checkpoint_dir=checkpoint_dir)
+
+    #the first run fails on the last file, which is left out and retried on the next run
+    plan_file = featureExtractor._plan_file_task
+    def _fail_last(file_path, *args):
+        if file_path == files[2]:
+            raise RuntimeError('interrupted')
+        return plan_file(file_path, *args)
+    monkeypatch.setattr(featureExtractor, '_plan_file_task', _fail_last)
+    partial = _run()
+    assert set(partial[1]['filename']) == {'cell_0', 'cell_1'}
+    monkeypatch.setattr(featureExtractor, '_plan_file_task', plan_file)
+    resumed = _run()
+    assert processed == [files[2:]]
+    for a, b in zip(expected, resumed):
+        pd.testing.assert_frame_equal(a, b)
+    #a dropped shard
+    os.remove(featureExtractor._shard_path(checkpoint_dir, files[1]))
+    resumed = _run()
+    assert processed == [files[1:2]]
+    for a, b in zip(expected, resumed):
+        pd.testing.assert_frame_equal(a, b)
+    #an edited file is processed again
+    os.utime(files[0], ns=(os.stat(files[0]).st_atime_ns, os.stat(files[0]).st_mtime_ns + 10**9))
+    _run()
+    assert processed == [files[:1]]
+    _run()
+    assert processed == [[]]
+    #another param_dict does not match the checkpoint
+    with pytest.raises(ValueError):
+        batch_feature_extract(files, dict(params, dv_cutoff=10.), protocol_name='', checkpoint_dir=checkpoint_dir)
+    #nor does an edited version of the code
+    monkeypatch.setattr(featureExtractor, 'package_version', lambda: 'src-edited')
+    with pytest.raises(ValueError):
+        batch_feature_extract(files, params, protocol_name='', checkpoint_dir=checkpoint_dir)
+
+
+def test_outputs():
+    #only computing the spike times gives the same spike times as the full analysis
+    x, y, c = _spiking_cell(n_sweeps=4)
+    params = dict(SPIKING_PARAMS)
+    assert feature_stages('sweepwise') == {'sweepwise', 'spike_train', 'spike_features', 'spike_times'}
+    with pytest.raises(ValueError):
+        feature_stages(['spike_times', 'not a stage'])
+    for backend in ['ipfx', 'numpy']:
+        _, full, _ = analyze(x, y, c, param_dict=dict(params, backend=backend), return_summary_frames=True)
+        summary, spikes, running_bin = analyze(x, y, c, param_dict=dict(params, backend=backend), return_summary_frames=True, outputs=['spike_times'])
+        assert 'width' not in spikes.columns and 'Taum (Fast)' not in summary.columns and running_bin.empty
+        pd.testing.assert_frame_equal(full[spikes.columns], spikes)
+        spike_times = analyze_spike_times(x, y, c, param_dict=dict(params, backend=backend))
+        np.testing.assert_array_equal(spike_times[:, 0], full['peak_t'].to_numpy())
+
+
+def test_param_grid(tmp_path):
+    #each param set of the grid gives the same spikes as analyzing the file with those params
+    file = _spiking_abf(tmp_path / 'cell.abf', n_sweeps=3)
+    params = dict(SPIKING_PARAMS)
+    grid = {'dv_cutoff': [7., 15.], 'min_peak': [-10., 10.]}
+    df_grid = param_grid_extract([file], grid, params, protocol_name='')
+    assert df_grid.index.names == ['param set', 'filename', 'sweep Number']
+    assert len(df_grid) == 4 * 3
+    for k, (dv_cutoff, min_peak) in enumerate([(7., -10.), (7., 10.), (15., -10.), (15., 10.)]):
+        rows = df_grid.xs(k, level='param set')
+        assert (rows['dv_cutoff'] == dv_cutoff).all() and (rows['min_peak'] == min_peak).all()
+        _, spikes, _ = analyze_sweepset(file=file, param_dict=dict(params, dv_cutoff=dv_cutoff, min_peak=min_peak))
+        counts = spikes.groupby('sweep Number').size() if 'sweep Number' in spikes.columns else pd.Series(dtype=np.int64)
+        np.testing.assert_array_equal(rows['spike count'].to_numpy(), counts.reindex([1, 2, 3], fill_value=0).to_numpy())
+        if len(counts):
+            np.testing.assert_allclose(rows['peak_t'].dropna().to_numpy(), spikes.groupby('sweep Number')['peak_t'].mean().to_numpy())
+
+
+def test_decay_fit():
+    #the fits recover the taus of a two phase decay, and report how they ended
+    t = np.arange(0, 1.5, 5e-5)
+    c = np.zeros_like(t)
+    c[2000:22000] = -50
+    v = np.full_like(t, -70.)
+    tt = t[2000:22000] - t[2000]
+    v[2000:22000] = -70 - 8 * (1 - np.exp(-tt * 40)) - 3 * (1 - np.exp(-tt * 300))
+    v += np.random.default_rng(0).normal(0, 0.2, t.shape)
+    p0 = exp_decay_p0(tt, v[2000:22000], 2)
+    assert p0[2] > p0[4]
+    tau_fast, tau_slow, curve, r_squared_2p, r_squared_1p, tau_1p, status = exp_decay_factor(t, v, c, 3000, return_status=True)
+    assert status == {'2p': 'converged', '1p': 'converged'}
+    np.testing.assert_allclose([tau_fast, tau_slow], [1 / 300, 1 / 40], rtol=0.1)
+    assert r_squared_2p > 0.9 and r_squared_2p >= r_squared_1p
+    out = exp_decay_factor_alt(t, v, c, 3000, return_status=True)
+    assert len(out) == 7 and out[3] >= out[4]
+    #a budget too small to converge still gives the best fit found so far
+    _, _, curve, _, _, _, status = exp_decay_factor(t, v, c, 3000, max_nfev=10, return_status=True)
+    assert status['2p'] == 'max_nfev' and np.all(np.isfinite(curve))
+    #the calls of an analytic jacobian come out of the same budget
+    calls = []
+    def _model(t, *params):
+        calls.append('func')
+        return exp_decay_2p(t, *params)
+    def _jac(t, *params):
+        calls.append('jac')
+        return exp_decay_2p_jac(t, *params)
+    curve, status = fit_curve(_model, tt, v[2000:22000], p0, max_nfev=6, presample=None, jac=_jac)
+    assert status == 'max_nfev' and len(calls) == 6 and 'jac' in calls
+
+
+def test_decay_fit_baseline():
+    #exp_decay_factor_alt gives the taus and r squared of the original curve_fit (from scipy's default start, stored below), within 0.1%.
+    #Seed 4 has no fast phase left in the fit window, its fast tau is NaN where curve_fit reported 0.00319909, wherever it stopped
+    baseline = {2: [0.01, 0.0365835, 0.784436, 0.783445, 0.034028],
+                3: [0.0044672, 0.0254657, 0.138273, -0.160936, 0.00133333],
+                4: [np.nan, 0.0768396, 0.963101, 0.963101, 0.0768291],
+                7: [0.002, 0.0574648, 0.939448, 0.939414, 0.0571818],
+                10: [0.00334697, 0.077322, 0.973588, 0.973584, 0.0771586],
+                11: [0.01, 0.0363501, 0.0811706, 0.0809759, 0.0299062]}
+    t = np.arange(0, 1.5, 5e-5)
+    c = np.zeros_like(t)
+    c[2000:22000] = -50
+    tt = t[2000:22000] - t[2000]
+    for seed, expected in baseline.items():
+        rng = np.random.default_rng(seed)
+        tau_slow, tau_fast = rng.uniform(0.02, 0.08), rng.uniform(0.002, 0.008)
+        b_slow, b_fast = rng.uniform(5, 12), rng.uniform(0, 4)
+        v = np.full_like(t, -70.)
+        v[2000:22000] = -70 - b_slow * (1 - np.exp(-tt / tau_slow)) - b_fast * (1 - np.exp(-tt / tau_fast))
+        v += rng.normal(0, 0.2, t.shape)
+        out = exp_decay_factor_alt(t, v, c, 3000, return_status=True)
+        np.testing.assert_allclose([out[0], out[1], out[3], out[4], out[5]], expected, rtol=1e-3)
+        assert out[6]['2p'] == ('degenerate' if seed == 4 else 'converged')
+
+
+def test_decay_fit_batch():
+    #fitting the sweeps of a cell together gives the same fits as one at a time
+    rng = np.random.default_rng(1)
+    t = np.arange(0, 1.5, 5e-5)
+    tt = t[2000:22000] - t[2000]
+    V, I = [], []
+    for k in range(6):
+        c = np.zeros_like(t)
+        c[2000:22000] = -10 * (k + 1)
+        v = np.full_like(t, -70.)
+        amp = 0 if k == 2 else (k + 1) / 6
+        v[2000:22000] = -70 - 8 * amp * (1 - np.exp(-tt * 40)) - 3 * amp * (1 - np.exp(-tt * 300))
+        V.append(v + rng.normal(0, 0.2, t.shape))
+        I.append(c)
+    V, I = np.array(V), np.array(I)
+    np.testing.assert_allclose(exp_decay_p0(tt, V[:, 2000:22000], 2), [exp_decay_p0(tt, v[2000:22000], 2) for v in V])
+    fits = exp_decay_factor_batch(t, V, I, 50, return_status=True)
+    assert len(fits) == 6
+    for k, (fit, v, c) in enumerate(zip(fits, V, I)):
+        single = exp_decay_factor(t, v, c, 50)
+        assert fit[6]['2p'] == 'converged'
+        if k == 2:
+            #nothing to fit, the taus are arbitrary
+            np.testing.assert_allclose(fit[3:5], single[3:5], atol=1e-3)
+            continue
+        np.testing.assert_allclose([fit[i] for i in (0, 1, 3, 4, 5)], [single[i] for i in (0, 1, 3, 4, 5)], rtol=1e-2)
+
+
+def test_subthres_context():
+    #the subthreshold functions take the context in place of the cell average arrays
+    t = np.arange(0, 1.5, 5e-5)
+    tt = t[2000:22000] - t[2000]
+    V, I = [], []
+    for k in range(4):
+        c = np.zeros_like(t)
+        c[2000:22000] = -10 * (k + 1)
+        v = np.full_like(t, -70.)
+        v[2000:22000] = -70 - 2 * (k + 1) * (1 - np.exp(-tt * 40))
+        V.append(v)
+        I.append(c)
+    V, I = np.array(V), np.array(I)
+    ctx = subthresContext(t, V, I, indices=[1, 2])
+    mean_v, mean_i = np.nanmean(V[[1, 2]], axis=0), np.nanmean(I[[1, 2]], axis=0)
+    np.testing.assert_array_equal(ctx.meanV, mean_v)
+    assert ctx.meanV is ctx.meanV #computed once
+    assert ctx.epochs == (1999, 21999)
+    assert ctx.dt == pytest.approx(5e-5)
+    assert compute_sag(ctx, 50) == compute_sag(t, mean_v, mean_i, 50)
+    assert membrane_resistance(ctx) == membrane_resistance(t, mean_v, mean_i)
+    np.testing.assert_equal(exp_decay_factor(ctx, 50), exp_decay_factor(t, mean_v, mean_i, 50))
+
+
+def test_subthres_blocks():
+    #the block metrics, and the per sweep functions over them, give the values of the original per sweep implementations (stored below), with nan for the sweeps they can not measure
+    #(rmp, Rm, sag, sag min, subthres_a sag, taum, deflection, deflection index) of each sweep with a step
+    baseline = [(-70.0, 163495790.95688257, -0.3535408361886567, -71.90620101737072, 0.12015344524372365, 0.021891836100366092, -71.90620101737072, 3033),
+                (-70.0, 163580164.54023385, -0.5896140819790077, -73.69559444434313, 0.11772859191797573, 0.02128909602841205, -73.69559444434313, 3325),
+                (-70.0, 163573744.64723194, -0.800048288794386, -75.46243883234057, 0.12494380438506993, 0.02191556098537169, -75.46243883234057, 3095),
+                (-70.0, 163565435.50664607, -1.0008161772004769, -77.21641690192872, 0.12561488546056446, 0.022188015710940034, -77.21641690192872, 2976)]
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 1.0, 1e-4)
+    tt = t[2000:7000] - t[2000]
+    V, I = [], []
+    for k in range(5):
+        c = np.zeros_like(t)
+        c[2000:7000] = -10 * (k + 1)
+        v = np.round(-70 + rng.normal(0, 0.05, t.shape), 2)
+        v[2000:7000] += -2 * (k + 1) * (1 - np.exp(-tt * 40)) + (k + 1) * 0.5 * (1 - np.exp(-tt * 5))
+        V.append(v)
+        I.append(c)
+    I[-1][:] = 0 #no step
+    V, I = np.array(V), np.array(I)
+    downward, upward, rise = step_indices(I)
+    np.testing.assert_array_equal(downward, [1999] * 4 + [-1])
+    np.testing.assert_array_equal(upward, [6999] * 4 + [-1])
+    rmp = rmp_mode_block(V, I)
+    resist = membrane_resistance_block(t, V, I)
+    sag, sag_min = compute_sag_block(t, V, I, 50)
+    suba_sag, taum, deflection, deflection_index = subthres_a_block(t, V, I, 0, 1)
+    for k, expected in enumerate(baseline):
+        assert (rmp[k], resist[k], sag[k], sag_min[k], suba_sag[k], taum[k], deflection[k]) == pytest.approx(expected[:7], rel=1e-9)
+        assert deflection_index[k] == expected[7]
+        sag_a, taum_a, (deflection_a, index_a) = subthres_a(t, V[k], I[k], 0, 1)
+        per_sweep = (rmp_mode(V[k], I[k]), membrane_resistance(t, V[k], I[k]), *compute_sag(t, V[k], I[k], 50), sag_a, taum_a, deflection_a)
+        assert per_sweep == pytest.approx(expected[:7], rel=1e-9)
+        assert index_a == expected[7]
+    assert np.isnan([rmp[4], resist[4], sag[4], sag_min[4], suba_sag[4], taum[4], deflection[4]]).all()
+    assert deflection_index[4] == -1
+
+
+class _subthresABF(object):
+    #a pyabf.ABF like cell, hyperpolarizing steps with a two phase decay
+    def __init__(self, name, n_sweeps=4, protocol='IC1', seed=0):
+        rng = np.random.default_rng(seed)
+        t = np.arange(0, 0.6, 5e-5)
+        tt = t[1000:9000] - t[1000]
+        self.data, self._c = [], []
+        for k in range(n_sweeps):
+            c = np.zeros_like(t)
+            c[1000:9000] = -10 * (k + 1)
+            v = np.full_like(t, -70.)
+            v[1000:9000] = -70 - 2 * (k + 1) * (1 - np.exp(-tt * 40)) - (k + 1) * (1 - np.exp(-tt * 300))
+            v[9000:] = v[8999]
+            self.data.append(v + rng.normal(0, 0.2, t.shape))
+            self._c.append(c)
+        self.data = np.array(self.data)
+        self.name, self.protocol = name, protocol
+        self.sweepCount, self.sweepList, self.sweepLengthSec = n_sweeps, list(range(n_sweeps)), t[-1]
+        self._t = t
+        self.setSweep(0)
+
+    def setSweep(self, sweep):
+        self.sweepX, self.sweepY, self.sweepC = self._t, self.data[sweep], self._c[sweep]
+
+
+def test_batch_subthreshold(tmp_path):
+    #the batch gives the frames of analyzing each file, in order, leaving out the files that fail or are of another protocol
+    cells = [_subthresABF(str(tmp_path / f'cell_{i}.abf'), seed=i) for i in range(2)]
+    expected = [analyze_subthres(_subthresABF(cell.name, seed=i), time_after=50) for i, cell in enumerate(cells)]
+    calls = []
+    files = [cells[0], str(tmp_path / 'missing.abf'), _subthresABF('other', protocol='VC'), cells[1]]
+    avg_df, sweepwise_df, errors = batch_subthreshold_extract(files, {'time_after': 50}, protocol_name='IC1', return_errors=True,
+                                                              progress=lambda n_done, n_files, file: calls.append((n_done, n_files)))
+    assert calls == [(1, 4), (2, 4), (3, 4), (4, 4)]
+    assert list(errors['filename']) == ['missing.abf']
+    pd.testing.assert_frame_equal(sweepwise_df, pd.concat([x[0] for x in expected]))
+    pd.testing.assert_frame_equal(avg_df, pd.concat([x[1] for x in expected]))
+    save_subthres_data(avg_df, sweepwise_df, str(tmp_path), 'test')
+    assert os.path.exists(str(tmp_path / 'subthres_test.xlsx'))
+
+
 def test_analyze_funcs():
     files = glob.glob(os.path.expanduser('~/Dropbox/sara_cell_v2') + '/**/*.abf', recursive=True)
     #load the protocols
@@ -0,0 +1,31 @@
+import pytest
+from pyAPisolation.scheduler import workScheduler
+
+
+def _square(x):
+    return x * x
+
+def _fail(x):
+    raise ValueError(f'bad item {x}')
+
+def _job(n):
+    #a two step job, fans out n tasks then sums them in a final task
+    squares = yield [(_square, (k,)) for k in range(n)]
+    total, = yield [(sum, (squares,))]
+    return total
+
+def test_scheduler_jobs():
+    #the jobs give the same results serially, in threads, and in worker processes
+    for n_jobs, pool in [(1, 'thread'), (3, 'thread'), (2, 'process')]:
+        scheduler = workScheduler(n_jobs=n_jobs, pool=pool)
+        results = dict([(i, result) for i, result, _ in scheduler.run(_job(n) for n in range(6))])
+        assert results == {n: sum([k * k for k in range(n)]) for n in range(6)}
+        assert sorted(scheduler.map(_square, range(4))) == [(i, i * i, None) for i in range(4)]
+
+def test_scheduler_errors():
+    scheduler = workScheduler(n_jobs=2, pool='thread')
+    out = sorted(scheduler.map(_fail, [1, 2], catch_errors=True), key=lambda x: x[0])
+    assert [x[1] for x in out] == [None, None]
+    assert 'bad item 2' in out[1][2]
+    with pytest.raises(ValueError):
+        list(workScheduler(n_jobs=1).map(_fail, [1]))